@@ -0,0 +1,353 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""asyncio client for the NICOS cache (Python 3 only).
+
+This client is meant for external tools that need many concurrent queries
+and update streams, e.g.::
+
+    async with AsyncCacheClient('localhost') as client:
+        values = await client.get_many(['mot/value', 'mot/status'])
+        histories = await client.history_many(['T/value', 'P/value'],
+                                              time.time() - 3600, time.time())
+        subscription = await client.subscribe('mot/')
+        async for (time, key, value, expired) in subscription:
+            ...
+
+Unlike `nicos.devices.cacheclient.CacheClient`, it keeps no local copy of
+the cache values.  Requests are pipelined over a few connections: every
+request is followed by a query for the end marker, whose reply marks the end
+of the reply to the request.  All subscriptions share one connection.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+from collections import deque
+from time import time as currenttime
+
+from nicos.core.errors import CacheError
+from nicos.protocols.cache import DEFAULT_CACHE_PORT, END_MARKER, \
+    HIST_DOWNSAMPLE, OP_ASK, OP_ASKMULTI, OP_SUBSCRIBE, OP_TELL, \
+    OP_TELLOLD, OP_UNSUBSCRIBE, OP_WILDCARD, cache_dump, cache_load, \
+    msg_pattern
+from nicos.pycompat import from_utf8, to_utf8
+from nicos.utils import parseHostPort
+
+END_REQUEST = END_MARKER + OP_ASK + '\n'
+END_REPLY = END_MARKER + OP_TELLOLD
+
+# maximum length of a line received from the cache
+MAX_LINE = 2**24
+
+
+class CacheConnection(object):
+    """A connection to the cache server with pipelined requests.
+
+    The server answers the requests of a connection in order, so the replies
+    are assigned to the pending requests in order as well.  Lines that are
+    not part of a reply are passed to *on_update*.
+    """
+
+    def __init__(self, addr, on_update=None, on_lost=None):
+        self._addr = addr
+        self._on_update = on_update
+        self._on_lost = on_lost
+        self._reader = self._writer = None
+        self._connecting = None
+        # (future, reply lines) for every request sent
+        self._pending = deque()
+
+    @property
+    def load(self):
+        """Number of requests waiting for their reply."""
+        return len(self._pending)
+
+    async def _connect(self):
+        if self._writer is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _open(self):
+        try:
+            self._reader, self._writer = await asyncio.open_connection(
+                self._addr[0], self._addr[1], limit=MAX_LINE)
+        except OSError as err:
+            raise CacheError('unable to connect to %s:%s: %s' %
+                             (self._addr + (err,)))
+        asyncio.ensure_future(self._read(self._reader))
+
+    async def send(self, msg):
+        """Send *msg*, which must not expect a reply."""
+        await self._connect()
+        self._writer.write(to_utf8(msg))
+        await self._writer.drain()
+
+    async def request(self, msg):
+        """Send *msg* and return the lines of the reply."""
+        await self._connect()
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((future, []))
+        self._writer.write(to_utf8(msg + END_REQUEST))
+        await self._writer.drain()
+        return await future
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    raise CacheError('connection closed by the cache')
+                line = from_utf8(line).rstrip('\r\n')
+                if line == END_REPLY:
+                    future, lines = self._pending.popleft()
+                    if not future.done():
+                        future.set_result(lines)
+                elif self._on_update:
+                    self._on_update(line)
+                elif self._pending:
+                    self._pending[0][1].append(line)
+        except (Exception, asyncio.CancelledError) as err:
+            # after close(), or if we already reconnected, nothing to do
+            if reader is self._reader:
+                if not isinstance(err, CacheError):
+                    err = CacheError('connection to the cache failed: %s' %
+                                     err)
+                self.close(err)
+                if self._on_lost:
+                    self._on_lost(err)
+
+    def close(self, err=None):
+        """Close the connection; pending requests fail with *err*."""
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+        while self._pending:
+            future = self._pending.popleft()[0]
+            if not future.done():
+                future.set_exception(err or CacheError('connection closed'))
+
+
+class Subscription(object):
+    """Updates of the keys containing a pattern, as an async iterator.
+
+    The iterator yields (time, key, value, expired) tuples; deleted keys have
+    the value None.  It raises `CacheError` if the connection is lost.
+    """
+
+    def __init__(self, client, pattern):
+        self.pattern = pattern
+        self._client = client
+        self._queue = asyncio.Queue()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def _put(self, item):
+        self._queue.put_nowait(item)
+
+    async def close(self):
+        """End the subscription; the iterator stops after the updates
+        received so far.
+        """
+        await self._client._unsubscribe(self)
+
+
+class AsyncCacheClient(object):
+    """asyncio client for the NICOS cache.
+
+    Keys are given without *prefix*, e.g. ``'motor/value'``.  Requests are
+    distributed over up to *connections* connections to the server.
+    """
+
+    def __init__(self, cache, prefix='nicos/', connections=4):
+        self._addr = parseHostPort(cache, DEFAULT_CACHE_PORT)
+        self._prefix = prefix.strip('/')
+        if self._prefix:
+            self._prefix += '/'
+        self._connections = [CacheConnection(self._addr)
+                             for _ in range(connections)]
+        self._subconn = CacheConnection(self._addr, self._handle_update,
+                                        self._subscriptions_lost)
+        self._subscriptions = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close all connections and end all subscriptions."""
+        for conn in self._connections:
+            conn.close()
+        self._subconn.close()
+        for subscription in self._subscriptions:
+            subscription._put(None)
+        self._subscriptions = []
+
+    async def _request(self, msg):
+        conn = min(self._connections, key=lambda conn: conn.load)
+        return await conn.request(msg)
+
+    def _parse(self, lines):
+        for line in lines:
+            match = msg_pattern.match(line)
+            if match:
+                yield match
+
+    async def get(self, key, default=None):
+        """Get the current value of *key*."""
+        return (await self.get_many([key], default))[0]
+
+    async def get_many(self, keys, default=None):
+        """Get the current values of all *keys* in a single request.
+
+        Returns a list of values in the same order.
+        """
+        keys = [key.lower() for key in keys]
+        if not keys:
+            return []
+        lines = await self._request('@%s%s\n' % (
+            OP_ASKMULTI, ','.join(self._prefix + key for key in keys)))
+        values = {}
+        for match in self._parse(lines):
+            value = match.group('value')
+            if value and match.group('op') == OP_TELL:
+                values[match.group('key')[len(self._prefix):]] = \
+                    cache_load(value)
+        return [values.get(key, default) for key in keys]
+
+    async def query(self, prefix=''):
+        """Return a dictionary of all keys starting with *prefix* and their
+        current values.
+        """
+        prefix = self._prefix + prefix.lower()
+        lines = await self._request('@%s%s\n' % (prefix, OP_WILDCARD))
+        result = {}
+        for match in self._parse(lines):
+            key, value = match.group('key'), match.group('value')
+            if key.startswith(prefix) and value and \
+               match.group('op') == OP_TELL:
+                result[key[len(self._prefix):]] = cache_load(value)
+        return result
+
+    async def put(self, key, value, time=None, ttl=None):
+        """Set *key* to *value*, which is serialized using `cache_dump()`."""
+        if time is None:
+            time = currenttime()
+        ttlstr = ttl and '+%s' % ttl or ''
+        # always use the same connection to keep the order of updates
+        await self._connections[0].send('%r%s@%s%s%s%s\n' % (
+            time, ttlstr, self._prefix, key.lower(), OP_TELL,
+            cache_dump(value)))
+
+    async def history(self, key, fromtime, totime, maxpoints=None):
+        """Return the history of *key* as a list of (time, value) tuples.
+
+        If *maxpoints* is given, the server returns a downsampled history of
+        at most that many values.
+        """
+        downsample = ''
+        if maxpoints:
+            downsample = '%s%d' % (HIST_DOWNSAMPLE, maxpoints)
+        lines = await self._request('%r-%r@%s%s%s%s\n' % (
+            fromtime, totime, self._prefix, key.lower(), OP_ASK, downsample))
+        result = []
+        for match in self._parse(lines):
+            time, value = match.group('time'), match.group('value')
+            if time is not None and value:
+                result.append((float(time), cache_load(value)))
+        return result
+
+    async def history_many(self, keys, fromtime, totime, maxpoints=None):
+        """Return a dictionary of the histories of all *keys*, which are
+        queried concurrently.
+        """
+        results = await asyncio.gather(*[
+            self.history(key, fromtime, totime, maxpoints) for key in keys])
+        return dict(zip(keys, results))
+
+    async def subscribe(self, pattern=''):
+        """Return a `Subscription` for the updates of all keys containing
+        *pattern* (after the prefix, if *pattern* is a key prefix).
+
+        All updates received by the server after this method returns are
+        delivered.
+        """
+        subscription = Subscription(self, self._prefix + pattern.lower())
+        if not any(sub.pattern == subscription.pattern
+                   for sub in self._subscriptions):
+            # the reply to the end marker query confirms the subscription
+            await self._subconn.request('@%s%s\n' % (subscription.pattern,
+                                                     OP_SUBSCRIBE))
+        self._subscriptions.append(subscription)
+        return subscription
+
+    async def _unsubscribe(self, subscription):
+        if subscription not in self._subscriptions:
+            return
+        self._subscriptions.remove(subscription)
+        subscription._put(None)
+        if not any(sub.pattern == subscription.pattern
+                   for sub in self._subscriptions):
+            await self._subconn.send('@%s%s\n' % (subscription.pattern,
+                                                  OP_UNSUBSCRIBE))
+
+    def _handle_update(self, line):
+        match = msg_pattern.match(line)
+        if not match or match.group('op') not in (OP_TELL, OP_TELLOLD):
+            return
+        key = match.group('key')
+        targets = [sub for sub in self._subscriptions if sub.pattern in key]
+        if not targets or not key.startswith(self._prefix):
+            return
+        time, value = match.group('time'), match.group('value')
+        try:
+            value = cache_load(value) if value else None
+        except ValueError:
+            value = None
+        item = (time and float(time), key[len(self._prefix):], value,
+                match.group('op') == OP_TELLOLD)
+        for subscription in targets:
+            subscription._put(item)
+
+    def _subscriptions_lost(self, err):
+        for subscription in self._subscriptions:
+            subscription._put(err)
+        self._subscriptions = []
@@ -1144,8 +1144,14 @@ class HistoryPanel(BaseHistoryWindow, Panel):
         return True
 
     def gethistory_callback(self, key, fromtime, totime):
-        return self.client.ask('gethistory', key, str(fromtime), str(totime),
-                               default=[])
+        history = self.client.ask('gethistory', key, str(fromtime),
+                                  str(totime), str(TimeSeries.maxsize),
+                                  noerror=True, default=None)
+        if history is None:
+            # older daemons do not support downsampling
+            history = self.client.ask('gethistory', key, str(fromtime),
+                                      str(totime), default=[])
+        return history
 
     def on_client_disconnected(self):
         self._disconnected_since = currenttime()
@@ -1217,7 +1223,8 @@ class StandaloneHistoryWindow(DlgUtils, BaseHistoryWindow, QMainWindow):
         self.setStatusBar(self.statusBar)
 
     def gethistory_callback(self, key, fromtime, totime):
-        return self.app.history(None, key, fromtime, totime)
+        return self.app.history(None, key, fromtime, totime,
+                                TimeSeries.maxsize)
 
     def closeEvent(self, event):
         self.saveSettings(self.settings)
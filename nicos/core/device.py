@@ -759,7 +759,8 @@ class Device(object):
             # and rely on saved _params and values
             self._cache = None
 
-    def history(self, name='value', fromtime=None, totime=None):
+    def history(self, name='value', fromtime=None, totime=None,
+                maxpoints=None):
         """Return a history of the parameter *name* (can also be ``'value'`` or
         ``'status'``).
 
@@ -772,6 +773,9 @@ class Device(object):
           'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or 'YYYY-MM-DD HH:MM:SS'
 
         Default is to query the values of the last hour.
+
+        If *maxpoints* is given, the history is downsampled to at most that
+        many values, keeping the minimum and maximum values of each interval.
         """
         if not self._cache:
             # no cache is configured for this setup
@@ -789,7 +793,8 @@ class Device(object):
                 totime = parseDateString(totime, enddate=True)
             elif totime < 0:
                 totime = currenttime() + totime * 3600
-            return self._cache.history(self, name, fromtime, totime)
+            return self._cache.history(self, name, fromtime, totime,
+                                       maxpoints)
 
     def info(self):
         """Return "device information" as an iterable of tuples ``(name,
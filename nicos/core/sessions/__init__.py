@@ -686,9 +686,9 @@ class Session(object):
                 else:
                     self.cache.shutdown()
             if not reuse_cache:
-                self.cache = self.cache_class('Cache',
-                                              cache=normalized_cache,
-                                              prefix='nicos/', lowlevel=True)
+                self.cache = self.cache_class(
+                    'Cache', cache=normalized_cache, prefix='nicos/',
+                    mirror=sysconfig.get('cachemirror', ''), lowlevel=True)
                 # be notified about plug-and-play sample environment devices
                 self.cache.addPrefixCallback('se/', self._pnpHandler)
                 # be notified about watchdog events
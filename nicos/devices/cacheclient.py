@@ -28,20 +28,28 @@
 from __future__ import absolute_import, division, print_function
 
 import errno
+import re
 import select
 import socket
 import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from fnmatch import translate
 from time import sleep, time as currenttime
 
 from nicos import session
-from nicos.core import CacheError, CacheLockError, Device, Param, host
+from nicos.core import CacheError, CacheLockError, Device, Param, host, \
+    intrange
+from nicos.devices.cachemirror import MirrorPublisher, MirrorReader
 from nicos.protocols.cache import BUFSIZE, CYCLETIME, DEFAULT_CACHE_PORT, \
-    END_MARKER, OP_ASK, OP_LOCK, OP_LOCK_LOCK, OP_LOCK_UNLOCK, OP_REWRITE, \
-    OP_SUBSCRIBE, OP_TELL, OP_TELLOLD, OP_UNSUBSCRIBE, OP_WILDCARD, \
-    SYNC_MARKER, cache_dump, cache_load, line_pattern, msg_pattern
+    END_MARKER, HIST_DOWNSAMPLE, OP_ASK, OP_ASKMULTI, OP_LOCK, OP_LOCK_LOCK, \
+    OP_LOCK_UNLOCK, OP_REWRITE, OP_SUBSCRIBE, OP_TELL, OP_TELLOLD, \
+    OP_UNSUBSCRIBE, OP_WILDCARD, SYNC_MARKER, cache_dump, cache_load, \
+    line_pattern, msg_pattern
 #pylint: disable=redefined-builtin
 from nicos.pycompat import from_utf8, iteritems, queue, string_types, \
     to_utf8, xrange
+from nicos.services.cache.stats import Histogram
 from nicos.utils import closeSocket, createThread, getSysInfo, tcpSocket
 
 
@@ -58,6 +66,8 @@ class BaseCacheClient(Device):
     }
 
     remote_callbacks = True
+    # maximum number of idle secondary sockets kept open
+    _max_secsockets = 3
     _worker = None
     _startup_done = None
 
@@ -72,7 +82,10 @@ class BaseCacheClient(Device):
         self._startup_done = threading.Event()
         self._connected = False
         self._socket = None
-        self._secsocket = None
+        # idle secondary sockets, used for requests with replies
+        self._secsockets = []
+        # incremented on disconnect, so that sockets in use are not reused
+        self._secgeneration = 0
         self._sec_lock = threading.RLock()
         self._prefix = self.prefix.strip('/')
         if self._prefix:
@@ -89,6 +102,8 @@ class BaseCacheClient(Device):
         self._stoprequest = False
         self._queue = queue.Queue()
         self._synced = True
+        # data received after the reply to the initial request
+        self._pending_data = b''
 
         # create worker thread, but do not start yet, leave that to subclasses
         self._worker = createThread('CacheClient worker', self._worker_thread,
@@ -134,11 +149,12 @@ class BaseCacheClient(Device):
         if self._socket:
             closeSocket(self._socket)
             self._socket = None
-        # close secondary socket
+        # close secondary sockets
         with self._sec_lock:
-            if self._secsocket:
-                closeSocket(self._secsocket)
-                self._secsocket = None
+            for sock in self._secsockets:
+                closeSocket(sock)
+            self._secsockets = []
+            self._secgeneration += 1
         self._disconnect_action()
 
     def _wait_retry(self):
@@ -150,25 +166,43 @@ class BaseCacheClient(Device):
     def _connect_action(self):
         # send request for all keys and updates....
         # (send a single request for a nonexisting key afterwards to
-        # determine the end of data)
+        # determine the end of data; the subscriptions are sent along so
+        # that no update between the reply and the subscription is missed)
+        started = currenttime()
         msg = '@%s%s\n%s%s\n' % (self._prefix, OP_WILDCARD, END_MARKER, OP_ASK)
-        self._socket.sendall(to_utf8(msg))
+        msg += '@%s%s\n' % (self._prefix, OP_SUBSCRIBE)
+        for prefix in self._prefixcallbacks:
+            msg += '@%s%s\n' % (prefix, OP_SUBSCRIBE)
+        nkeys = self._sync_request(msg)
+        self.log.info('initial sync: got %d keys in %.3f s', nkeys,
+                      currenttime() - started)
 
-        # read response
-        data, n = b'', 0
-        sentinel = to_utf8(END_MARKER + OP_TELLOLD + '\n')
-        while not data.endswith(sentinel) and n < 1000:
-            data += self._socket.recv(BUFSIZE)
-            n += 1
+    def _sync_request(self, msg):
+        """Send *msg*, which must end with a query for the end marker (and
+        optionally subscriptions), and process the reply while it arrives.
 
-        # send request for all updates
-        msg = '@%s%s\n' % (self._prefix, OP_SUBSCRIBE)
+        Returns the number of lines before the end marker.  Data received
+        after the end marker is left for the worker loop.
+        """
+        sentinel = to_utf8(END_MARKER + OP_TELLOLD + '\n')
         self._socket.sendall(to_utf8(msg))
-        for prefix in self._prefixcallbacks:
-            msg = '@%s%s\n' % (prefix, OP_SUBSCRIBE)
-            self._socket.sendall(to_utf8(msg))
-
-        self._process_data(data)
+        # only the last incomplete line is kept between reads
+        data = b''
+        nlines = 0
+        while True:
+            newdata = self._socket.recv(BUFSIZE)
+            if not newdata:
+                raise CacheError('connection closed by the cache')
+            data += newdata
+            end = (b'\n' + data).find(b'\n' + sentinel)
+            if end >= 0:
+                end += len(sentinel)
+                nlines += data.count(b'\n', 0, end) - 1
+                self._process_data(data[:end])
+                self._pending_data = data[end:]
+                return nlines
+            nlines += newdata.count(b'\n')
+            data = self._process_data(data)
 
     def _disconnect_action(self):
         pass
@@ -226,6 +260,7 @@ class BaseCacheClient(Device):
                     if not self._socket:
                         self._wait_retry()
                         continue
+                    data, self._pending_data = self._pending_data, b''
             else:
                 if self._socket:
                     self._disconnect()
@@ -325,7 +360,7 @@ class BaseCacheClient(Device):
         self._disconnect()
 
     def _single_request(self, tosend, sentinel=b'\n', retry=2, sync=False):
-        """Communicate over the secondary socket."""
+        """Communicate over a secondary socket."""
         if not self._socket:
             self._disconnect('single request: no socket')
             if not self._socket:
@@ -333,43 +368,52 @@ class BaseCacheClient(Device):
         if sync:
             # sync has to be false for lock requests, as these occur during startup
             self._queue.join()
+        # take an idle secondary socket, or open a new one if all are in use
+        # by other threads
         with self._sec_lock:
-            if not self._secsocket:
-                try:
-                    self._secsocket = tcpSocket(self.cache, DEFAULT_CACHE_PORT)
-                except Exception as err:
-                    self.log.warning('unable to connect secondary socket '
-                                     'to %s: %s', self.cache, err)
-                    self._secsocket = None
-                    self._disconnect('secondary socket: could not connect')
-                    raise CacheError('secondary socket could not be created')
-
+            sock = self._secsockets.pop() if self._secsockets else None
+            generation = self._secgeneration
+        if sock is None:
             try:
-                # write request
-                # self.log.debug("get_explicit: sending %r", tosend)
-                self._secsocket.sendall(to_utf8(tosend))
-
-                # give 10 seconds time to get the whole reply
-                timeout = currenttime() + 10
-                # read response
-                data = b''
-                while not data.endswith(sentinel):
-                    newdata = self._secsocket.recv(BUFSIZE)  # blocking read
-                    if not newdata:
-                        raise socket.error('cache closed connection')
-                    if currenttime() > timeout:
-                        # do not just break, we need to reopen the socket
-                        raise socket.error('getting response took too long')
-                    data += newdata
-            except socket.error:
-                self.log.warning('error during cache query', exc=1)
-                closeSocket(self._secsocket)
-                self._secsocket = None
-                if retry:
-                    for m in self._single_request(tosend, sentinel, retry - 1):
-                        yield m
-                    return
-                raise
+                sock = tcpSocket(self.cache, DEFAULT_CACHE_PORT)
+            except Exception as err:
+                self.log.warning('unable to connect secondary socket '
+                                 'to %s: %s', self.cache, err)
+                self._disconnect('secondary socket: could not connect')
+                raise CacheError('secondary socket could not be created')
+
+        try:
+            # write request
+            # self.log.debug("get_explicit: sending %r", tosend)
+            sock.sendall(to_utf8(tosend))
+
+            # give 10 seconds time to get the whole reply
+            timeout = currenttime() + 10
+            # read response
+            data = b''
+            while not data.endswith(sentinel):
+                newdata = sock.recv(BUFSIZE)  # blocking read
+                if not newdata:
+                    raise socket.error('cache closed connection')
+                if currenttime() > timeout:
+                    # do not just break, we need to reopen the socket
+                    raise socket.error('getting response took too long')
+                data += newdata
+        except socket.error:
+            self.log.warning('error during cache query', exc=1)
+            closeSocket(sock)
+            if retry:
+                for m in self._single_request(tosend, sentinel, retry - 1):
+                    yield m
+                return
+            raise
+        with self._sec_lock:
+            if generation == self._secgeneration and \
+               len(self._secsockets) < self._max_secsockets:
+                self._secsockets.append(sock)
+                sock = None
+        if sock is not None:
+            closeSocket(sock)
 
         lmatch = line_pattern.match
         mmatch = msg_pattern.match
@@ -468,16 +512,302 @@ class BaseCacheClient(Device):
             self.log.exception('storing sysinfo failed')
 
 
+class HistoryCache(object):
+    """Cache for the results of history queries of a client.
+
+    For the most recently queried *maxkeys* keys, all values of one time range
+    are kept, together with the last value before the range.  Queries that
+    overlap the range only fetch the missing intervals from the cache server.
+
+    Ranges that extend to the current time are "live": they are extended with
+    the updates received for the key, so that repeated queries up to the
+    current time need no request at all.  The client must call `update` for
+    every update, and `disconnected` when updates might have been missed.
+    """
+
+    # queries up to this many seconds before now are considered live
+    live_delay = 1.0
+
+    def __init__(self, maxkeys, maxvalues=100000):
+        self._maxkeys = maxkeys
+        self._maxvalues = maxvalues
+        self._lock = threading.Lock()
+        # maps key -> [fromtime, totime, times, values, live], in LRU order
+        self._entries = OrderedDict()
+        # entries for live ranges that are being fetched
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def disconnected(self):
+        """Stop extending the live ranges, updates may have been missed."""
+        with self._lock:
+            for entry in self._entries.values():
+                entry[4] = False
+            for entry in self._pending.values():
+                entry[4] = False
+
+    def update(self, key, time, value):
+        """Register a new serialized value of *key*."""
+        with self._lock:
+            entry = self._entries.get(key) or self._pending.get(key)
+            if entry is None or not entry[4] or not time:
+                return
+            try:
+                self._insert(entry, time, cache_load(value))
+            except ValueError:
+                # the history can't be kept up to date anymore
+                entry[4] = False
+                self._entries.pop(key, None)
+                return
+            if len(entry[2]) > self._maxvalues:
+                entry[4] = False
+                self._entries.pop(key, None)
+
+    def _insert(self, entry, time, value):
+        times = entry[2]
+        if not times or time > times[-1]:
+            times.append(time)
+            entry[3].append(value)
+        else:
+            index = bisect_left(times, time)
+            if times[index] != time:
+                times.insert(index, time)
+                entry[3].insert(index, value)
+
+    def query(self, key, fromtime, totime, fetch):
+        """Return the history of *key* between *fromtime* and *totime*.
+
+        ``fetch(fromtime, totime)`` must query the cache server and return a
+        list of (time, value) tuples.
+        """
+        now = currenttime()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                if entry[4]:
+                    # all values up to now have been received
+                    entry[1] = max(entry[1], now)
+                if totime < entry[0] or fromtime > entry[1]:
+                    # no overlap, replace the range
+                    entry = None
+        if entry is None:
+            entry = self._fetch(key, fromtime, totime, now, fetch)
+        else:
+            # fetch only the missing intervals
+            left = right = ()
+            oldfrom, oldto = entry[0], entry[1]
+            if fromtime < oldfrom:
+                left = fetch(fromtime, oldfrom)
+            if totime > oldto:
+                right = fetch(oldto, totime)
+            with self._lock:
+                for (time, value) in left:
+                    self._insert(entry, time, value)
+                for (time, value) in right:
+                    if time >= oldto:
+                        self._insert(entry, time, value)
+                entry[0] = min(entry[0], fromtime)
+                entry[1] = max(entry[1], totime)
+        with self._lock:
+            times, values = entry[2], entry[3]
+            start = bisect_left(times, fromtime)
+            end = bisect_right(times, totime)
+            # include the last value before the range, like the server
+            start = max(start - 1, 0)
+            return list(zip(times[start:end], values[start:end]))
+
+    def _fetch(self, key, fromtime, totime, now, fetch):
+        live = totime >= now - self.live_delay
+        if live:
+            # updates received during the query are collected already
+            totime = max(totime, now)
+        entry = [fromtime, totime, [], [], live]
+        if live:
+            with self._lock:
+                self._pending[key] = entry
+        try:
+            result = fetch(fromtime, totime)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        with self._lock:
+            for (time, value) in result:
+                self._insert(entry, time, value)
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self._maxkeys:
+                self._entries.popitem(last=False)
+        return entry
+
+
+class CallbackTrie(object):
+    """Callbacks registered for key patterns.
+
+    Patterns are shell-style globs (see `fnmatch`).  They are stored in a
+    character trie under the literal part before the first wildcard, so that
+    only the patterns whose literal part is a prefix of a key have to be
+    checked for it.
+    """
+
+    def __init__(self):
+        # node: maps character -> child node, and '' -> list of
+        # (pattern, matcher, function); matcher is None for plain prefixes
+        self._root = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _split(self, pattern):
+        match = re.search(r'[*?[]', pattern)
+        if not match:
+            return pattern, ''
+        return pattern[:match.start()], pattern[match.start():]
+
+    def add(self, pattern, function):
+        literal, rest = self._split(pattern)
+        node = self._root
+        for char in literal:
+            node = node.setdefault(char, {})
+        matcher = None if rest == '*' else re.compile(translate(pattern)).match
+        node.setdefault('', []).append((pattern, matcher, function))
+        self._count += 1
+
+    def remove(self, pattern, function):
+        node = self._root
+        for char in self._split(pattern)[0]:
+            node = node.get(char)
+            if node is None:
+                return
+        entries = node.get('', [])
+        for i, entry in enumerate(entries):
+            if entry[0] == pattern and entry[2] == function:
+                del entries[i]
+                self._count -= 1
+                return
+
+    def match(self, key):
+        """Return the functions registered for patterns matching *key*."""
+        result = []
+        node = self._root
+        for char in key + '\0':
+            for (_, matcher, function) in node.get('', ()):
+                if matcher is None or matcher(key):
+                    result.append(function)
+            node = node.get(char)
+            if node is None:
+                break
+        return result
+
+
+class CallbackDispatcher(object):
+    """Runs the callbacks of a cache client in a pool of threads.
+
+    Callbacks for the same key always run in the same thread, in the order
+    of the updates.  Without threads, callbacks run in the calling thread.
+    """
+
+    def __init__(self, log, nthreads):
+        self.log = log
+        self._queues = [queue.Queue() for _ in range(nthreads)]
+        self._threads = [createThread('cache callbacks %d' % i, self._run,
+                                      args=(q,))
+                         for (i, q) in enumerate(self._queues)]
+        self._maxqueued = 0
+        # time from dispatching until the callbacks are finished
+        self._latency = Histogram()
+        # time spent in the callbacks
+        self._runtime = Histogram()
+
+    def dispatch(self, key, callbacks, value, time):
+        if not self._queues:
+            self._call(currenttime(), key, callbacks, value, time)
+            return
+        q = self._queues[hash(key) % len(self._queues)]
+        q.put((currenttime(), key, callbacks, value, time))
+        queued = q.qsize()
+        if queued > self._maxqueued:
+            self._maxqueued = queued
+
+    def stop(self):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            # the client may be shut down from a callback
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def getStats(self):
+        """Return the number of queued callback calls (now and maximum) and
+        histograms of the callback latency and run time.
+        """
+        return {
+            'queued': sum(q.qsize() for q in self._queues),
+            'maxqueued': self._maxqueued,
+            'latency': self._latency.snapshot(),
+            'runtime': self._runtime.snapshot(),
+        }
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            self._call(*item)
+
+    def _call(self, queued, key, callbacks, value, time):
+        started = currenttime()
+        for callback in callbacks:
+            try:
+                callback(key, value, time)
+            except Exception:
+                self.log.warning('error in cache callback', exc=1)
+        finished = currenttime()
+        self._runtime.add(finished - started)
+        self._latency.add(finished - queued)
+
+
 class CacheClient(BaseCacheClient):
 
+    parameters = {
+        'historycache': Param('Number of keys for which history query '
+                              'results are kept (0 disables the cache)',
+                              type=intrange(0, 100000), default=32),
+        'callbackthreads': Param('Number of threads that run the callbacks '
+                                 '(0 runs them in the thread receiving the '
+                                 'updates)', type=intrange(0, 64), default=1),
+        'mirror': Param('Path of the shared memory mirror of the cache '
+                        'values for the clients on this host (empty to '
+                        'disable)', type=str, default=''),
+    }
+
     temporary = True
     _dblock = None
+    _dispatcher = None
+    _publisher = None
+    _reader = None
 
     def doInit(self, mode):
         BaseCacheClient.doInit(self, mode)
+        # maps key -> [value, time, serialized value]; values received from
+        # the cache are only decoded when they are first needed, until then
+        # the serialized value is kept (and set to None after decoding)
         self._db = {}
         self._dblock = threading.Lock()
         self._callbacks = {}
+        self._patterncallbacks = CallbackTrie()
+        self._dispatcher = CallbackDispatcher(self.log, self.callbackthreads)
+        self._history = HistoryCache(self.historycache)
+        # with an attached mirror reader: maps key -> time of values we put,
+        # so that they are not processed again when the mirror sends them
+        self._own_writes = {}
 
         # the execution master lock needs to be refreshed every now and then
         self._ismaster = False
@@ -488,6 +818,8 @@ class CacheClient(BaseCacheClient):
 
     def doShutdown(self):
         BaseCacheClient.doShutdown(self)
+        if self._dispatcher:
+            self._dispatcher.stop()
         # make sure the interface is still usable but has no values to return
         if self._dblock:
             with self._dblock:
@@ -502,14 +834,77 @@ class CacheClient(BaseCacheClient):
         # clear the local database of possibly outdated values
         with self._dblock:
             self._db.clear()
-        # get all current values from the cache
-        BaseCacheClient._connect_action(self)
+        self._own_writes.clear()
+        if self.mirror:
+            self._setup_mirror()
+        if self._reader:
+            # values and updates of our prefix come from the mirror
+            msg = ''.join('@%s%s\n' % (prefix, OP_SUBSCRIBE)
+                          for prefix in self._prefixcallbacks)
+            if msg:
+                self._socket.sendall(to_utf8(msg))
+            self._reader.attach()
+            self.log.info('attached to the cache mirror')
+        else:
+            # get all current values from the cache
+            BaseCacheClient._connect_action(self)
+            if self._publisher:
+                self._publisher.start()
+                self.log.info('publishing the cache mirror')
         # tell the server all our rewrites
         for newprefix, oldprefix in iteritems(self._inv_rewrites):
             self._queue.put(self._prefix + newprefix + OP_REWRITE +
                             self._prefix + oldprefix + '\n')
 
+    def _disconnect_action(self):
+        self._history.disconnected()
+        if self._publisher:
+            self._publisher.stop()
+            self._publisher = None
+        if self._reader:
+            self._reader.stop()
+            self._reader = None
+
+    def _setup_mirror(self):
+        """Become the publisher of the mirror, or attach to it as a reader.
+
+        If neither is possible, the client works without the mirror until it
+        reconnects.
+        """
+        source = '%s|%s' % (self.cache, self._prefix)
+        try:
+            self._publisher = MirrorPublisher.acquire(self.mirror, source,
+                                                      self.log)
+            if not self._publisher:
+                self._reader = MirrorReader(self.mirror, source, self.log,
+                                            self._handle_mirror)
+        except Exception as err:
+            self.log.warning('not using the cache mirror: %s', err)
+
+    def _handle_mirror(self, key, time, value, expired):
+        mytime = self._own_writes.get(key)
+        if mytime is not None:
+            # our own update, or older than it
+            if time <= mytime:
+                if time == mytime:
+                    self._own_writes.pop(key, None)
+                return
+            self._own_writes.pop(key, None)
+        if value is None:
+            # too long for the mirror
+            value = ''
+            for msgmatch in self._single_request(
+                    '@%s%s%s\n' % (self._prefix, key, OP_ASK)):
+                time = msgmatch.group('time') or time
+                value = msgmatch.group('value') or ''
+                expired = msgmatch.group('op') == OP_TELLOLD
+        self._handle_msg(time, None, None, '@', self._prefix + key,
+                         expired and OP_TELLOLD or OP_TELL, value)
+
     def _wait_data(self):
+        if self._reader and self._reader.lost:
+            self._disconnect('lost connection to the cache mirror')
+            return
         if self._ismaster:
             time = currenttime()
             if time > self._master_expires:
@@ -553,30 +948,80 @@ class CacheClient(BaseCacheClient):
                            db_time - time)
             return
 
-        self._propagate((time, key, op, value))
+        self._notify((time, key, op, value))
         # self.log.debug('got %s=%s', key, value)
         if not value or op == OP_TELLOLD:
             with self._dblock:
                 self._db.pop(key, None)
-        else:
+            return
+        self._history.update(key, time, value)
+        if self._do_callbacks and (
+                self._has_callbacks(key) or
+                key.endswith('/value') and session.experiment):
+            # the callbacks need the value anyway
             value = cache_load(value)
             with self._dblock:
-                self._db[key] = (value, time)
-            if self._do_callbacks:
-                if key in self._callbacks:
-                    self._call_callbacks(key, value, time)
-                if key.endswith('/value') and session.experiment:
-                    session.experiment.data.cacheCallback(key, value, time)
+                self._db[key] = [value, time, None]
+            self._call_callbacks(key, value, time)
+            if key.endswith('/value') and session.experiment:
+                session.experiment.data.cacheCallback(key, value, time)
+        else:
+            with self._dblock:
+                self._db[key] = [None, time, value]
+
+    def _decode(self, entry):
+        """Return the value of a local database entry, decoding it on first
+        use.
+        """
+        if entry[2] is not None:
+            entry[0] = cache_load(entry[2])
+            entry[2] = None
+        return entry[0]
+
+    def _decoded_items(self, keys):
+        """Return (key, value) pairs for the given keys of the local database,
+        skipping corrupt values.  Must be called with the database lock held.
+        """
+        result = []
+        for key in keys:
+            try:
+                result.append((key, self._decode(self._db[key])))
+            except ValueError:
+                self.log.warning('ignoring corrupt value for %s', key, exc=1)
+        return result
+
+    def _has_callbacks(self, key):
+        if key in self._callbacks:
+            return True
+        if self._patterncallbacks:
+            with self._dblock:
+                return bool(self._patterncallbacks.match(key))
+        return False
 
     def _call_callbacks(self, key, value, time):
         with self._dblock:
             # copy is intented here to avoid races with add/removeCallback
-            callbacks = tuple(self._callbacks[key])
-        for callback in callbacks:
-            try:
-                callback(key, value, time)
-            except Exception:
-                self.log.warning('error in cache callback', exc=1)
+            callbacks = tuple(self._callbacks.get(key, ()))
+            if self._patterncallbacks:
+                callbacks += tuple(self._patterncallbacks.match(key))
+        if callbacks:
+            self._dispatcher.dispatch(key, callbacks, value, time)
+
+    def getCallbackStats(self):
+        """Return statistics of the callback calls, see
+        `CallbackDispatcher.getStats`.
+        """
+        return self._dispatcher.getStats()
+
+    def _notify(self, args):
+        """Pass a change of the local database to the mirror, if we publish
+        it, and to `_propagate`.
+        """
+        publisher = self._publisher
+        if publisher:
+            time, key, op, value = args
+            publisher.publish(key, time, value, op == OP_TELLOLD)
+        self._propagate(args)
 
     def _propagate(self, args):
         pass
@@ -601,6 +1046,21 @@ class CacheClient(BaseCacheClient):
                     # emty list: remove!
                     self._callbacks.pop(('%s/%s' % (dev, key)).lower(), None)
 
+    def addPatternCallback(self, pattern, function):
+        """Add a callback to be called when a key matching the given pattern
+        is updated.
+
+        The pattern is matched against "device/subkey" and can contain
+        shell-style wildcards, e.g. ``'mot*/status'`` or ``'motor/*'``.
+        """
+        with self._dblock:
+            self._patterncallbacks.add(pattern.lower(), function)
+
+    def removePatternCallback(self, pattern, function):
+        """Remove the given callback for the given pattern, if present."""
+        with self._dblock:
+            self._patterncallbacks.remove(pattern.lower(), function)
+
     def get(self, dev, key, default=None, mintime=None):
         """Get a value from the local cache for the given device and subkey.
 
@@ -624,7 +1084,12 @@ class CacheClient(BaseCacheClient):
             else:
                 self.log.debug('%s not in cache and no cache connection', dbkey)
             return default
-        value, time = entry
+        try:
+            value = self._decode(entry)
+        except ValueError:
+            self.log.warning('ignoring corrupt value for %s', dbkey, exc=1)
+            return default
+        time = entry[1]
         if mintime and time < mintime:
             try:
                 if self.is_connected():
@@ -639,12 +1104,17 @@ class CacheClient(BaseCacheClient):
 
     def get_values(self):
         with self._dblock:
-            return {key: value for (key, (value, _)) in iteritems(self._db)}
+            return dict(self._decoded_items(list(self._db)))
 
     def get_explicit(self, dev, key, default=None):
         """Get a value from the cache server, bypassing the local cache.  This
         is needed if the current update time and ttl is required.
+
+        *key* can also be a list of keys, which are then queried in a single
+        request; a list of (time, ttl, value) tuples is returned.
         """
+        if isinstance(key, (list, tuple)):
+            return self._get_explicit_multi(dev, key, default)
         if dev:
             key = ('%s/%s' % (dev, key)).lower()
         tosend = '@%s%s%s\n' % (self._prefix, key, OP_ASK)
@@ -661,6 +1131,28 @@ class CacheClient(BaseCacheClient):
                     default)
         return (None, None, default)  # shouldn't happen
 
+    def _get_explicit_multi(self, dev, keys, default):
+        if dev:
+            keys = [('%s/%s' % (dev, key)).lower() for key in keys]
+        else:
+            keys = [key.lower() for key in keys]
+        if not keys:
+            return []
+        tosend = '@%s%s\n%s%s\n' % (
+            OP_ASKMULTI, ','.join(self._prefix + key for key in keys),
+            END_MARKER, OP_ASK)
+        results = {}
+        for msgmatch in self._single_request(tosend, b'###!\n'):
+            key = msgmatch.group('key')
+            if key == END_MARKER:
+                break
+            time, ttl, value = msgmatch.group('time'), msgmatch.group('ttl'), \
+                msgmatch.group('value')
+            results[key[len(self._prefix):]] = (
+                time and float(time), ttl and float(ttl),
+                cache_load(value) if value else default)
+        return [results.get(key, (None, None, default)) for key in keys]
+
     def get_raw(self, key, default=None):
         """Get a value from the cache server by full name."""
         tosend = '%s%s\n' % (key, OP_ASK)
@@ -683,13 +1175,17 @@ class CacheClient(BaseCacheClient):
         ttlstr = ttl and '+%s' % ttl or ''
         dbkey = ('%s/%s' % (dev, key)).lower()
         with self._dblock:
-            self._db[dbkey] = (value, time)
+            self._db[dbkey] = [value, time, None]
         dvalue = cache_dump(value)
+        # the server sends no update back to us, but the mirror does
+        self._history.update(dbkey, time, dvalue)
+        if self._reader:
+            self._own_writes[dbkey] = time
         msg = '%r%s@%s%s%s%s%s\n' % (time, ttlstr, self._prefix, dbkey,
                                      flag, OP_TELL, dvalue)
         # self.log.debug('putting %s=%s', dbkey, value)
         self._queue.put(msg)
-        self._propagate((time, dbkey, OP_TELL, dvalue))
+        self._notify((time, dbkey, OP_TELL, dvalue))
         if key == 'value' and session.experiment:
             session.experiment.data.cacheCallback(dbkey, value, time)
         # we have to check rewrites here, since the cache server won't send
@@ -698,8 +1194,10 @@ class CacheClient(BaseCacheClient):
             for newprefix in self._rewrites[str(dev).lower()]:
                 rdbkey = ('%s/%s' % (newprefix, key)).lower()
                 with self._dblock:
-                    self._db[rdbkey] = (value, time)
-                self._propagate((time, rdbkey, OP_TELL, dvalue))
+                    self._db[rdbkey] = [value, time, None]
+                if self._reader:
+                    self._own_writes[rdbkey] = time
+                self._notify((time, rdbkey, OP_TELL, dvalue))
                 if key == 'value' and session.experiment:
                     session.experiment.data.cacheCallback(rdbkey, value, time)
 
@@ -757,7 +1255,9 @@ class CacheClient(BaseCacheClient):
                     msg = '%r@%s%s%s\n' % (time, self._prefix, dbkey, OP_TELL)
                     self._db.pop(dbkey, None)
                     self._queue.put(msg)
-                    self._propagate((time, dbkey, OP_TELL, ''))
+                    if self._reader:
+                        self._own_writes[dbkey] = time
+                    self._notify((time, dbkey, OP_TELL, ''))
 
     def clear_all(self):
         """Clear all cache keys."""
@@ -767,7 +1267,9 @@ class CacheClient(BaseCacheClient):
                 msg = '%r@%s%s%s\n' % (time, self._prefix, dbkey, OP_TELL)
                 self._db.pop(dbkey, None)
                 self._queue.put(msg)
-                self._propagate((time, dbkey, OP_TELL, ''))
+                if self._reader:
+                    self._own_writes[dbkey] = time
+                self._notify((time, dbkey, OP_TELL, ''))
 
     def invalidate(self, dev, key):
         """Locally invalidate device/subkey.  This does not touch the remote
@@ -780,14 +1282,28 @@ class CacheClient(BaseCacheClient):
             self._db.pop(dbkey, None)
 
     # pylint: disable=W0221
-    def history(self, dev, key, fromtime, totime):
+    def history(self, dev, key, fromtime, totime, maxpoints=None):
         """History query: opens a separate connection since it is otherwise not
         possible to determine which response lines belong to it.
+
+        If *maxpoints* is given, the server returns a downsampled history of
+        at most that many values.  Otherwise, results are kept in a local
+        history cache (see `HistoryCache`).
         """
         if dev:
             key = ('%s/%s' % (dev, key)).lower()
-        tosend = '%r-%r@%s%s%s\n###?\n' % (fromtime, totime,
-                                           self._prefix, key, OP_ASK)
+        if maxpoints or not self.historycache:
+            return self._query_history(key, fromtime, totime, maxpoints)
+        return self._history.query(
+            key, fromtime, totime,
+            lambda start, end: self._query_history(key, start, end))
+
+    def _query_history(self, key, fromtime, totime, maxpoints=None):
+        downsample = ''
+        if maxpoints:
+            downsample = '%s%d' % (HIST_DOWNSAMPLE, maxpoints)
+        tosend = '%r-%r@%s%s%s%s\n###?\n' % (fromtime, totime, self._prefix,
+                                             key, OP_ASK, downsample)
         ret = []
         for msgmatch in self._single_request(tosend, b'###!\n', sync=False):
             # process data
@@ -801,10 +1317,11 @@ class CacheClient(BaseCacheClient):
     def query_db(self, query, tries=3):
         with self._dblock:
             if isinstance(query, string_types):
-                return [(k, self._db[k][0]) for k in self._db if k.startswith(query)]
+                return self._decoded_items(
+                    [k for k in self._db if k.startswith(query)])
             else:
-                query = set(query)
-                return [(k, self._db[k][0]) for k in self._db if k in query]
+                return self._decoded_items(
+                    [k for k in set(query) if k in self._db])
 
 
 class DaemonCacheClient(CacheClient):
@@ -828,16 +1345,11 @@ class SyncCacheClient(BaseCacheClient):
 
     def _connect_action(self):
         # like for BaseCacheClient, but without request for updates
-        msg = '@%s%s\n###%s\n' % (self._prefix, OP_WILDCARD, OP_ASK)
-        self._socket.sendall(to_utf8(msg))
-
-        # read response
-        data, n = b'', 0
-        while not data.endswith(b'###!\n') and n < 1000:
-            data += self._socket.recv(BUFSIZE)
-            n += 1
-
-        self._process_data(data)
+        started = currenttime()
+        msg = '@%s%s\n%s%s\n' % (self._prefix, OP_WILDCARD, END_MARKER, OP_ASK)
+        nkeys = self._sync_request(msg)
+        self.log.debug('sync: got %d keys in %.3f s', nkeys,
+                       currenttime() - started)
 
         # stop immediately after reading data
         self._stoprequest = True
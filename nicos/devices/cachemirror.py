@@ -0,0 +1,398 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""Host-local shared memory mirror of the cache values.
+
+One cache client on a host (the *publisher*) keeps the subscription to the
+cache server and writes all current values into a memory mapped table.  Other
+clients on the host attach to the table (as *readers*) instead of subscribing
+themselves; they are notified of changed table slots over a Unix socket.
+
+The table consists of a header and fixed-size slots.  Each key is assigned a
+slot when it is first published, and keeps it for the lifetime of the table.
+Slots are protected by a sequence lock: the publisher increments the sequence
+number of the slot before and after writing it, and readers retry until they
+have copied the slot with the same even sequence number before and after.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import fcntl
+import mmap
+import os
+import socket
+import struct
+import threading
+from time import sleep, time as currenttime
+
+from nicos.protocols.cache import BUFSIZE
+from nicos.pycompat import from_utf8, to_utf8
+from nicos.utils import closeSocket, createThread
+
+MAGIC = b'NICOSMIR'
+VERSION = 1
+
+# magic, version, flags, number of slots, slot size, used slots, source
+HEADER = struct.Struct('<8sIIIII64s')
+HEADER_SIZE = 128
+# sequence number, flags, key length, value length, time
+SLOT = struct.Struct('<IIIId')
+# sequence numbers and other single header fields
+SEQ = struct.Struct('<I')
+FLAGS_OFFSET = 12
+USED_OFFSET = 24
+KEY_OFFSET = SLOT.size
+KEY_SIZE = 232
+VALUE_OFFSET = KEY_OFFSET + KEY_SIZE
+
+# table flags: the publisher could not mirror all keys
+TABLE_INCOMPLETE = 1
+# slot flags: the value is expired, or too long for the slot
+SLOT_EXPIRED = 1
+SLOT_LONG = 2
+
+
+class MirrorTable(object):
+    """The memory mapped table of the mirror.
+
+    With *create*, a new table file is created (replacing an existing one
+    atomically, readers of the old table are not disturbed).  Otherwise the
+    existing table is mapped read-only.
+    """
+
+    def __init__(self, path, source='', nslots=32768, slotsize=1024,
+                 create=False):
+        self.path = path
+        if create:
+            if slotsize <= VALUE_OFFSET:
+                raise ValueError('slot size must be larger than %d' %
+                                 VALUE_OFFSET)
+            tmppath = '%s.%d' % (path, os.getpid())
+            fd = os.open(tmppath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, HEADER_SIZE + nslots * slotsize)
+                self._map = mmap.mmap(fd, HEADER_SIZE + nslots * slotsize)
+            finally:
+                os.close(fd)
+            HEADER.pack_into(self._map, 0, MAGIC, VERSION, 0, nslots,
+                             slotsize, 0, to_utf8(source))
+            os.rename(tmppath, path)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+            if len(self._map) < HEADER_SIZE:
+                self._map.close()
+                raise ValueError('not a cache mirror table')
+            magic, version, _, nslots, slotsize, _, _ = \
+                HEADER.unpack_from(self._map)
+            if magic != MAGIC or version != VERSION or \
+               len(self._map) < HEADER_SIZE + nslots * slotsize:
+                self._map.close()
+                raise ValueError('not a cache mirror table')
+        self.nslots = nslots
+        self.slotsize = slotsize
+        self.valuesize = slotsize - VALUE_OFFSET
+
+    def close(self):
+        self._map.close()
+
+    @property
+    def source(self):
+        return from_utf8(HEADER.unpack_from(self._map)[6].rstrip(b'\0'))
+
+    @property
+    def flags(self):
+        return HEADER.unpack_from(self._map)[2]
+
+    @property
+    def used(self):
+        """Number of slots assigned to keys."""
+        return SEQ.unpack_from(self._map, USED_OFFSET)[0]
+
+    def set_flags(self, flags):
+        SEQ.pack_into(self._map, FLAGS_OFFSET, flags)
+
+    def write(self, index, key, time, value, expired=False):
+        """Write a slot; only called by the publisher.
+
+        Values that do not fit into the slot are marked as long, readers have
+        to get them from the cache server.  If *index* is the next unused
+        slot, it is assigned to the key.
+        """
+        offset = HEADER_SIZE + index * self.slotsize
+        key = to_utf8(key)
+        value = to_utf8(value)
+        flags = expired and SLOT_EXPIRED or 0
+        if len(value) > self.valuesize:
+            flags |= SLOT_LONG
+            value = b''
+        seq = SEQ.unpack_from(self._map, offset)[0]
+        # an odd sequence number tells readers that the slot is being written
+        SEQ.pack_into(self._map, offset, seq + 1)
+        SLOT.pack_into(self._map, offset, seq + 1, flags, len(key),
+                       len(value), time)
+        self._map[offset + KEY_OFFSET:offset + KEY_OFFSET + len(key)] = key
+        self._map[offset + VALUE_OFFSET:
+                  offset + VALUE_OFFSET + len(value)] = value
+        SEQ.pack_into(self._map, offset, seq + 2)
+        if index >= self.used:
+            SEQ.pack_into(self._map, USED_OFFSET, index + 1)
+
+    def read(self, index):
+        """Read a slot consistently.
+
+        Returns (key, time, value, expired); value is None if it is too long
+        for the slot.
+        """
+        offset = HEADER_SIZE + index * self.slotsize
+        while True:
+            seq = SEQ.unpack_from(self._map, offset)[0]
+            if seq & 1:
+                # being written right now
+                sleep(0)
+                continue
+            data = self._map[offset:offset + self.slotsize]
+            if SEQ.unpack_from(self._map, offset)[0] == seq:
+                break
+        _, flags, keylen, valuelen, time = SLOT.unpack_from(data)
+        key = from_utf8(data[KEY_OFFSET:KEY_OFFSET + keylen])
+        if flags & SLOT_LONG:
+            value = None
+        else:
+            value = from_utf8(data[VALUE_OFFSET:VALUE_OFFSET + valuelen])
+        return key, time, value, bool(flags & SLOT_EXPIRED)
+
+
+class MirrorPublisher(object):
+    """Writes the values received by a cache client into the mirror table,
+    and notifies the attached readers.
+
+    Only one publisher per mirror path can exist at a time; this is ensured
+    by a lock on the ``.lock`` file.  Use `acquire` to create a publisher.
+    """
+
+    def __init__(self, path, source, log, lockfd, nslots, slotsize):
+        self.log = log
+        self._path = path
+        self._lockfd = lockfd
+        self._lock = threading.Lock()
+        self._table = MirrorTable(path, source, nslots, slotsize, create=True)
+        # maps key -> slot index
+        self._slots = {}
+        self._readers = []
+        self._server = None
+        self._thread = None
+
+    @classmethod
+    def acquire(cls, path, source, log, nslots=32768, slotsize=1024):
+        """Return a new publisher, or None if another client (in this or
+        another process) is already publishing on the path.
+        """
+        lockfd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(lockfd)
+            return None
+        try:
+            return cls(path, source, log, lockfd, nslots, slotsize)
+        except Exception:
+            os.close(lockfd)
+            raise
+
+    def start(self):
+        """Start accepting readers; call after the table is filled."""
+        sockpath = self._path + '.sock'
+        if os.path.exists(sockpath):
+            os.unlink(sockpath)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(sockpath)
+        self._server.listen(50)
+        self._thread = createThread('cache mirror publisher', self._accept,
+                                    args=(self._server,))
+
+    def _accept(self, server):
+        while True:
+            try:
+                conn = server.accept()[0]
+            except socket.error:
+                # server socket was closed
+                return
+            # a reader that is too slow is dropped, it will resync
+            conn.settimeout(2)
+            with self._lock:
+                if self._server is None:
+                    closeSocket(conn)
+                    return
+                self._readers.append(conn)
+
+    def publish(self, key, time, value, expired=False):
+        with self._lock:
+            if self._table is None:
+                return
+            index = self._slots.get(key)
+            if index is None:
+                index = len(self._slots)
+                if index >= self._table.nslots or \
+                   len(to_utf8(key)) > KEY_SIZE:
+                    self._abandon('cannot mirror key %r, the mirror table '
+                                  'is full or the key is too long' % key)
+                    return
+                self._slots[key] = index
+            self._table.write(index, key, time or 0, value, expired)
+            if not self._readers:
+                return
+            line = to_utf8('%d\n' % index)
+            for conn in self._readers[:]:
+                try:
+                    conn.sendall(line)
+                except socket.error:
+                    self.log.warning('dropping slow cache mirror reader')
+                    closeSocket(conn)
+                    self._readers.remove(conn)
+
+    def _abandon(self, why):
+        # mark the table as incomplete: readers detach and don't attach
+        # again, but nobody else becomes publisher while we hold the lock
+        self.log.warning('%s; disabling the cache mirror', why)
+        self._table.set_flags(TABLE_INCOMPLETE)
+        self._close()
+
+    def _close(self):
+        if self._server:
+            closeSocket(self._server)
+            self._server = None
+            os.unlink(self._path + '.sock')
+        for conn in self._readers:
+            closeSocket(conn)
+        self._readers = []
+        if self._table:
+            self._table.close()
+            self._table = None
+
+    def stop(self):
+        with self._lock:
+            self._close()
+            if self._lockfd is not None:
+                os.close(self._lockfd)
+                self._lockfd = None
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class MirrorReader(object):
+    """Reads the mirror table and receives the change notifications.
+
+    *callback* is called as ``callback(key, time, value, expired)`` for all
+    keys when attaching (from `attach`) and for every change afterwards (from
+    the reader thread).  When the publisher goes away, `lost` is set and the
+    client must reconnect.
+    """
+
+    def __init__(self, path, source, log, callback, wait=10):
+        self.log = log
+        self.lost = False
+        self._callback = callback
+        self._stopped = False
+        self._thread = None
+        # the publisher fills the table before accepting readers; wait for
+        # it if it is just starting up
+        deadline = currenttime() + wait
+        while True:
+            try:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(path + '.sock')
+                break
+            except socket.error:
+                closeSocket(self._sock)
+                if self._incomplete(path):
+                    raise ValueError('mirror table is incomplete')
+                if currenttime() > deadline:
+                    raise
+                sleep(0.1)
+        try:
+            self._table = MirrorTable(path)
+            if self._table.source != source:
+                raise ValueError('mirror table is for %r, not %r' %
+                                 (self._table.source, source))
+            if self._table.flags & TABLE_INCOMPLETE:
+                raise ValueError('mirror table is incomplete')
+        except Exception:
+            closeSocket(self._sock)
+            raise
+
+    def _incomplete(self, path):
+        # the publisher has given up, no need to wait for it
+        try:
+            table = MirrorTable(path)
+        except Exception:
+            return False
+        try:
+            return bool(table.flags & TABLE_INCOMPLETE)
+        finally:
+            table.close()
+
+    def attach(self):
+        """Pass all current values to the callback and start receiving
+        changes.
+        """
+        # already connected, so no change after the scan can be missed
+        for index in range(self._table.used):
+            self._callback(*self._table.read(index))
+        self._thread = createThread('cache mirror reader', self._run)
+
+    def _run(self):
+        data = b''
+        while True:
+            try:
+                newdata = self._sock.recv(BUFSIZE)
+            except socket.error:
+                newdata = b''
+            if not newdata or self._stopped:
+                break
+            data += newdata
+            lines = data.split(b'\n')
+            data = lines.pop()
+            for line in lines:
+                try:
+                    self._callback(*self._table.read(int(line)))
+                except Exception:
+                    self.log.warning('error handling cache mirror update',
+                                     exc=1)
+        if not self._stopped:
+            self.lost = True
+
+    def stop(self):
+        self._stopped = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        closeSocket(self._sock)
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._table.close()
@@ -75,19 +75,41 @@ Operation: ``OP_ASK`` or ``'?'``
 - When an ``@`` is present, the timestamp is returned with the reply.
 - With ``time1-time2@`` or ``time1+timeinterval@``, a history query is made and
   several values can be returned.
-- The value, if present, is ignored.
+- For history queries, a value of ``~N`` requests a downsampled history of at
+  most N values: the time range is divided into intervals, and only the
+  minimum and maximum value in each interval are returned (for non-numeric
+  values, the first and the last one).
+- Otherwise, the value, if present, is ignored.
 
 Examples::
 
   nicos/temp/value?                         # request only the value
   @nicos/temp/value?                        # request value with timestamp
   1327504780-1327504790@nicos/temp/value?   # request all values in time range
+  1327504780-1327504790@nicos/temp/value?~1000  # ... at most 1000 values
 
 Response: except for history queries, a single line in the form ``key=value``
 or ``time@key=value``, see below.  If the key is nonexistent or expired, the
 form is ``[time@]key!`` or ``[time@]key!value``.  For history queries, a number
 of lines of the same form.
 
+Querying multiple keys
+----------------------
+
+Operation: ``OP_ASKMULTI`` or ``'&'``
+
+- The key is empty; the value is a comma-separated list of keys.
+- Like for op '?', timestamps (and TTLs) are returned if ``@`` is present.
+- History queries are not allowed.
+
+Examples::
+
+  &nicos/temp/value,nicos/temp/status       # request only values
+  @&nicos/temp/value,nicos/temp/status      # request values with timestamps
+
+Response: for each requested key, in the requested order, a single line as for
+a single query.
+
 Querying with wildcard
 ----------------------
 
@@ -203,8 +225,8 @@ from ast import Add, BinOp, Call, Dict, List, Name, Num, Set, Str, Sub, \
     Tuple, UnaryOp, USub, parse
 from base64 import b64decode, b64encode
 
-from nicos.pycompat import binary_type, cPickle as pickle, from_utf8, \
-    iteritems, number_types, text_type
+from nicos.pycompat import PY2, binary_type, cPickle as pickle, \
+    from_utf8, iteritems, number_types, string_types, text_type
 from nicos.utils import readonlydict, readonlylist
 
 try:
@@ -230,6 +252,7 @@ OP_UNSUBSCRIBE = '|'
 OP_TELLOLD = '!'
 OP_LOCK = '$'
 OP_REWRITE = '~'
+OP_ASKMULTI = '&'
 
 OP_LOCK_LOCK = '+'
 OP_LOCK_UNLOCK = '-'
@@ -237,6 +260,9 @@ OP_LOCK_UNLOCK = '-'
 # put flags between key and op...
 FLAG_NO_STORE = '#'
 
+# value prefix for downsampled history queries
+HIST_DOWNSAMPLE = '~'
+
 # end/sync special token
 END_MARKER = '###'
 SYNC_MARKER = '#sync#'
@@ -249,7 +275,7 @@ CYCLETIME = 0.1
 BUFSIZE = 8192
 
 opkeys = OP_TELL + OP_ASK + OP_WILDCARD + OP_SUBSCRIBE + OP_UNSUBSCRIBE + \
-    OP_TELLOLD + OP_LOCK + OP_REWRITE
+    OP_TELLOLD + OP_LOCK + OP_REWRITE + OP_ASKMULTI
 
 # regular expression matching a cache protocol message
 msg_pattern = re.compile(r'''
@@ -272,8 +298,27 @@ line_pattern = re.compile(br'([^\r\n]*)\r?\n')
 
 repr_types = number_types + (text_type, binary_type)
 
+# exact types handled by the fast paths of cache_dump
+_repr_exact = frozenset(repr_types + (bool,))
+_brackets = {list: ('[', ']'), readonlylist: ('[', ']'), tuple: ('(', ')')}
+
 
 def cache_dump(obj):
+    cls = type(obj)
+    if cls in _repr_exact:
+        return repr(obj)
+    elif cls in _brackets:
+        opening, closing = _brackets[cls]
+        return opening + ''.join([
+            (repr(item) if type(item) in _repr_exact else cache_dump(item)) +
+            ',' for item in obj]) + closing
+    elif obj is None:
+        return 'None'
+    return _cache_dump(obj)
+
+
+def _cache_dump(obj):
+    # general case, also handles subclasses of the basic types
     res = []
     if isinstance(obj, repr_types):
         res.append(repr(obj))
@@ -367,7 +412,51 @@ def ast_eval(node):
     return _convert(node)
 
 
+# values that need no parsing, and regexes for the common simple values that
+# are decoded without building an AST
+_load_constants = dict(_safe_names, **{'-inf': -float('inf'),
+                                       '-nan': -float('nan')})
+_INT = r'-?(?:0|[1-9][0-9]*)'
+_FLOAT = (r'-?(?:(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+          r'|[0-9]+[eE][-+]?[0-9]+|inf|nan)')
+_STR = r'\'[^\'\\]*\'|"[^"\\]*"'
+# items of sequences are split at commas, so strings must not contain any;
+# on Python 2, parsing a string literal would give a byte string
+_ITEM = _FLOAT + '|' + _INT + ('' if PY2 else r'|\'[^\'\\,]*\'|"[^"\\,]*"')
+_int_match = re.compile(_INT + r'\Z').match
+_float_match = re.compile(_FLOAT + r'\Z').match
+_str_match = re.compile('(?:%s)\\Z' % _STR).match
+_list_match = re.compile(r'\[(?:(?:%s),)*\]\Z' % _ITEM).match
+_tuple_match = re.compile(r'\((?:(?:%s),)+\)\Z' % _ITEM).match
+
+
+def _load_item(token):
+    if token[0] in '\'"':
+        return token[1:-1]
+    elif token.lstrip('-').isdigit():
+        return int(token)
+    return float(token)
+
+
 def cache_load(entry):
+    if isinstance(entry, string_types) and entry:
+        first = entry[0]
+        if first == '[':
+            if _list_match(entry):
+                return readonlylist(map(_load_item,
+                                        entry[1:-1].split(',')[:-1]))
+        elif first == '(':
+            if _tuple_match(entry):
+                return tuple(map(_load_item, entry[1:-1].split(',')[:-1]))
+        elif first in '\'"':
+            if not PY2 and _str_match(entry):
+                return entry[1:-1]
+        elif entry in _load_constants:
+            return _load_constants[entry]
+        elif _int_match(entry):
+            return int(entry)
+        elif _float_match(entry):
+            return float(entry)
     try:
         # parsing with 'eval' always gives an ast.Expression node
         expr = parse(entry, mode='eval').body
@@ -25,6 +25,7 @@
 from __future__ import absolute_import, division, print_function
 
 from nicos.services.cache.database.base import CacheDatabase
+from nicos.services.cache.database.columnar import ColumnarCacheDatabase
 from nicos.services.cache.database.flatfile import FlatfileCacheDatabase
 from nicos.services.cache.database.memory import MemoryCacheDatabase, \
     MemoryCacheDatabaseWithHistory
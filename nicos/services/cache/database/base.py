@@ -25,11 +25,152 @@
 from __future__ import absolute_import, division, print_function
 
 import threading
+from collections import OrderedDict
+from heapq import heappop, heappush
+from itertools import count
 from time import time as currenttime
 
 from nicos.core import ConfigurationError, Device
-from nicos.protocols.cache import OP_LOCK, OP_LOCK_LOCK, OP_LOCK_UNLOCK
+from nicos.protocols.cache import OP_LOCK, OP_LOCK_LOCK, OP_LOCK_UNLOCK, \
+    OP_TELL
+from nicos.pycompat import iteritems
 from nicos.services.cache.entry import CacheEntry
+from nicos.services.cache.stats import Histogram
+
+
+class ExpiryQueue(object):
+    """Schedules the expiry of cache entries with a TTL.
+
+    Entries are kept in a heap ordered by their expiry time.  Replaced entries
+    are not removed from the heap; the *expire* callback given to `run` must
+    check if the entry is still current, and can reschedule it if its TTL was
+    extended in the meantime.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._counter = count()
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, key, entry):
+        """Schedule expiry of *entry* (stored under *key*), if it has a
+        TTL.
+        """
+        if not entry.ttl:
+            return
+        item = (entry.time + entry.ttl, next(self._counter), key, entry)
+        with self._cond:
+            heappush(self._heap, item)
+            if self._heap[0] is item:
+                # new earliest expiry time
+                self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self, expire):
+        """Call ``expire(key, entry, time)`` for each scheduled entry when
+        it is due, until `stop` is called.
+        """
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = currenttime()
+                    if self._heap and self._heap[0][0] <= now:
+                        _, _, key, entry = heappop(self._heap)
+                        break
+                    self._cond.wait(self._heap and self._heap[0][0] - now
+                                    or None)
+                else:
+                    return
+            try:
+                expire(key, entry, now)
+            except Exception:
+                # the callback should log errors itself
+                pass
+
+
+class WildcardIndex(object):
+    """Index for the wildcard queries of a cache database.
+
+    Wildcard queries return all keys that contain the requested string.  For
+    the most recently used *maxpatterns* patterns, the set of matching keys is
+    kept and extended when keys are updated, so that only the first query of
+    a pattern has to look at all keys.  The serialized responses are kept as
+    well, until a matching key is updated or a returned TTL runs out.
+
+    The database must call `update` for every change of a key, and `clear`
+    when it is cleared.
+    """
+
+    def __init__(self, maxpatterns=32):
+        self._maxpatterns = maxpatterns
+        self._lock = threading.Lock()
+        # maps pattern -> [set of matching keys, generation], in LRU order
+        self._patterns = OrderedDict()
+        # maps (pattern, ts) -> (response, time until which it is valid)
+        self._responses = {}
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def clear(self):
+        with self._lock:
+            self._patterns.clear()
+            self._responses.clear()
+
+    def update(self, key):
+        """Register a change of *key* (which may be new)."""
+        with self._lock:
+            for pattern, entry in iteritems(self._patterns):
+                if pattern in key:
+                    entry[0].add(key)
+                    entry[1] += 1
+                    self._responses.pop((pattern, False), None)
+                    self._responses.pop((pattern, True), None)
+
+    def query(self, pattern, ts, scan, build):
+        """Return the response to a wildcard query for *pattern*.
+
+        ``scan()`` must return all keys of the database; it is only called
+        when the pattern is not indexed yet.  ``build(keys, ts)`` must return
+        the response for the given keys and the time until which it is valid.
+        """
+        now = currenttime()
+        with self._lock:
+            entry = self._patterns.pop(pattern, None)
+            cached = self._responses.get((pattern, ts))
+            new = entry is None
+            if new:
+                entry = [set(), 0]
+                while len(self._patterns) >= self._maxpatterns:
+                    oldpattern = self._patterns.popitem(last=False)[0]
+                    self._responses.pop((oldpattern, False), None)
+                    self._responses.pop((oldpattern, True), None)
+            self._patterns[pattern] = entry
+            if cached is not None and now < cached[1]:
+                return cached[0]
+        if new:
+            # the pattern is already registered, so that keys created during
+            # the scan are added by update()
+            found = [key for key in scan() if pattern in key]
+            with self._lock:
+                entry[0].update(found)
+        with self._lock:
+            keys = list(entry[0])
+            generation = entry[1]
+        response, validuntil = build(keys, ts)
+        with self._lock:
+            if self._patterns.get(pattern) is entry and \
+               entry[1] == generation:
+                self._responses[(pattern, ts)] = (response, validuntil)
+        return response
 
 
 class CacheDatabase(Device):
@@ -44,6 +185,64 @@ class CacheDatabase(Device):
         self._rewrites = {}
         # map new prefix -> incoming prefix
         self._inv_rewrites = {}
+        self._wildcard = WildcardIndex()
+        # time spent waiting for the locks of the database
+        self._lockwait = Histogram()
+
+    def ask_hist_downsampled(self, key, fromtime, totime, maxpoints):
+        """History query like `ask_hist`, but returning at most *maxpoints*
+        values.
+
+        The time range is divided into buckets, and for each bucket only the
+        minimum and maximum value are returned, so that peaks are preserved.
+        For buckets with non-numeric values, the first and last value are
+        returned.  The last value before the range is returned as well.
+        """
+        nbuckets = max(1, (maxpoints - 1) // 2)
+        width = float(totime - fromtime) / nbuckets or 1.
+        before = None
+        # bucket index -> [first, last, min, max, numeric]
+        buckets = {}
+        for chunk in self.ask_hist(key, fromtime, totime):
+            for line in chunk.splitlines():
+                time, rest = line.split('@', 1)
+                time = float(time)
+                if time < fromtime:
+                    if before is None or time >= before[0]:
+                        before = (time, line)
+                    continue
+                try:
+                    fvalue = float(rest.split(OP_TELL, 1)[1])
+                except ValueError:
+                    fvalue = None
+                point = (time, fvalue, line)
+                index = min(int((time - fromtime) / width), nbuckets - 1)
+                bucket = buckets.get(index)
+                if bucket is None:
+                    buckets[index] = [point, point, point, point,
+                                      fvalue is not None]
+                    continue
+                if time < bucket[0][0]:
+                    bucket[0] = point
+                if time >= bucket[1][0]:
+                    bucket[1] = point
+                if fvalue is None:
+                    bucket[4] = False
+                elif bucket[4]:
+                    if fvalue < bucket[2][1]:
+                        bucket[2] = point
+                    if fvalue > bucket[3][1]:
+                        bucket[3] = point
+        result = [before[1] + '\n'] if before else []
+        for index in sorted(buckets):
+            first, last, minimum, maximum, numeric = buckets[index]
+            points = set(numeric and (minimum, maximum) or (first, last))
+            result.extend(point[2] + '\n' for point in sorted(points))
+        return [''.join(result)]
+
+    def getStats(self):
+        """Return statistics of the database, published by the server."""
+        return {'lockwait': self._lockwait.snapshot()}
 
     def initDatabase(self):
         """Initialize the database from persistent store, if present."""
@@ -52,6 +251,7 @@ class CacheDatabase(Device):
     def clearDatabase(self):
         """Clear the database also from persistent store, if present."""
         self.log.info('clearing database')
+        self._wildcard.clear()
 
     def rewrite(self, key, value):
         """Rewrite handling."""
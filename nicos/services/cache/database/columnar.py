@@ -0,0 +1,394 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""Cache database with history in binary column files."""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+
+from nicos import config
+from nicos.core import Param
+from nicos.protocols.cache import FLAG_NO_STORE, OP_TELL
+from nicos.pycompat import from_utf8, to_utf8
+from nicos.services.cache.database.memory import MemoryCacheDatabase
+from nicos.services.cache.entry import CacheEntry
+from nicos.utils import ensureDirectory
+
+# base values of the code column
+CODE_FLOAT = 0      # value is in the value column
+CODE_DELETED = 1    # key was deleted or expired
+CODE_STRING = 2     # codes from here on index the string dictionary
+# flag in the code column: value was set with a TTL
+CODE_TTL = 0x80000000
+
+COLUMNS = [('value', '<f8'), ('code', '<u4'), ('time', '<f8')]
+
+
+class ColumnStore(object):
+    """Append-only binary column storage of cache key history.
+
+    Each key gets a directory ``category/subkey`` (with slashes in the
+    category replaced by dashes) containing three column files of equal
+    length:
+
+    * ``time``: float64 timestamps
+    * ``value``: float64 values, for values that are floats
+    * ``code``: uint32 codes, either `CODE_FLOAT`, `CODE_DELETED` or
+      `CODE_STRING` plus the index of the value in the string dictionary;
+      `CODE_TTL` is or-ed in if the value had a time-to-live
+
+    The string dictionary ``strings`` contains one (PyON) value per line.
+
+    Columns are read with memory maps; the time column is searched with
+    `numpy.searchsorted`, so timestamps per key are expected to be
+    increasing.
+    """
+
+    def __init__(self, basepath, maxopen=256):
+        self.basepath = basepath
+        self._lock = threading.RLock()
+        # open column files per key, least recently used first
+        self._files = OrderedDict()
+        self._maxopen = maxopen
+        # string dictionaries per key: (list of strings, string -> index)
+        self._strings = {}
+
+    def _keypath(self, key):
+        try:
+            category, subkey = key.rsplit('/', 1)
+        except ValueError:
+            category, subkey = 'nocat', key
+        return path.join(self.basepath, category.replace('/', '-'), subkey)
+
+    def keys(self):
+        """Yield all keys present in the store."""
+        for catdir in os.listdir(self.basepath):
+            if not path.isdir(path.join(self.basepath, catdir)):
+                continue
+            category = catdir.replace('-', '/')
+            for subkey in os.listdir(path.join(self.basepath, catdir)):
+                if path.isfile(path.join(self.basepath, catdir, subkey,
+                                         'time')):
+                    if category == 'nocat':
+                        yield subkey
+                    else:
+                        yield category + '/' + subkey
+
+    def _get_files(self, key):
+        files = self._files.pop(key, None)
+        if files is None:
+            keypath = self._keypath(key)
+            ensureDirectory(keypath)
+            files = [open(path.join(keypath, name), 'ab')
+                     for (name, _) in COLUMNS]
+            if len(self._files) >= self._maxopen:
+                for fd in self._files.popitem(last=False)[1]:
+                    fd.close()
+        self._files[key] = files
+        return files
+
+    def _get_strings(self, key):
+        if key not in self._strings:
+            strings = []
+            filename = path.join(self._keypath(key), 'strings')
+            if path.isfile(filename):
+                with open(filename, 'rb') as fd:
+                    strings = [from_utf8(line.rstrip(b'\n')) for line in fd]
+            self._strings[key] = (strings, dict((s, i) for (i, s)
+                                                in enumerate(strings)))
+        return self._strings[key]
+
+    def _encode(self, key, value):
+        if value is None:
+            return CODE_DELETED, 0.
+        try:
+            fvalue = float(value)
+        except ValueError:
+            pass
+        else:
+            # only store floats that can be reconstructed exactly
+            if repr(fvalue) == value:
+                return CODE_FLOAT, fvalue
+        strings, index = self._get_strings(key)
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(strings)
+            strings.append(value)
+            with open(path.join(self._keypath(key), 'strings'), 'ab') as fd:
+                fd.write(to_utf8(value) + b'\n')
+        return CODE_STRING + code, 0.
+
+    def _decode(self, key, code, value):
+        code &= ~CODE_TTL
+        if code == CODE_FLOAT:
+            return repr(float(value))
+        elif code == CODE_DELETED:
+            return None
+        return self._get_strings(key)[0][code - CODE_STRING]
+
+    def append(self, key, time, value, ttl):
+        """Append a new value (None for deletion) for the key."""
+        with self._lock:
+            valuefd, codefd, timefd = self._get_files(key)
+            code, fvalue = self._encode(key, value)
+            if ttl:
+                code |= CODE_TTL
+            # the time column is written last: readers only consider records
+            # present in all columns
+            valuefd.write(np.array([fvalue], '<f8').tobytes())
+            valuefd.flush()
+            codefd.write(np.array([code], '<u4').tobytes())
+            codefd.flush()
+            timefd.write(np.array([time], '<f8').tobytes())
+            timefd.flush()
+
+    def _read_columns(self, key):
+        keypath = self._keypath(key)
+        columns = []
+        for name, dtype in COLUMNS:
+            filename = path.join(keypath, name)
+            if not path.isfile(filename) or path.getsize(filename) == 0:
+                return None
+            columns.append(np.memmap(filename, dtype, mode='r'))
+        length = min(len(column) for column in columns)
+        if not length:
+            return None
+        return [column[:length] for column in columns]
+
+    def last(self, key):
+        """Return (time, value, had ttl) of the last record for the key."""
+        with self._lock:
+            columns = self._read_columns(key)
+            if columns is None:
+                return None
+            values, codes, times = columns
+            code = int(codes[-1])
+            return (float(times[-1]), self._decode(key, code, values[-1]),
+                    bool(code & CODE_TTL))
+
+    def query(self, key, fromtime, totime):
+        """Return a list of (time, value) for all records in the time range.
+
+        Like for the flatfile database, the last value before the range is
+        also returned.  Deleted or expired values are returned as ``''``.
+        """
+        with self._lock:
+            columns = self._read_columns(key)
+            if columns is None:
+                return []
+            values, codes, times = columns
+            start = int(np.searchsorted(times, fromtime, 'left'))
+            end = int(np.searchsorted(times, totime, 'right'))
+            indices = list(range(start, end))
+            # add the last non-deleted value before the range
+            for i in range(start - 1, -1, -1):
+                if codes[i] & ~CODE_TTL != CODE_DELETED:
+                    indices.insert(0, i)
+                    break
+            result = []
+            for i in indices:
+                value = self._decode(key, int(codes[i]), values[i])
+                result.append((float(times[i]),
+                               '' if value is None else value))
+            return result
+
+    def close(self):
+        with self._lock:
+            for files in self._files.values():
+                for fd in files:
+                    fd.close()
+            self._files.clear()
+
+
+def convertFlatfile(srcpath, store, log=None):
+    """Convert the history of a flatfile cache database store (in format v2)
+    into the given `ColumnStore`.
+
+    Returns the number of records converted.
+    """
+    lasttimes = {}
+    nrecords = 0
+    for year in sorted(os.listdir(srcpath)):
+        if not year.isdigit() or not path.isdir(path.join(srcpath, year)):
+            continue
+        for monthday in sorted(os.listdir(path.join(srcpath, year))):
+            daydir = path.join(srcpath, year, monthday)
+            if log:
+                log.info('converting %s/%s', year, monthday)
+            for fn in sorted(os.listdir(daydir)):
+                category = fn.replace('-', '/')
+                with open(path.join(daydir, fn), 'rb') as fd:
+                    if not fd.readline().startswith(
+                            b'# NICOS cache store file v2'):
+                        if log:
+                            log.warning('skipping %s/%s/%s with wrong format',
+                                        year, monthday, fn)
+                        continue
+                    for line in fd:
+                        try:
+                            subkey, time, hasttl, value = \
+                                from_utf8(line).rstrip().split(None, 3)
+                            time = float(time)
+                        except ValueError:
+                            continue
+                        key = category + '/' + subkey
+                        value = None if value == '-' else value
+                        # skip values repeated at the start of each day, and
+                        # values out of order
+                        last = lasttimes.get(key)
+                        if last is not None and (
+                                time < last[0] or
+                                (time == last[0] and value == last[1])):
+                            continue
+                        lasttimes[key] = (time, value)
+                        store.append(key, time, value, hasttl == '-')
+                        nrecords += 1
+    return nrecords
+
+
+class ColumnarCacheDatabase(MemoryCacheDatabase):
+    """Cache database that keeps the current values in memory and the history
+    in binary column files.
+
+    See `ColumnStore` for the format.  Compared to the flatfile database,
+    history queries do not need to parse text, and take time mostly
+    proportional to the number of returned values.
+
+    An existing flatfile store can be converted with the
+    ``tools/cache-convert-columnar`` script.
+    """
+
+    parameters = {
+        'storepath': Param('Directory where the column files are stored',
+                           type=str, mandatory=True),
+    }
+
+    def doInit(self, mode):
+        MemoryCacheDatabase.doInit(self, mode)
+        self._store = ColumnStore(path.join(config.nicos_root,
+                                            self.storepath))
+
+    def doShutdown(self):
+        self._store.close()
+
+    def initDatabase(self):
+        ensureDirectory(self._store.basepath)
+        nkeys = 0
+        with self._db_lock:
+            for key in self._store.keys():
+                try:
+                    last = self._store.last(key)
+                except Exception:
+                    self.log.warning('could not read columns for %s', key,
+                                     exc=1)
+                    continue
+                if last is None or last[1] is None:
+                    continue
+                time, value, hadttl = last
+                entry = CacheEntry(time, None, value)
+                # like in the flatfile database, values with a TTL are
+                # considered expired after a restart
+                entry.expired = hadttl
+                dbkey = key if '/' in key else 'nocat/' + key
+                self._db[dbkey] = [entry]
+                nkeys += 1
+        self.log.info('loaded %d keys from %s', nkeys, self._store.basepath)
+
+    def clearDatabase(self):
+        MemoryCacheDatabase.clearDatabase(self)
+        self._store.close()
+        basepath = self._store.basepath
+        if path.isdir(basepath):
+            for fn in os.listdir(basepath):
+                if fn != '.keep':
+                    shutil.rmtree(path.join(basepath, fn), ignore_errors=True)
+
+    def ask(self, key, ts, time, ttl):
+        dbkey = key if '/' in key else 'nocat/' + key
+        with self._db_lock:
+            entries = self._db.get(dbkey)
+        if entries and entries[-1].expired and entries[-1].value:
+            entry = entries[-1]
+            if ts:
+                return ['%r@%s!%s\n' % (entry.time, key, entry.value)]
+            return [key + '!' + entry.value + '\n']
+        return MemoryCacheDatabase.ask(self, key, ts, time, ttl)
+
+    def ask_hist(self, key, fromtime, totime):
+        if fromtime > totime:
+            return
+        try:
+            values = self._store.query(key, fromtime, totime)
+        except Exception:
+            self.log.exception('error reading store for history query')
+            return
+        for i in range(0, len(values), 100):
+            yield ''.join('%r@%s=%s\n' % (time, key, value)
+                          for (time, value) in values[i:i + 100])
+
+    def tell(self, key, value, time, ttl, from_client):
+        if value is None:
+            # deletes cannot have a TTL
+            ttl = None
+        store = True
+        if key.endswith(FLAG_NO_STORE):
+            key = key[:-len(FLAG_NO_STORE)]
+            store = False
+        try:
+            category, subkey = key.rsplit('/', 1)
+        except ValueError:
+            category = 'nocat'
+            subkey = key
+        newcats = [category]
+        if category in self._rewrites:
+            newcats.extend(self._rewrites[category])
+        for newcat in newcats:
+            key = newcat + '/' + subkey
+            with self._db_lock:
+                entries = self._db.setdefault(key, [])
+                update = True
+                if entries:
+                    lastent = entries[-1]
+                    if lastent.value == value and not lastent.ttl and \
+                       not lastent.expired:
+                        # not a real update
+                        update = False
+                entries[:] = [CacheEntry(time, ttl, value)]
+                if update and store:
+                    try:
+                        self._store.append(key, time, value, ttl)
+                    except Exception:
+                        self.log.exception('could not store value for %s',
+                                           key)
+            self._wildcard.update(key)
+            if update or not store:
+                self._server.update(key, OP_TELL, value or '', time, ttl,
+                                    from_client)
@@ -25,6 +25,7 @@
 
 from __future__ import absolute_import, division, print_function
 
+import gzip
 import os
 import shutil
 import threading
@@ -32,13 +33,168 @@ from os import path
 from time import localtime, mktime, sleep, time as currenttime
 
 from nicos import config
-from nicos.core import Param, oneof
+from nicos.core import ConfigurationError, Param, floatrange, intrange, \
+    oneof
 from nicos.protocols.cache import FLAG_NO_STORE, OP_TELL, OP_TELLOLD
-from nicos.pycompat import iteritems, listitems
-from nicos.services.cache.database.base import CacheDatabase
+from nicos.pycompat import cPickle as pickle, from_utf8, iteritems, \
+    listitems
+from nicos.services.cache.database.base import CacheDatabase, ExpiryQueue
 from nicos.services.cache.entry import CacheEntry
+from nicos.services.cache.stats import Histogram, TimedLock
 from nicos.utils import allDays, createThread, ensureDirectory
 
+# name of the subdirectory (below the store path) with history index files
+INDEX_DIR = '.index'
+# time span covered by one bucket of the history index, in seconds
+INDEX_BUCKET = 600
+# name of the snapshot file (below the store path) and its format version
+SNAPSHOT_FILE = '.snapshot'
+SNAPSHOT_VERSION = 1
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# compression methods for store files of finished days: suffix and opener
+COMPRESSIONS = {
+    'gzip': ('.gz', gzip.open),
+    'xz': ('.xz', lzma and lzma.open),
+}
+
+
+def openStoreFile(filename):
+    """Open a store file for reading in binary mode.
+
+    If the file has been compressed, the compressed file is opened with
+    streaming decompression instead.  Returns None if the file doesn't exist.
+    """
+    try:
+        return open(filename, 'rb')
+    except (IOError, OSError):
+        pass
+    for suffix, opener in COMPRESSIONS.values():
+        if opener and path.isfile(filename + suffix):
+            try:
+                return opener(filename + suffix, 'rb')
+            except (IOError, OSError):
+                pass
+    return None
+
+
+class HistoryIndex(object):
+    """Sidecar index of a flatfile store file.
+
+    For each subkey and time bucket (of `INDEX_BUCKET` seconds), the byte
+    offset of the first line for this subkey and bucket is recorded.  The
+    index file consists of lines of the form ``subkey<TAB>bucket<TAB>offset``.
+
+    History queries then only need to read the part of the store file that
+    can contain the requested time range.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # maps subkey -> list of (bucket, offset) in order of appearance
+        self.subkeys = {}
+        # list of (bucket, offset of the first line in the bucket)
+        self.buckets = []
+        self._seen = set()
+        self._seen_buckets = set()
+        self._fd = None
+
+    def _add(self, subkey, bucket, offset):
+        self._seen.add((subkey, bucket))
+        self.subkeys.setdefault(subkey, []).append((bucket, offset))
+        if bucket not in self._seen_buckets:
+            self._seen_buckets.add(bucket)
+            self.buckets.append((bucket, offset))
+
+    @classmethod
+    def load(cls, filename):
+        index = cls(filename)
+        with open(filename) as fd:
+            for line in fd:
+                try:
+                    subkey, bucket, offset = line.split('\t')
+                    index._add(subkey, int(bucket), int(offset))
+                except ValueError:
+                    # incompletely written line
+                    continue
+        return index
+
+    @classmethod
+    def build(cls, storefile, filename):
+        """Create the index file for an existing store file."""
+        index = cls(filename)
+        offset = 0
+        fd = openStoreFile(storefile)
+        if fd is None:
+            raise IOError('store file %s does not exist' % storefile)
+        with fd:
+            for line in fd:
+                if not line.startswith(b'#'):
+                    try:
+                        subkey, time = from_utf8(line).split(None, 2)[:2]
+                        bucket = int(float(time) // INDEX_BUCKET)
+                    except ValueError:
+                        pass
+                    else:
+                        if (subkey, bucket) not in index._seen:
+                            index._add(subkey, bucket, offset)
+                offset += len(line)
+        ensureDirectory(path.dirname(filename))
+        with open(filename, 'w') as fd:
+            for subkey, entries in iteritems(index.subkeys):
+                for bucket, offset in entries:
+                    fd.write('%s\t%d\t%d\n' % (subkey, bucket, offset))
+        return index
+
+    def update(self, subkey, time, fd):
+        """Record the line for *subkey* and *time* that is about to be written
+        to the store file *fd*.
+        """
+        bucket = int(time // INDEX_BUCKET)
+        if (subkey, bucket) in self._seen:
+            return
+        offset = fd.tell()
+        self._add(subkey, bucket, offset)
+        if self._fd is None:
+            ensureDirectory(path.dirname(self.filename))
+            self._fd = open(self.filename, 'a')
+        self._fd.write('%s\t%d\t%d\n' % (subkey, bucket, offset))
+        self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def byterange(self, subkey, fromtime, totime):
+        """Return (start, end) byte offsets of the store file region that
+        contains all lines for *subkey* between *fromtime* and *totime*, and
+        the last line before *fromtime*.
+
+        *end* is None if the region extends to the end of the file.  If the
+        subkey does not occur in the file at all, None is returned.
+        """
+        entries = list(self.subkeys.get(subkey, ()))
+        if not entries:
+            return None
+        frombucket = int(fromtime // INDEX_BUCKET)
+        # allow one bucket of slack for values arriving out of order
+        tobucket = int(totime // INDEX_BUCKET) + 1
+        # start at the last line before the range, but also make sure that
+        # lines in range that were written out of order are included
+        before = [offset for (bucket, offset) in entries
+                  if bucket < frombucket]
+        inrange = [offset for (bucket, offset) in entries
+                   if bucket >= frombucket]
+        start = min(([max(before)] if before else []) + inrange)
+        after = [offset for (bucket, offset) in list(self.buckets)
+                 if bucket > tobucket and offset > start]
+        return start, (min(after) if after else None)
+
 
 class FlatfileCacheDatabase(CacheDatabase):
     """Cache database which writes historical values to disk in a flatfile
@@ -73,6 +229,11 @@ class FlatfileCacheDatabase(CacheDatabase):
     cache server, rather by the NICOS clients.  The value can also a single
     dash, this indicates that at the given timestamp the latest value for this
     key expired.
+
+    With *writebehind* set, updates are queued and written by a separate
+    thread in batches, at the latest after *flushinterval*.  On a crash of the
+    cache, queued lines not yet written are lost.  What happens to written
+    lines on a crash of the host is selected by *durability*.
     """
 
     parameters = {
@@ -82,12 +243,43 @@ class FlatfileCacheDatabase(CacheDatabase):
                            'store hierarchy (auto meaning none on Windows, '
                            'hard else)', default='auto',
                            type=oneof('auto', 'hard', 'soft', 'none')),
+        'writebehind': Param('Write store files from a separate thread '
+                             'instead of the client receiver threads',
+                             type=bool, default=False),
+        'durability': Param('Guarantee for each write of store lines: '
+                            '"flush" hands them to the OS (they survive a '
+                            'cache crash), "fsync" also syncs them to disk '
+                            '(they survive a host crash)',
+                            type=oneof('flush', 'fsync'), default='flush'),
+        'flushinterval': Param('Maximum delay of writing store lines in '
+                               'write-behind mode', type=floatrange(0.01, 60),
+                               default=1, unit='s'),
+        'flushsize': Param('Number of queued store lines that triggers '
+                           'writing in write-behind mode',
+                           type=intrange(1, 1000000), default=1000),
+        'queuesize': Param('Maximum number of queued store lines in '
+                           'write-behind mode; if full, clients must wait',
+                           type=intrange(1, 10000000), default=100000),
+        'compression': Param('Compression of the store files of finished '
+                             'days, done in the background after rollover',
+                             type=oneof('none', 'gzip', 'xz'),
+                             default='none'),
+        'snapshotinterval': Param('Interval for writing a snapshot of the '
+                                  'current values, for fast startup '
+                                  '(0 to disable)', type=floatrange(0),
+                                  default=300, unit='s'),
     }
 
     def doInit(self, mode):
-        self._cat = {}
-        self._cat_lock = threading.Lock()
         CacheDatabase.doInit(self, mode)
+        self._cat = {}
+        self._cat_lock = TimedLock(self._lockwait)
+        # history indexes of the store files of the current day, by file name
+        self._indexes = {}
+        # cache of history indexes for files of previous days
+        self._index_cache = {}
+        # time needed to write (and sync) store file lines
+        self._writelatency = Histogram()
 
         if self.makelinks == 'auto':
             # Windows compatibility: it does not provide os.link
@@ -110,11 +302,45 @@ class FlatfileCacheDatabase(CacheDatabase):
         self._nextmidnight = self._midnight + 86400
 
         self._stoprequest = False
+        self._expiry = ExpiryQueue()
+        # write-behind queue of (category, subkey, time, line)
+        self._wb_queue = []
+        self._wb_cond = threading.Condition()
+        self._wb_full = False
+        # held while writing to store files in write-behind mode
+        self._write_lock = threading.RLock()
+        self._wb_stats = {'queued': 0, 'maxqueued': 0, 'written': 0,
+                          'commits': 0, 'lastcommit': 0., 'maxcommit': 0.}
+        self._compressor = None
+        if self.compression == 'xz' and lzma is None:
+            raise ConfigurationError(self, 'xz compression needs the lzma '
+                                     'module')
+        self._writer = None
+        if self.writebehind:
+            self._writer = createThread('writer', self._write_behind)
         self._cleaner = createThread('cleaner', self._clean)
+        self._snapshotter = None
+        if self.snapshotinterval:
+            self._snapshotter = createThread('snapshot', self._snapshot_loop)
 
     def doShutdown(self):
         self._stoprequest = True
+        self._expiry.stop()
+        with self._wb_cond:
+            self._wb_cond.notify_all()
         self._cleaner.join()
+        if self._writer:
+            self._writer.join()
+        if self._compressor:
+            self._compressor.join()
+        if self._snapshotter:
+            self._snapshotter.join()
+            # all store lines are written now, so the snapshot needs no
+            # journal replay on the next startup
+            try:
+                self._write_snapshot()
+            except Exception:
+                self.log.warning('could not write snapshot', exc=1)
 
     def _read_one_storefile(self, filename):
         with open(filename, 'r+') as fd:
@@ -125,8 +351,9 @@ class FlatfileCacheDatabase(CacheDatabase):
         self.log.warning('ignoring store file %s with wrong format', filename)
         return {}
 
-    def _read_one_storefile_v2(self, filename, fd):
-        db = {}
+    def _read_one_storefile_v2(self, filename, fd, db=None):
+        if db is None:
+            db = {}
         for line in fd:
             if '\x00' in line:
                 self.log.warning('found nullbyte in store file %s', filename)
@@ -169,19 +396,137 @@ class FlatfileCacheDatabase(CacheDatabase):
                           'to %s/%s', self._year, self._currday)
             self._set_lastday()
             return
+        started = currenttime()
         with self._cat_lock:
+            source = 'snapshot and files'
+            snapshot = self._load_snapshot(curdir)
+            if snapshot is None:
+                source = 'files'
+                snapshot = {}
             for fn in os.listdir(curdir):
                 cat = fn.replace('-', '/')
                 try:
-                    db = self._read_one_storefile(path.join(curdir, fn))
-                    lock = threading.Lock()
+                    if fn in snapshot:
+                        cat, db = snapshot[fn]
+                    else:
+                        db = self._read_one_storefile(path.join(curdir, fn))
+                    lock = TimedLock(self._lockwait)
                     self._cat[cat] = [None, lock, db]
                     nkeys += len(db)
                 except Exception:
                     self.log.warning('could not read cache file %s', fn, exc=1)
+            # values restored from a snapshot can still have a TTL
+            for cat, (_, _, db) in iteritems(self._cat):
+                for subkey, entry in iteritems(db):
+                    if entry.value and not entry.expired:
+                        self._expiry.schedule((cat, subkey), entry)
             if do_rollover:
                 self._rollover()
-        self.log.info('loaded %d keys from files in %s', nkeys, curdir)
+        self.log.info('loaded %d keys from %s in %s (%.2f s)', nkeys, source,
+                      curdir, currenttime() - started)
+        self._start_compression()
+
+    def _load_snapshot(self, curdir):
+        """Load the snapshot of current values, if it is for the store files in
+        *curdir*, and replay the lines written to the store files after it was
+        taken.
+
+        Returns a dictionary mapping store file names to (category, entries),
+        or None if the snapshot is missing or stale.
+        """
+        snapname = path.join(self._basepath, SNAPSHOT_FILE)
+        if not path.isfile(snapname):
+            return None
+        try:
+            with open(snapname, 'rb') as fd:
+                snapshot = pickle.load(fd)
+            if snapshot['version'] != SNAPSHOT_VERSION:
+                self.log.info('ignoring snapshot with old format')
+                return None
+            if path.realpath(path.join(self._basepath, snapshot['day'])) != \
+               path.realpath(curdir):
+                self.log.info('ignoring stale snapshot from %s',
+                              snapshot['day'])
+                return None
+            result = {}
+            for category, (size, entries) in iteritems(snapshot['cats']):
+                fn = category.replace('/', '-')
+                filename = path.join(curdir, fn)
+                if not path.isfile(filename) or path.getsize(filename) < size:
+                    self.log.info('ignoring snapshot, store file %s has '
+                                  'changed', fn)
+                    return None
+                db = {}
+                for subkey, (time, ttl, value, expired) in iteritems(entries):
+                    db[subkey] = CacheEntry(time, ttl, value)
+                    db[subkey].expired = expired
+                self._replay_journal(filename, size, db)
+                result[fn] = (category, db)
+            return result
+        except Exception:
+            self.log.warning('could not load snapshot', exc=1)
+            return None
+
+    def _replay_journal(self, filename, offset, db):
+        """Apply all lines of a store file after *offset* to *db*."""
+        with open(filename, 'rb') as fd:
+            if offset:
+                # skip a line that was partially written when the snapshot
+                # was taken, its value is already in the snapshot
+                fd.seek(offset - 1)
+                if fd.read(1) != b'\n':
+                    fd.readline()
+            self._read_one_storefile_v2(filename,
+                                        (from_utf8(line) for line in fd), db)
+
+    def _write_snapshot(self):
+        """Write a snapshot of the current values, together with the sizes
+        of the store files they correspond to, and atomically replace the
+        previous one.
+        """
+        started = currenttime()
+        with self._cat_lock:
+            day = path.join(self._year, self._currday)
+            categories = listitems(self._cat)
+        cats = {}
+        for category, (_, lock, db) in categories:
+            filename = path.join(self._basepath, day,
+                                 category.replace('/', '-'))
+            with lock:
+                # values of categories without store file are not persistent
+                if not path.isfile(filename):
+                    continue
+                cats[category] = (path.getsize(filename), dict(
+                    (subkey, (entry.time, entry.ttl, entry.value,
+                              entry.expired))
+                    for (subkey, entry) in iteritems(db)))
+        if path.join(self._year, self._currday) != day:
+            # rollover happened in between
+            return
+        snapname = path.join(self._basepath, SNAPSHOT_FILE)
+        with open(snapname + '.tmp', 'wb') as fd:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'day': day,
+                         'cats': cats}, fd, 2)
+            fd.flush()
+            os.fsync(fd.fileno())
+        if hasattr(os, 'replace'):
+            os.replace(snapname + '.tmp', snapname)
+        else:
+            os.rename(snapname + '.tmp', snapname)
+        self.log.debug('wrote snapshot of %d categories in %.3f s', len(cats),
+                       currenttime() - started)
+
+    def _snapshot_loop(self):
+        lastsnapshot = currenttime()
+        while not self._stoprequest:
+            sleep(self._long_loop_delay)
+            if currenttime() - lastsnapshot < self.snapshotinterval:
+                continue
+            lastsnapshot = currenttime()
+            try:
+                self._write_snapshot()
+            except Exception:
+                self.log.warning('could not write snapshot', exc=1)
 
     def clearDatabase(self):
         self.log.info('clearing database from %s', self._basepath)
@@ -206,6 +551,12 @@ class FlatfileCacheDatabase(CacheDatabase):
         self._currday = '%02d-%02d' % ltime[1:3]
         self._midnight = mktime(ltime[:3] + (0,) * (8-3) + (ltime[8],))
         self._nextmidnight = self._midnight + 86400
+        with self._write_lock:
+            # queued lines belong into the files of the previous day
+            self._write_queued()
+            self._roll_fds()
+
+    def _roll_fds(self):
         # roll over all file descriptors
         for category, (fd, _, db) in iteritems(self._cat):
             if fd:
@@ -214,16 +565,79 @@ class FlatfileCacheDatabase(CacheDatabase):
             fd = self._create_fd(category)
             for subkey, entry in iteritems(db):
                 if entry.value:
-                    fd.write('%s\t%s\t%s\t%s\n' % (
-                        subkey, entry.time,
-                        (entry.ttl or entry.expired) and '-' or '+',
-                        entry.value))
+                    self._write_line(category, fd, subkey, entry.time,
+                                     '%s\t%s\t%s\t%s\n' % (
+                                         subkey, entry.time,
+                                         (entry.ttl or entry.expired) and '-'
+                                         or '+', entry.value), flush=False)
+            self._sync(fd)
             # don't keep fds open for *all* files with keys, rather reopen
             # those that are necessary when new updates come in
             fd.close()
+            self._indexes.pop(category.replace('/', '-')).close()
         # set the 'lastday' symlink to the current day directory
         self._set_lastday()
-        # old files could be compressed here, but it is probably not worth it
+        self._start_compression()
+
+    def _start_compression(self):
+        if self.compression == 'none':
+            return
+        if self._compressor and self._compressor.is_alive():
+            return
+        self._compressor = createThread('compressor', self._compress_old)
+
+    def _compress_old(self):
+        """Compress the store files of all days before the current one."""
+        suffix, opener = COMPRESSIONS[self.compression]
+        allsuffixes = tuple(s for (s, _) in COMPRESSIONS.values())
+        for year in sorted(os.listdir(self._basepath)):
+            yeardir = path.join(self._basepath, year)
+            if not year.isdigit() or not path.isdir(yeardir):
+                continue
+            for monthday in sorted(os.listdir(yeardir)):
+                if (year, monthday) == (self._year, self._currday):
+                    continue
+                daydir = path.join(yeardir, monthday)
+                if not path.isdir(daydir):
+                    continue
+                for category in sorted(os.listdir(daydir)):
+                    if category.endswith(allsuffixes) or \
+                       category.endswith('.tmp'):
+                        continue
+                    if self._stoprequest:
+                        return
+                    try:
+                        self._compress_file(year, monthday, category, suffix,
+                                            opener)
+                    except Exception:
+                        self.log.warning('could not compress store file '
+                                         '%s/%s/%s', year, monthday, category,
+                                         exc=1)
+
+    def _compress_file(self, year, monthday, category, suffix, opener):
+        filename = path.join(self._basepath, year, monthday, category)
+        # the index refers to offsets in the uncompressed data, so it must be
+        # created before compressing to avoid decompressing again later
+        indexname = path.join(self._basepath, INDEX_DIR, year, monthday,
+                              category)
+        if not path.isfile(indexname):
+            HistoryIndex.build(filename, indexname)
+        tmpname = filename + suffix + '.tmp'
+        with open(filename, 'rb') as src:
+            dst = opener(tmpname, 'wb')
+            try:
+                shutil.copyfileobj(src, dst)
+            finally:
+                dst.close()
+        os.rename(tmpname, filename + suffix)
+        # replace the link in the by-category hierarchy
+        linkname = path.join(self._basepath, category, year, monthday)
+        if path.lexists(linkname):
+            os.unlink(linkname)
+        if path.isdir(path.dirname(linkname)):
+            self._make_link(filename + suffix, linkname + suffix)
+        os.unlink(filename)
+        self.log.debug('compressed store file %s', filename)
 
     def _set_lastday(self):
         if not hasattr(os, 'symlink'):
@@ -239,6 +653,8 @@ class FlatfileCacheDatabase(CacheDatabase):
     def _create_fd(self, category):
         """Open the by-date output file for the current day for a given
         category, and create the by-category hard link if necessary.
+
+        Also opens the history index for the file.
         """
         category = category.replace('/', '-')
         bydate = path.join(self._basepath, self._year, self._currday)
@@ -249,6 +665,9 @@ class FlatfileCacheDatabase(CacheDatabase):
         # write version identification, but only for empty files
         if fd.tell() == 0:
             fd.write('# NICOS cache store file v2\n')
+            fd.flush()
+        self._indexes[category] = self._get_index(self._year, self._currday,
+                                                  category, cache=False)
         bycat = path.join(self._basepath, category, self._year)
         ensureDirectory(bycat)
         linkname = path.join(bycat, self._currday)
@@ -259,6 +678,144 @@ class FlatfileCacheDatabase(CacheDatabase):
                 self.log.exception('linking %s -> %s', linkname, filename)
         return fd
 
+    def _get_fd(self, category):
+        fd = self._cat[category][0]
+        if fd is None:
+            fd = self._cat[category][0] = self._create_fd(category)
+        return fd
+
+    def _sync(self, fd):
+        fd.flush()
+        if self.durability == 'fsync':
+            os.fsync(fd.fileno())
+
+    def _store(self, category, subkey, time, line):
+        """Store a line in the store file of a category.
+
+        In write-behind mode, the line is only queued for the writer thread.
+        Must be called with the category lock held.
+        """
+        if not self.writebehind:
+            started = currenttime()
+            fd = self._get_fd(category)
+            self._write_line(category, fd, subkey, time, line, flush=False)
+            self._sync(fd)
+            self._writelatency.add(currenttime() - started)
+            return
+        with self._wb_cond:
+            while len(self._wb_queue) >= self.queuesize and \
+                  not self._stoprequest:
+                if not self._wb_full:
+                    self.log.warning('write-behind queue is full, store '
+                                     'files are written too slowly')
+                    self._wb_full = True
+                self._wb_cond.wait(1)
+            self._wb_queue.append((category, subkey, time, line))
+            queued = len(self._wb_queue)
+            if queued > self._wb_stats['maxqueued']:
+                self._wb_stats['maxqueued'] = queued
+            if queued == self.flushsize:
+                self._wb_cond.notify_all()
+
+    def _write_behind(self):
+        """Writer thread for write-behind mode."""
+        while True:
+            with self._wb_cond:
+                deadline = currenttime() + self.flushinterval
+                while len(self._wb_queue) < self.flushsize and \
+                      not self._stoprequest:
+                    remaining = deadline - currenttime()
+                    if remaining <= 0:
+                        break
+                    self._wb_cond.wait(remaining)
+                stopping = self._stoprequest
+            try:
+                with self._write_lock:
+                    self._write_queued()
+            except Exception:
+                self.log.exception('error writing store files')
+            if stopping:
+                break
+
+    def _write_queued(self):
+        """Write all queued lines and sync the files.
+
+        Must be called with self._write_lock held.
+        """
+        with self._wb_cond:
+            batch = self._wb_queue
+            self._wb_queue = []
+            self._wb_full = False
+            self._wb_cond.notify_all()
+        if not batch:
+            return
+        started = currenttime()
+        fds = {}
+        for category, subkey, time, line in batch:
+            fd = fds.get(category)
+            if fd is None:
+                fd = fds[category] = self._get_fd(category)
+            self._write_line(category, fd, subkey, time, line, flush=False)
+        for fd in fds.values():
+            self._sync(fd)
+        duration = currenttime() - started
+        self._writelatency.add(duration)
+        stats = self._wb_stats
+        stats['written'] += len(batch)
+        stats['commits'] += 1
+        stats['lastcommit'] = duration
+        if duration > stats['maxcommit']:
+            stats['maxcommit'] = duration
+        if duration > self.flushinterval:
+            self.log.warning('writing %d store lines took %.3f s',
+                             len(batch), duration)
+
+    def getStats(self):
+        stats = CacheDatabase.getStats(self)
+        stats['writelatency'] = self._writelatency.snapshot()
+        if self.writebehind:
+            stats['writebehind'] = self.getWriteStats()
+        return stats
+
+    def getWriteStats(self):
+        """Return counters of the write-behind queue: current and maximum
+        number of queued lines, number of written lines and commits, and the
+        duration of the last and the slowest commit.
+        """
+        with self._wb_cond:
+            stats = dict(self._wb_stats)
+            stats['queued'] = len(self._wb_queue)
+        return stats
+
+    def _write_line(self, category, fd, subkey, time, line, flush=True):
+        """Write a line to the store file of a category, and update its history
+        index.
+        """
+        self._indexes[category.replace('/', '-')].update(subkey, time, fd)
+        fd.write(line)
+        if flush:
+            fd.flush()
+
+    def _get_index(self, year, monthday, category, cache=True):
+        """Return the history index for the given store file, creating it if
+        it doesn't exist yet.
+        """
+        filename = path.join(self._basepath, year, monthday, category)
+        if cache and filename in self._index_cache:
+            return self._index_cache[filename]
+        indexname = path.join(self._basepath, INDEX_DIR, year, monthday,
+                              category)
+        if path.isfile(indexname):
+            index = HistoryIndex.load(indexname)
+        else:
+            self.log.debug('creating history index for %s', filename)
+            index = HistoryIndex.build(filename, indexname)
+        if cache:
+            if len(self._index_cache) > 1000:
+                self._index_cache.clear()
+            self._index_cache[filename] = index
+        return index
+
     def ask(self, key, ts, time, ttl):
         try:
             category, subkey = key.rsplit('/', 1)
@@ -290,45 +847,72 @@ class FlatfileCacheDatabase(CacheDatabase):
             return [key + op + entry.value + '\n']
 
     def ask_wc(self, key, ts, time, ttl):
-        ret = set()
-        # look for matching keys
+        return self._wildcard.query(key, ts, self._all_keys,
+                                    self._wildcard_response)
+
+    def _all_keys(self):
+        keys = []
         for cat, (_, lock, db) in listitems(self._cat):
             prefix = cat + '/' if cat != 'nocat' else ''
             with lock:
-                for subkey, entry in iteritems(db):
-                    if key not in prefix+subkey:
-                        continue
-                    # check for removed keys
-                    if entry.value is None:
-                        continue
-                    # check for expired keys
-                    op = entry.expired and OP_TELLOLD or OP_TELL
-                    if entry.ttl:
-                        if ts:
-                            ret.add('%r+%s@%s%s%s\n' %
-                                    (entry.time, entry.ttl, prefix+subkey,
-                                     op, entry.value))
-                        else:
-                            ret.add(prefix+subkey + op + entry.value + '\n')
-                    elif ts:
-                        ret.add('%r@%s%s%s\n' % (entry.time, prefix+subkey,
-                                                 op, entry.value))
-                    else:
-                        ret.add(prefix+subkey + op + entry.value + '\n')
-        return [''.join(ret)]
+                keys.extend(prefix + subkey for subkey in db)
+        return keys
+
+    def _wildcard_response(self, keys, ts):
+        ret = []
+        for key in keys:
+            try:
+                cat, subkey = key.rsplit('/', 1)
+            except ValueError:
+                cat, subkey = 'nocat', key
+            with self._cat_lock:
+                if cat not in self._cat:
+                    continue
+                lock, db = self._cat[cat][1:]
+            with lock:
+                entry = db.get(subkey)
+            # check for removed keys
+            if entry is None or entry.value is None:
+                continue
+            # check for expired keys
+            op = entry.expired and OP_TELLOLD or OP_TELL
+            if entry.ttl:
+                if ts:
+                    ret.append('%r+%s@%s%s%s\n' % (entry.time, entry.ttl, key,
+                                                   op, entry.value))
+                else:
+                    ret.append(key + op + entry.value + '\n')
+            elif ts:
+                ret.append('%r@%s%s%s\n' % (entry.time, key, op, entry.value))
+            else:
+                ret.append(key + op + entry.value + '\n')
+        # expired entries are registered with the index by _expire()
+        return [''.join(ret)], float('inf')
 
-    def _read_one_histfile(self, year, monthday, category, subkey):
+    def _read_one_histfile(self, year, monthday, category, subkey,
+                           fromtime=None, totime=None):
         fn = path.join(self._basepath, year, monthday, category)
-        if not path.isfile(fn):
+        fd = openStoreFile(fn)
+        if fd is None:
             return
-        with open(fn, 'U') as fd:
+        with fd:
             firstline = fd.readline()
             nsplit = 2
-            if firstline.startswith('# NICOS cache store file v2'):
+            if firstline.startswith(b'# NICOS cache store file v2'):
                 nsplit = 3
+                if fromtime is not None:
+                    # only v2 files are indexed
+                    byterange = self._find_byterange(year, monthday, category,
+                                                     subkey, fromtime, totime)
+                    if byterange is None:
+                        return
+                    fd.seek(byterange[0])
+                    if byterange[1] is not None:
+                        fd = self._limit_lines(fd, byterange[1])
             else:
                 fd.seek(0, os.SEEK_SET)
             for line in fd:
+                line = from_utf8(line)
                 if '\x00' in line:
                     self.log.warning('found nullbyte in file %s', fn)
                     continue
@@ -340,6 +924,32 @@ class FlatfileCacheDatabase(CacheDatabase):
                         value = ''
                     yield (time, value)
 
+    def _find_byterange(self, year, monthday, category, subkey, fromtime,
+                        totime):
+        current = (year, monthday) == (self._year, self._currday)
+        index = None
+        if current:
+            # the index of a file being written is kept up to date in memory
+            index = self._indexes.get(category)
+        try:
+            if index is None:
+                index = self._get_index(year, monthday, category,
+                                        cache=not current)
+        except Exception:
+            self.log.warning('could not read history index for %s/%s/%s',
+                             year, monthday, category, exc=1)
+            return 0, None
+        return index.byterange(subkey, fromtime, totime)
+
+    def _limit_lines(self, fd, end):
+        """Yield lines from *fd* until the offset *end* is reached."""
+        pos = fd.tell()
+        for line in fd:
+            if pos >= end:
+                return
+            pos += len(line)
+            yield line
+
     def ask_hist(self, key, fromtime, totime):
         try:
             category, subkey = key.rsplit('/', 1)
@@ -359,8 +969,8 @@ class FlatfileCacheDatabase(CacheDatabase):
         inrange = False
         for year, monthday in days:
             try:
-                for time, value in self._read_one_histfile(year, monthday,
-                                                           category, subkey):
+                for time, value in self._read_one_histfile(
+                        year, monthday, category, subkey, fromtime, totime):
                     if fromtime <= time <= totime:
                         if not inrange and lastvalue:
                             temp.append(lastvalue)
@@ -380,28 +990,32 @@ class FlatfileCacheDatabase(CacheDatabase):
         yield ''.join(temp)
 
     def _clean(self):
-        def cleanonce():
-            with self._cat_lock:
-                for cat, (fd, lock, db) in iteritems(self._cat):
-                    with lock:
-                        for subkey, entry in iteritems(db):
-                            if not entry.value or entry.expired:
-                                continue
-                            time = currenttime()
-                            if entry.ttl and (entry.time + entry.ttl < time):
-                                entry.expired = True
-                                for client in self._server._connected.values():
-                                    client.update(cat + '/' + subkey,
-                                                  OP_TELLOLD, entry.value,
-                                                  time, None)
-                                if fd is None:
-                                    fd = self._create_fd(cat)
-                                    self._cat[cat][0] = fd
-                                fd.write('%s\t%s\t-\t-\n' % (subkey, time))
-                                fd.flush()
-        while not self._stoprequest:
-            sleep(self._long_loop_delay)
-            cleanonce()
+        self._expiry.run(self._expire)
+
+    def _expire(self, key, entry, time):
+        cat, subkey = key
+        with self._cat_lock:
+            lock, db = self._cat[cat][1:]
+        with lock:
+            if db.get(subkey) is not entry or not entry.value or \
+               entry.expired or not entry.ttl:
+                # entry was replaced or updated
+                return
+            if entry.time + entry.ttl > time:
+                # TTL was extended by an update with the same value
+                self._expiry.schedule(key, entry)
+                return
+            entry.expired = True
+            self._wildcard.update(cat + '/' + subkey if cat != 'nocat'
+                                  else subkey)
+            self._server.update(cat + '/' + subkey, OP_TELLOLD, entry.value,
+                                time, None)
+            try:
+                self._store(cat, subkey, time,
+                            '%s\t%s\t-\t-\n' % (subkey, time))
+            except Exception:
+                self.log.exception('could not store expiry of %s/%s', cat,
+                                   subkey)
 
     def tell(self, key, value, time, ttl, from_client):
         # self.log.debug('updating %s %s', key, value)
@@ -430,8 +1044,9 @@ class FlatfileCacheDatabase(CacheDatabase):
             with self._cat_lock:
                 if newcat not in self._cat:
                     # the first item, fd, is created on demand below
-                    self._cat[newcat] = [None, threading.Lock(), {}]
-                fd, lock, db = self._cat[newcat]
+                    self._cat[newcat] = [None, TimedLock(self._lockwait),
+                                         {}]
+                _, lock, db = self._cat[newcat]
             update = True
             with lock:
                 if subkey in db:
@@ -441,23 +1056,22 @@ class FlatfileCacheDatabase(CacheDatabase):
                         # but don't write an update to the history file
                         entry.time = time
                         entry.ttl = ttl
+                        self._expiry.schedule((newcat, subkey), entry)
                         update = not store_on_disk
                     elif value is None and entry.expired:
                         # do not delete old value, it is already expired
                         update = not store_on_disk
                 if update:
                     db[subkey] = CacheEntry(time, ttl, value)
+                    self._expiry.schedule((newcat, subkey), db[subkey])
                     if store_on_disk:
-                        if fd is None:
-                            fd = self._create_fd(newcat)
-                            self._cat[newcat][0] = fd
-                        fd.write('%s\t%s\t%s\t%s\n' % (
-                            subkey, time,
-                            ttl and '-' or (value and '+' or '-'),
-                            value or '-'))
-                        fd.flush()
+                        self._store(newcat, subkey, time,
+                                    '%s\t%s\t%s\t%s\n' % (
+                                        subkey, time,
+                                        ttl and '-' or (value and '+' or '-'),
+                                        value or '-'))
+                self._wildcard.update(newcat + '/' + subkey
+                                      if newcat != 'nocat' else subkey)
             if update and (not ttl or time + ttl > now):
-                key = newcat + '/' + subkey
-                for client in self._server._connected.values():
-                    if client is not from_client:
-                        client.update(key, OP_TELL, value or '', time, ttl)
+                self._server.update(newcat + '/' + subkey, OP_TELL,
+                                    value or '', time, ttl, from_client)
@@ -24,14 +24,15 @@
 
 from __future__ import absolute_import, division, print_function
 
-from time import sleep, time as currenttime
+from time import time as currenttime
 
 from kafka import KafkaConsumer, KafkaProducer, TopicPartition
 
 from nicos.core import Attach, Param, host, listof
 from nicos.core.errors import ConfigurationError
 from nicos.protocols.cache import FLAG_NO_STORE, OP_TELL, OP_TELLOLD
-from nicos.pycompat import iteritems, to_utf8
+from nicos.pycompat import to_utf8
+from nicos.services.cache.database.base import ExpiryQueue
 from nicos.services.cache.database.memory import MemoryCacheDatabase
 from nicos.services.cache.entry import CacheEntry
 from nicos.services.cache.entry.serializer import CacheEntrySerializer
@@ -113,6 +114,7 @@ class KafkaCacheDatabase(MemoryCacheDatabase):
 
         # Cleanup thread configuration
         self._stoprequest = False
+        self._expiry = ExpiryQueue()
         self._cleaner = createThread('cleaner', self._clean, start=False)
 
     def doShutdown(self):
@@ -121,6 +123,7 @@ class KafkaCacheDatabase(MemoryCacheDatabase):
 
         # Stop the cleaner thread
         self._stoprequest = True
+        self._expiry.stop()
         self._cleaner.join()
 
     def initDatabase(self):
@@ -140,6 +143,8 @@ class KafkaCacheDatabase(MemoryCacheDatabase):
                         #               msg.timestamp, msg.key, entry)
                         if entry.ttl and entry.time + entry.ttl < now:
                             entry.expired = True
+                        else:
+                            self._expiry.schedule(msg.key, entry)
 
                         self._db[msg.key] = [entry]
 
@@ -147,22 +152,18 @@ class KafkaCacheDatabase(MemoryCacheDatabase):
         self.log.info('Processed %i messages.', message_count)
 
     def _clean(self):
-        def cleanonce():
-            with self._db_lock:
-                for key, entries in iteritems(self._db):
-                    entry = entries[-1]
-                    if not entry.value or entry.expired:
-                        continue
-                    time = currenttime()
-                    if entry.ttl and (entry.time + entry.ttl < time):
-                        entry.expired = True
-                        for client in self._server._connected.values():
-                            client.update(key, OP_TELLOLD, entry.value, time,
-                                          None)
-
-        while not self._stoprequest:
-            sleep(self._long_loop_delay)
-            cleanonce()
+        self._expiry.run(self._expire)
+
+    def _expire(self, key, entry, time):
+        with self._db_lock:
+            entries = self._db.get(key)
+            if not entries or entries[-1] is not entry or not entry.value or \
+               entry.expired:
+                # entry was replaced
+                return
+            entry.expired = True
+        self._wildcard.update(key)
+        self._server.update(key, OP_TELLOLD, entry.value, time, None)
 
     def _update_topic(self, key, entry):
         # This method is responsible to communicate and update all the
@@ -215,12 +216,13 @@ class KafkaCacheDatabase(MemoryCacheDatabase):
                         send_update = False
                 thisent = CacheEntry(time, ttl, value)
                 entries[:] = [thisent]
+                self._expiry.schedule(key, thisent)
                 if send_update:
                     self._update_topic(key, thisent)
+            self._wildcard.update(key)
             if send_update or always_send_update:
-                for client in self._server._connected.values():
-                    if client is not from_client and client.is_active():
-                        client.update(key, OP_TELL, value or '', time, ttl)
+                self._server.update(key, OP_TELL, value or '', time, ttl,
+                                    from_client)
 
 
 class KafkaCacheDatabaseWithHistory(KafkaCacheDatabase):
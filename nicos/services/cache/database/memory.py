@@ -30,18 +30,18 @@ from time import time as currenttime
 
 from nicos.core import Param, intrange
 from nicos.protocols.cache import FLAG_NO_STORE, OP_TELL, OP_TELLOLD
-from nicos.pycompat import iteritems
 from nicos.services.cache.database.base import CacheDatabase
 from nicos.services.cache.entry import CacheEntry
+from nicos.services.cache.stats import TimedLock
 
 
 class MemoryCacheDatabase(CacheDatabase):
     """Cache database that keeps the current value for each key in memory."""
 
     def doInit(self, mode):
-        self._db = {}
-        self._db_lock = threading.Lock()
         CacheDatabase.doInit(self, mode)
+        self._db = {}
+        self._db_lock = TimedLock(self._lockwait)
 
     def ask(self, key, ts, time, ttl):
         dbkey = key if '/' in key else 'nocat/' + key
@@ -68,11 +68,21 @@ class MemoryCacheDatabase(CacheDatabase):
             return [key + OP_TELL + lastent.value + '\n']
 
     def ask_wc(self, key, ts, time, ttl):
-        ret = set()
+        return self._wildcard.query(key, ts, self._all_keys,
+                                    self._wildcard_response)
+
+    def _all_keys(self):
+        with self._db_lock:
+            return list(self._db)
+
+    def _wildcard_response(self, keys, ts):
+        ret = []
+        now = currenttime()
+        validuntil = float('inf')
         with self._db_lock:
-            # look for matching keys
-            for dbkey, entries in iteritems(self._db):
-                if key not in dbkey:
+            for dbkey in keys:
+                entries = self._db.get(dbkey)
+                if not entries:
                     continue
                 lastent = entries[-1]
                 # check for removed keys
@@ -82,19 +92,26 @@ class MemoryCacheDatabase(CacheDatabase):
                     dbkey = dbkey[6:]
                 # check for expired keys
                 if lastent.ttl:
-                    remaining = lastent.time + lastent.ttl - currenttime()
-                    op = remaining > 0 and OP_TELL or OP_TELLOLD
+                    expires = lastent.time + lastent.ttl
+                    if expires > now and not lastent.expired:
+                        op = OP_TELL
+                        validuntil = min(validuntil, expires)
+                    else:
+                        op = OP_TELLOLD
                     if ts:
-                        ret.add('%r+%s@%s%s%s\n' % (lastent.time, lastent.ttl,
-                                                    dbkey, op, lastent.value))
+                        ret.append('%r+%s@%s%s%s\n' % (lastent.time,
+                                                       lastent.ttl, dbkey,
+                                                       op, lastent.value))
                     else:
-                        ret.add(dbkey + op + lastent.value + '\n')
-                elif ts:
-                    ret.add('%r@%s%s%s\n' % (lastent.time, dbkey,
-                                             OP_TELL, lastent.value))
+                        ret.append(dbkey + op + lastent.value + '\n')
                 else:
-                    ret.add(dbkey + OP_TELL + lastent.value + '\n')
-        return ret
+                    op = lastent.expired and OP_TELLOLD or OP_TELL
+                    if ts:
+                        ret.append('%r@%s%s%s\n' % (lastent.time, dbkey,
+                                                    op, lastent.value))
+                    else:
+                        ret.append(dbkey + op + lastent.value + '\n')
+        return [''.join(ret)], validuntil
 
     def ask_hist(self, key, fromtime, totime):
         return []
@@ -128,10 +145,10 @@ class MemoryCacheDatabase(CacheDatabase):
                         send_update = False
                 # never cache more than a single entry, memory fills up too fast
                 entries[:] = [CacheEntry(time, ttl, value)]
+            self._wildcard.update(key)
             if send_update or always_send_update:
-                for client in self._server._connected.values():
-                    if client is not from_client and client.is_active():
-                        client.update(key, OP_TELL, value or '', time, ttl)
+                self._server.update(key, OP_TELL, value or '', time, ttl,
+                                    from_client)
 
 
 class MemoryCacheDatabaseWithHistory(MemoryCacheDatabase):
@@ -153,8 +170,11 @@ class MemoryCacheDatabaseWithHistory(MemoryCacheDatabase):
         # return the first value before the range too
         inrange = False
         try:
-            entries = self._db[key]
+            entries = self._db.get(key, ())
             for entry in entries:
+                if entry.time is None:
+                    # initial placeholder entry of the key
+                    continue
                 if fromtime <= entry.time <= totime:
                     ret.append('%r@%s=%s\n' % (entry.time, key, entry.value))
                     inrange = True
@@ -194,7 +214,7 @@ class MemoryCacheDatabaseWithHistory(MemoryCacheDatabase):
                     # not a real update
                     send_update = False
                 entries.append(CacheEntry(time, ttl, value))
+            self._wildcard.update(key)
             if send_update or always_send_update:
-                for client in self._server._connected.values():
-                    if client is not from_client and client.is_active():
-                        client.update(key, OP_TELL, value or '', time, ttl)
+                self._server.update(key, OP_TELL, value or '', time, ttl,
+                                    from_client)
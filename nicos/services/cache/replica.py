@@ -0,0 +1,166 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""Support for read-only replicas of the NICOS cache.
+
+A replica is a normal `CacheServer` whose ``primary`` attached device is a
+`CacheReplicaClient`.  It mirrors all values of the primary cache into its own
+database and serves read requests (asks, wildcard and history queries,
+subscriptions) from there.  Writes (tells, locks and rewrites) of its clients
+are forwarded to the primary.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from time import time as currenttime
+
+from nicos.core import Override
+from nicos.devices.cacheclient import BaseCacheClient
+from nicos.protocols.cache import END_MARKER, OP_LOCK, OP_REWRITE, OP_TELL, \
+    OP_TELLOLD, msg_pattern
+from nicos.pycompat import iteritems
+from nicos.services.cache.stats import STATS_PREFIX
+
+# TTL given to values that are already expired on the primary, so that they
+# are expired by the local database right away
+EXPIRED_TTL = 1e-6
+
+
+class CacheReplicaClient(BaseCacheClient):
+    """Connection of a replica cache server to its primary.
+
+    All values of the primary are mirrored into the database of the replica,
+    including the history if the database keeps one (e.g. the flatfile
+    database).  The history is only mirrored while the replica is running.
+    """
+
+    parameter_overrides = {
+        'prefix': Override(mandatory=False, default=''),
+    }
+
+    remote_callbacks = False
+    _db = None
+
+    def doInit(self, mode):
+        BaseCacheClient.doInit(self, mode)
+        # keys seen during the initial synchronization
+        self._synckeys = None
+        # rewrites forwarded to the primary, resent after reconnecting
+        self._forwarded_rewrites = {}
+
+    def follow(self, db):
+        """Start mirroring the primary into the database *db*."""
+        self._db = db
+        self._worker.start()
+
+    def _connect_action(self):
+        self._synckeys = set()
+        try:
+            BaseCacheClient._connect_action(self)
+            # values deleted on the primary while we were not connected
+            lines = ''.join(self._db.ask_wc('', False, None, None))
+            for line in lines.splitlines():
+                match = msg_pattern.match(line)
+                if match and match.group('key') not in self._synckeys and \
+                   not match.group('key').startswith(STATS_PREFIX):
+                    self._db.tell(match.group('key'), None, currenttime(),
+                                  None, None)
+        finally:
+            self._synckeys = None
+        for key, value in iteritems(self._forwarded_rewrites):
+            self._queue.put(key + OP_REWRITE + value + '\n')
+
+    def _handle_msg(self, time, ttlop, ttl, tsop, key, op, value):
+        if op not in (OP_TELL, OP_TELLOLD) or key == END_MARKER or \
+           key.startswith(STATS_PREFIX):
+            # the replica publishes its own statistics
+            return
+        if self._synckeys is not None:
+            self._synckeys.add(key)
+        time = float(time) if time else currenttime()
+        ttl = float(ttl) if ttl else None
+        if op == OP_TELLOLD:
+            if not value:
+                return
+            if ttl is None:
+                # the value expired on the primary; normally the local copy
+                # has expired at the same time already
+                if self._db.ask(key, False, None, None) == \
+                   [key + OP_TELLOLD + value + '\n']:
+                    return
+                ttl = EXPIRED_TTL
+        self._db.tell(key, value or None, time, ttl, None)
+
+    def forward_tell(self, key, value, time, ttl):
+        if ttl:
+            msg = '%r+%s@%s%s%s\n' % (time, ttl, key, OP_TELL, value or '')
+        else:
+            msg = '%r@%s%s%s\n' % (time, key, OP_TELL, value or '')
+        self._queue.put(msg)
+
+    def forward_lock(self, key, value, time, ttl):
+        tosend = '%s%s%s\n' % (key, OP_LOCK, value or '')
+        if ttl:
+            tosend = '%r+%s@%s' % (time, ttl, tosend)
+        try:
+            for msgmatch in self._single_request(tosend):
+                return [key + OP_LOCK + (msgmatch.group('value') or '') + '\n']
+        except Exception:
+            self.log.warning('could not forward lock request for %s', key,
+                             exc=1)
+        # without answer from the primary, the lock is denied
+        return [key + OP_LOCK + 'primary cache not reachable\n']
+
+    def forward_rewrite(self, key, value):
+        if value:
+            self._forwarded_rewrites[key] = value
+        else:
+            self._forwarded_rewrites.pop(key, None)
+        self._queue.put(key + OP_REWRITE + (value or '') + '\n')
+
+
+class ReplicaDatabase(object):
+    """Database seen by the client connections of a replica.
+
+    Reads are handled by the local database, writes are forwarded to the
+    primary.  Tells are also applied locally, since the primary does not send
+    updates back to the connection they came from.
+    """
+
+    def __init__(self, db, upstream):
+        self._db = db
+        self._upstream = upstream
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def tell(self, key, value, time, ttl, from_client):
+        self._upstream.forward_tell(key, value, time, ttl)
+        self._db.tell(key, value, time, ttl, from_client)
+
+    def lock(self, key, value, time, ttl):
+        return self._upstream.forward_lock(key, value, time, ttl)
+
+    def rewrite(self, key, value):
+        self._upstream.forward_rewrite(key, value)
@@ -40,38 +40,160 @@ from __future__ import absolute_import, division, print_function
 import select
 import socket
 import threading
-from errno import EAGAIN
+from errno import EAGAIN, EINTR, EWOULDBLOCK
 from time import sleep, time as currenttime
 
 from nicos import config, session
-from nicos.core import Attach, Device, Param, host
+from nicos.core import Attach, ConfigurationError, Device, Param, \
+    floatrange, host, intrange, oneof
 from nicos.protocols.cache import BUFSIZE, CYCLETIME, DEFAULT_CACHE_PORT, \
-    OP_ASK, OP_LOCK, OP_REWRITE, OP_SUBSCRIBE, OP_TELL, OP_TELLOLD, \
-    OP_UNSUBSCRIBE, OP_WILDCARD, line_pattern, msg_pattern
-from nicos.pycompat import from_utf8, listitems, listvalues, queue, to_utf8
+    FLAG_NO_STORE, HIST_DOWNSAMPLE, OP_ASK, OP_ASKMULTI, OP_LOCK, \
+    OP_REWRITE, OP_SUBSCRIBE, OP_TELL, OP_TELLOLD, OP_UNSUBSCRIBE, \
+    OP_WILDCARD, cache_dump, line_pattern, msg_pattern
+from nicos.pycompat import from_utf8, iteritems, listitems, listvalues, \
+    to_utf8
 # pylint: disable=W0611
 from nicos.services.cache.database import CacheDatabase, \
     FlatfileCacheDatabase, MemoryCacheDatabase, \
     MemoryCacheDatabaseWithHistory
+from nicos.services.cache.replica import CacheReplicaClient, ReplicaDatabase
+from nicos.services.cache.stats import STATS_PREFIX, ServerStats
+from nicos.services.cache.subscriptions import SubscriptionIndex
 from nicos.utils import closeSocket, createThread, getSysInfo, loggers, \
     parseHostPort
 
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
+
+# timeout for sending data to a client before the connection is closed
+SEND_TIMEOUT = 5
+
+
+class CacheOutbox(object):
+    """Data waiting to be sent to a client.
+
+    Replies to requests are always sent completely and in order.  Updates are
+    sent in order as well, as long as the client keeps up.  Once more than
+    *conflate* updates are waiting, the client is lagging behind, and a new
+    update of a key replaces the update of the same key that is still waiting,
+    so that only the latest value is sent.  If more than *maxsize* updates are
+    waiting anyway, the outbox overflows and the connection is closed; the
+    client will reconnect and request the current values again.
+
+    A limit of 0 disables conflation or the overflow check, respectively.
+    """
+
+    def __init__(self, worker, maxsize=0, conflate=0):
+        self._worker = worker
+        self._maxsize = maxsize
+        self._conflate = conflate
+        self._cond = threading.Condition()
+        # waiting data in order; conflated updates are replaced by None
+        self._chunks = []
+        # maps keys to the index of their latest waiting update in _chunks
+        self._updates = {}
+        # number of waiting updates
+        self._nupdates = 0
+        self._closed = False
+        # accounting of lagging clients
+        self.conflated = 0
+        self.overflowed = False
+        # number of bytes sent
+        self.sent = 0
+
+    def __len__(self):
+        with self._cond:
+            return self._nupdates
+
+    def _has_data(self):
+        return bool(self._chunks)
+
+    def _take(self):
+        data = ''.join(chunk for chunk in self._chunks if chunk is not None)
+        self._chunks = []
+        self._updates.clear()
+        self._nupdates = 0
+        return data
+
+    def has_data(self):
+        with self._cond:
+            return self._has_data()
+
+    def put(self, data, key=None):
+        """Add a reply, or an update of *key* to the outbox.
+
+        Returns true if the outbox was empty before.
+        """
+        with self._cond:
+            if self._closed:
+                return False
+            wasempty = not self._has_data()
+            if key is not None:
+                index = self._updates.get(key)
+                if index is not None and self._nupdates >= self._conflate > 0:
+                    self._chunks[index] = None
+                    self._nupdates -= 1
+                    self.conflated += 1
+                self._updates[key] = len(self._chunks)
+                self._nupdates += 1
+            self._chunks.append(data)
+            queued = self._nupdates
+            overflow = queued > self._maxsize > 0
+            if overflow:
+                self.overflowed = True
+                self.close()
+            else:
+                self._cond.notify()
+        if overflow:
+            self._worker.overflow(queued, self.conflated)
+            return False
+        return wasempty
+
+    def get(self):
+        """Wait for data and return all of it as one string.
+
+        Returns None if the outbox has been closed.
+        """
+        with self._cond:
+            while not self._chunks and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            return self._take()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._take()
+            self._cond.notify_all()
+
 
 class CacheWorker(object):
     """Worker thread class for the cache server.
 
     One worker starts two threads: one for receiving data from the connection,
-    and one for sending.  Data to send must be posited in `self.send_queue`.
+    and one for sending.  Data to send must be posited in `self.send_queue`,
+    a `CacheOutbox`.
     """
 
-    def __init__(self, db, sock, name, loglevel):
+    def __init__(self, db, sock, name, loglevel, subscriptions=None,
+                 maxqueued=0, conflate=0, stats=None):
         self.name = name
+        # server statistics, if collected
+        self.stats = stats
+        # limits of the outbox for updates
+        self.maxqueued = maxqueued
+        self.conflate = conflate
         # actual value handling is done by the database object
         self.db = db
+        # server-wide subscription index, if used
+        self.subscriptions = subscriptions
         # the socket object
         self.sock = sock
         # timeout for send (recv is covered by select timeout)
-        self.sock.settimeout(5)
+        self.sock.settimeout(SEND_TIMEOUT)
         # list of subscriptions
         self.updates_on = set()
         # list of subscriptions with timestamp requested
@@ -84,13 +206,20 @@ class CacheWorker(object):
         # start sender thread (if necessary)
         self.start_sender(name)
 
-        # start receiver thread
-        self.receiver = createThread('receiver %s' % name, self._receiver_thread)
+        # start receiver thread (if necessary)
+        self.start_receiver(name)
 
     def start_sender(self, name):
-        self.send_queue = queue.Queue()
+        self.send_queue = CacheOutbox(self, self.maxqueued, self.conflate)
         self.sender = createThread('sender %s' % name, self._sender_thread)
 
+    def start_receiver(self, name):
+        # assign before starting: other threads may call is_active() as soon
+        # as the first subscription has been processed
+        self.receiver = createThread('receiver %s' % name,
+                                     self._receiver_thread, start=False)
+        self.receiver.start()
+
     def __str__(self):
         return 'worker(%s)' % self.name
 
@@ -108,19 +237,29 @@ class CacheWorker(object):
             closeSocket(sock)
 
     def join(self):
-        self.send_queue.put('end')   # to wake from blocking get()
+        self.send_queue.close()   # to wake from blocking get()
         self.sender.join()
         self.receiver.join()
 
+    def overflow(self, queued, conflated):
+        """Called by the outbox if the client does not keep up."""
+        self.log.warning('client does not keep up: %d updates waiting to be '
+                         'sent (%d conflated), shutting down',
+                         queued, conflated)
+        self.closedown()
+
     def _sender_thread(self):
         while not self.stoprequest:
+            # all data that accumulated while sending is sent in one batch
             data = self.send_queue.get()
             # self.log.debug('sending: %r', data)
-            if self.sock is None:  # connection already closed
+            if data is None or self.sock is None:  # connection closed
                 return
+            data = to_utf8(data)
             while True:
                 try:
-                    self.sock.sendall(to_utf8(data))
+                    self.sock.sendall(data)
+                    self.send_queue.sent += len(data)
                 except socket.timeout:
                     self.log.warning('send timed out, shutting down')
                     self.closedown()
@@ -221,17 +360,40 @@ class CacheWorker(object):
             ttl = ttl - time
 
         # dispatch operations to database object
+        started = currenttime()
         if op == OP_TELL:
             self.db.tell(key, value, time, ttl, self)
         elif op == OP_ASK:
             if ttl:
-                return self.db.ask_hist(key, time, time + ttl)
+                if value and value.startswith(HIST_DOWNSAMPLE):
+                    try:
+                        maxpoints = int(value[1:])
+                    except ValueError:
+                        pass
+                    else:
+                        if maxpoints > 0:
+                            return self._timed('history', started,
+                                               self.db.ask_hist_downsampled(
+                                                   key, time, time + ttl,
+                                                   maxpoints))
+                return self._timed('history', started,
+                                   self.db.ask_hist(key, time, time + ttl))
             else:
                 # although passed, time and ttl are ignored here
-                return self.db.ask(key, tsop, time, ttl)
+                return self._timed('ask', started,
+                                   self.db.ask(key, tsop, time, ttl))
+        elif op == OP_ASKMULTI:
+            # the keys are given in the value, time and ttl are ignored
+            ret = []
+            for askkey in (value or '').lower().split(','):
+                askkey = askkey.strip()
+                if askkey:
+                    ret.extend(self.db.ask(askkey, tsop, time, ttl))
+            return self._timed('ask', started, ret)
         elif op == OP_WILDCARD:
             # time and ttl are currently ignored for wildcard requests
-            return self.db.ask_wc(key, tsop, time, ttl)
+            return self._timed('wildcard', started,
+                               self.db.ask_wc(key, tsop, time, ttl))
         elif op == OP_SUBSCRIBE:
             # both time and ttl are ignored for subscription requests,
             # but the return format changes when the @ is included
@@ -239,11 +401,15 @@ class CacheWorker(object):
                 self.ts_updates_on.add(key)
             else:
                 self.updates_on.add(key)
+            if self.subscriptions is not None:
+                self.subscriptions.add(self, key, bool(tsop))
         elif op == OP_UNSUBSCRIBE:
             if tsop:
                 self.ts_updates_on.discard(key)  # note: discard does not raise
             else:
                 self.updates_on.discard(key)
+            if self.subscriptions is not None:
+                self.subscriptions.remove(self, key, bool(tsop))
         elif op == OP_TELLOLD:
             # the server shouldn't get TELLOLD, ignore it
             pass
@@ -253,28 +419,46 @@ class CacheWorker(object):
             self.db.rewrite(key, value)
         return []
 
+    def _timed(self, kind, started, ret):
+        """Record the latency of a request, if statistics are collected."""
+        if self.stats is None:
+            return ret
+        # history queries can return generators, which do the actual work
+        ret = list(ret)
+        self.stats.requests[kind].add(currenttime() - started)
+        return ret
+
     def update(self, key, op, value, time, ttl):
-        """Check if we need to send the update given."""
-        # make sure line has at least a default timestamp
+        """Check if we need to send the update given.
+
+        The server uses its `SubscriptionIndex` and `send_update` instead.
+        """
         for mykey in self.ts_updates_on:
             # do a substring match on key
             if mykey in key:
-                if not time:
-                    time = currenttime()
-                # self.log.debug('sending update of %s to %s', key, value)
-                if ttl is not None:
-                    msg = '%r+%s@%s%s%s\n' % (time, ttl, key, op, value)
-                else:
-                    msg = '%r@%s%s%s\n' % (time, key, op, value)
-                self.send_queue.put(msg)
+                self.send_update(key, op, value, time, ttl, True)
                 return  # send at most one update
         # same for requested updates without timestamp
         for mykey in self.updates_on:
             if mykey in key:
-                # self.log.debug('sending update of %s to %s', key, value)
-                self.send_queue.put(key + op + value + '\n')
+                self.send_update(key, op, value, time, ttl, False)
                 return  # send at most one update
 
+    def send_update(self, key, op, value, time, ttl, ts):
+        """Send the given update, with timestamp if *ts* is true."""
+        # self.log.debug('sending update of %s to %s', key, value)
+        if ts:
+            # make sure line has at least a default timestamp
+            if not time:
+                time = currenttime()
+            if ttl is not None:
+                msg = '%r+%s@%s%s%s\n' % (time, ttl, key, op, value)
+            else:
+                msg = '%r@%s%s%s\n' % (time, key, op, value)
+            self.send_queue.put(msg, key)
+        else:
+            self.send_queue.put(key + op + value + '\n', key)
+
 
 class CacheUDPWorker(CacheWorker):
     """Special subclass for handling UDP requests."""
@@ -287,7 +471,7 @@ class CacheUDPWorker(CacheWorker):
         CacheWorker.__init__(self, db, sock, name, loglevel)
 
     def start_sender(self, name):
-        pass
+        self.send_queue = None
 
     def join(self):
         self.receiver.join()
@@ -325,6 +509,265 @@ class CacheUDPWorker(CacheWorker):
         return datalen
 
 
+class CacheSendBuffer(CacheOutbox):
+    """Outbox of a `CacheSelectorWorker`.
+
+    Data can be added from any thread with `put`; the event loop owning the
+    connection is then woken up and writes the data out without blocking.
+    """
+
+    def __init__(self, worker, loop, maxsize=0, conflate=0):
+        CacheOutbox.__init__(self, worker, maxsize, conflate)
+        self._loop = loop
+        # data taken from the outbox, but not yet sent completely
+        self._pending = b''
+        # time since which data is waiting to be sent without any progress
+        self._stalled_since = None
+
+    def _has_data(self):
+        return bool(self._chunks or self._pending)
+
+    def put(self, data, key=None):
+        if CacheOutbox.put(self, data, key):
+            with self._cond:
+                self._stalled_since = currenttime()
+            self._loop.wakeup(self._worker)
+
+    def is_stalled(self, now, timeout=SEND_TIMEOUT):
+        with self._cond:
+            return self._stalled_since is not None and \
+                now - self._stalled_since > timeout
+
+    def send(self, sock):
+        """Send as much data as possible without blocking.
+
+        Returns true if there is still data left to send.
+        """
+        with self._cond:
+            # only take new data when the previous batch is out, so that
+            # updates can still be conflated while the client is lagging
+            if not self._pending and self._chunks:
+                self._pending = to_utf8(self._take())
+            if self._pending:
+                sent = sock.send(self._pending)
+                if sent:
+                    self.sent += sent
+                    self._pending = self._pending[sent:]
+                    self._stalled_since = currenttime()
+            if not self._pending:
+                self._stalled_since = None
+                return False
+            return True
+
+
+class CacheSelectorWorker(CacheWorker):
+    """Worker class for the "selector" engine of the cache server.
+
+    No threads are started; instead the connection is registered with one of
+    the server's `CacheSelectorLoop` instances, which calls `handle_read` and
+    `handle_write` when the socket is ready.  Replies and updates are collected
+    in a `CacheSendBuffer`.
+    """
+
+    def __init__(self, db, sock, name, loglevel, loop, subscriptions=None,
+                 maxqueued=0, conflate=0, stats=None):
+        self.loop = loop
+        self.data = b''
+        self.finished = threading.Event()
+        CacheWorker.__init__(self, db, sock, name, loglevel, subscriptions,
+                             maxqueued, conflate, stats)
+        self.sock.setblocking(False)
+        loop.register(self)
+
+    def start_sender(self, name):
+        self.send_queue = CacheSendBuffer(self, self.loop, self.maxqueued,
+                                          self.conflate)
+
+    def start_receiver(self, name):
+        pass
+
+    def is_active(self):
+        return not self.stoprequest
+
+    def closedown(self):
+        # the socket is closed by the event loop after unregistering it
+        if not self.stoprequest:
+            self.stoprequest = True
+            self.loop.wakeup(self)
+
+    def join(self):
+        self.finished.wait()
+
+    def handle_read(self):
+        try:
+            newdata = self.sock.recv(BUFSIZE)
+        except socket.error as err:
+            if err.args[0] in (EAGAIN, EWOULDBLOCK, EINTR):
+                return
+            newdata = b''
+        if not newdata:
+            # connection closed by the other end
+            self.closedown()
+            return
+        self.data = self._process_data(self.data + newdata,
+                                       self.send_queue.put)
+
+    def handle_write(self):
+        """Write pending data; return true if there is more to write."""
+        try:
+            return self.send_queue.send(self.sock)
+        except socket.error as err:
+            if err.args[0] in (EAGAIN, EWOULDBLOCK, EINTR):
+                return True
+            self.log.warning('other end closed, shutting down', exc=err)
+        except Exception:
+            self.log.warning('other end closed, shutting down')
+        self.closedown()
+        return False
+
+
+class CacheSelectorUDPWorker(CacheUDPWorker):
+    """UDP handler for the "selector" engine.
+
+    The received data is processed synchronously in the thread that received
+    the datagram, without starting a new thread.
+    """
+
+    def start_receiver(self, name):
+        self._receiver_thread()
+
+    def is_active(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class CacheSelectorLoop(object):
+    """Event loop for the "selector" engine of the cache server.
+
+    One loop thread multiplexes any number of `CacheSelectorWorker` connections
+    using the best selector available on the platform (e.g. epoll).
+    """
+
+    def __init__(self, name, log):
+        self.log = log
+        self._selector = selectors.DefaultSelector()
+        # socket pair used to wake up the loop from other threads
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        # workers that need to be registered
+        self._new = []
+        # workers whose output or state changed
+        self._changed = set()
+        # maps registered workers -> currently selected events
+        self._workers = {}
+        self._stoprequest = False
+        self._thread = createThread(name, self._loop_thread)
+
+    def register(self, worker):
+        with self._lock:
+            self._new.append(worker)
+        self._wake()
+
+    def wakeup(self, worker):
+        with self._lock:
+            if worker in self._changed:
+                return
+            self._changed.add(worker)
+        if threading.current_thread() is not self._thread:
+            self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_send.send(b'x')
+        except socket.error:
+            # buffer full: the loop will wake up anyway
+            pass
+
+    def stop(self):
+        self._stoprequest = True
+        self._wake()
+        self._thread.join()
+
+    def _loop_thread(self):
+        nextcheck = currenttime() + CYCLETIME * 3
+        while not self._stoprequest:
+            try:
+                events = self._selector.select(CYCLETIME * 3)
+            except (select.error, EnvironmentError) as err:
+                if err.args[0] == EINTR:
+                    continue
+                raise
+            for key, mask in events:
+                worker = key.data
+                if worker is None:
+                    try:
+                        while self._wakeup_recv.recv(BUFSIZE):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        worker.handle_read()
+                    if mask & selectors.EVENT_WRITE and worker.is_active():
+                        if not worker.handle_write():
+                            self.wakeup(worker)
+                except Exception:
+                    worker.log.exception('error handling connection, '
+                                         'shutting down')
+                    worker.closedown()
+            with self._lock:
+                new, self._new = self._new, []
+                changed, self._changed = self._changed, set()
+            for worker in new:
+                self._selector.register(worker.sock, selectors.EVENT_READ,
+                                        worker)
+                self._workers[worker] = selectors.EVENT_READ
+                changed.add(worker)
+            for worker in changed:
+                self._update_worker(worker)
+            now = currenttime()
+            if now > nextcheck:
+                nextcheck = now + CYCLETIME * 3
+                for worker in list(self._workers):
+                    if worker.send_queue.is_stalled(now):
+                        worker.log.warning('send timed out, shutting down')
+                        worker.closedown()
+                        self._update_worker(worker)
+        for worker in list(self._workers):
+            worker.stoprequest = True
+            self._update_worker(worker)
+        self._selector.close()
+        closeSocket(self._wakeup_recv)
+        closeSocket(self._wakeup_send)
+
+    def _update_worker(self, worker):
+        """Send pending data, and update selected events or remove the worker
+        according to its state.
+        """
+        if worker not in self._workers:
+            return
+        events = selectors.EVENT_READ
+        if worker.is_active() and worker.send_queue.has_data():
+            # try to send directly; only wait for writability if necessary
+            if worker.handle_write():
+                events |= selectors.EVENT_WRITE
+        if not worker.is_active():
+            del self._workers[worker]
+            sock, worker.sock = worker.sock, None
+            self._selector.unregister(sock)
+            closeSocket(sock)
+            worker.finished.set()
+        elif self._workers[worker] != events:
+            self._workers[worker] = events
+            self._selector.modify(worker.sock, events, worker)
+
+
 class CacheServer(Device):
     """
     The server class.
@@ -335,10 +778,32 @@ class CacheServer(Device):
                           type=host(defaultport=DEFAULT_CACHE_PORT),
                           mandatory=True,
                           ext_desc="The default port is ``14869``."),
+        'engine':   Param('Connection handling engine: "threaded" starts two '
+                          'threads per client, "selector" multiplexes all '
+                          'clients on a few event loops',
+                          type=oneof('threaded', 'selector'),
+                          default='threaded'),
+        'selectorloops': Param('Number of event loop threads used by the '
+                               '"selector" engine', type=intrange(1, 64),
+                               default=1),
+        'maxqueued':     Param('Maximum number of updates waiting to be sent '
+                               'to a client; a client that lags behind more '
+                               'is disconnected (0 = no limit)',
+                               type=intrange(0, 10**9), default=100000),
+        'conflate':      Param('Number of updates waiting to be sent to a '
+                               'client from which on only the latest update '
+                               'of each key is kept (0 = never)',
+                               type=intrange(0, 10**9), default=1000),
+        'statsinterval': Param('Interval for publishing server statistics '
+                               'under the "cache/stats/" keys (0 = never)',
+                               type=floatrange(0), default=10, unit='s'),
     }
 
     attached_devices = {
-        'db': Attach('The cache database instance', CacheDatabase),
+        'db':      Attach('The cache database instance', CacheDatabase),
+        'primary': Attach('Connection to the primary cache, if this server '
+                          'is a read-only replica', CacheReplicaClient,
+                          optional=True),
     }
 
     def doInit(self, mode):
@@ -350,19 +815,104 @@ class CacheServer(Device):
         self._serversocket_udp = None
         # worker connections
         self._connected = {}
+        # index of all subscriptions of the connected workers
+        self._subscriptions = SubscriptionIndex()
+        # outbox accounting of closed connections
+        self._sendstats = {'conflated': 0, 'overflows': 0}
+        # statistics published under the stats keys
+        self._stats = ServerStats() if self.statsinterval else None
+        self._statsthread = None
         self._attached_db._server = self
+        # the database as seen by the clients: in replica mode, writes are
+        # forwarded to the primary
+        self._db = self._attached_db
+        if self._attached_primary:
+            self._db = ReplicaDatabase(self._attached_db,
+                                       self._attached_primary)
         self._connectionLock = threading.Lock()
+        # event loops for the selector engine
+        self._loops = []
+        if self.engine == 'selector' and selectors is None:
+            raise ConfigurationError(self, 'the selector engine needs the '
+                                     'selectors module (Python 3)')
 
     def start(self, *startargs):
         if config.instrument == 'demo' and 'clear' in startargs:
             self._attached_db.clearDatabase()
         self._attached_db.initDatabase()
+        if self._attached_primary:
+            self.log.info('running as replica of %s',
+                          self._attached_primary.cache)
+            self._attached_primary.follow(self._attached_db)
         self.storeSysInfo()
+        if self.engine == 'selector':
+            self._loops = [CacheSelectorLoop('selector %d' % i, self.log)
+                           for i in range(self.selectorloops)]
         self._worker = createThread('server', self._server_thread)
+        if self._stats:
+            self._statsthread = createThread('stats', self._stats_thread)
+
+    def update(self, key, op, value, time, ttl, from_client=None):
+        """Send an update to all clients subscribed to the key, except for the
+        client that sent it.
+        """
+        if self._stats:
+            self._stats.countUpdate(key)
+        for client, ts in self._subscriptions.lookup(key):
+            if client is not from_client and client.is_active():
+                client.send_update(key, op, value, time, ttl, ts)
+
+    def getSendStats(self):
+        """Return the number of updates waiting to be sent, conflated, and
+        the number of connections closed because their outbox overflowed.
+        """
+        stats = dict(self._sendstats, queued=0)
+        for client in listvalues(self._connected):
+            if client.send_queue is not None:
+                stats['queued'] += len(client.send_queue)
+                stats['conflated'] += client.send_queue.conflated
+                stats['overflows'] += client.send_queue.overflowed
+        return stats
+
+    def getStats(self):
+        """Return the statistics published under the stats keys."""
+        clients = {}
+        for addr, client in listitems(self._connected):
+            if client.send_queue is not None:
+                clients[addr] = {'queued': len(client.send_queue),
+                                 'sent': client.send_queue.sent,
+                                 'conflated': client.send_queue.conflated}
+        stats = {
+            'updaterate': self._stats.updateRates(),
+            'subscriptions': len(self._subscriptions),
+            'clients': clients,
+            'sendqueues': self.getSendStats(),
+            'database': self._attached_db.getStats(),
+        }
+        for kind, histogram in iteritems(self._stats.requests):
+            stats[kind + 'latency'] = histogram.snapshot()
+        return stats
+
+    def _stats_thread(self):
+        nextpublish = currenttime() + self.statsinterval
+        while not self._stoprequest:
+            sleep(min(self._long_loop_delay, self.statsinterval))
+            now = currenttime()
+            if now < nextpublish:
+                continue
+            nextpublish = now + self.statsinterval
+            try:
+                for name, value in iteritems(self.getStats()):
+                    # only kept in memory, not in the store files
+                    self._attached_db.tell(
+                        STATS_PREFIX + name + FLAG_NO_STORE,
+                        cache_dump(value), now, 3 * self.statsinterval, None)
+            except Exception:
+                self.log.warning('could not publish statistics', exc=1)
 
     def storeSysInfo(self):
         key, res = getSysInfo('cache')
-        self._attached_db.tell(key, str(res), currenttime(), None, None)
+        self._db.tell(key, str(res), currenttime(), None, None)
 
     def _bind_to(self, address, proto='tcp'):
         # bind to the address with the given protocol; return socket and address
@@ -408,6 +958,7 @@ class CacheServer(Device):
                           self._boundto[0], self._boundto[1])
 
         # now enter main serving loop
+        nconn = 0
         while not self._stoprequest:
             # loop through connections, first to remove dead ones,
             # secondly to try to reconnect
@@ -416,7 +967,13 @@ class CacheServer(Device):
                     self.log.info('client connection %s closed', addr)
                     client.closedown()
                     client.join()  # wait for threads to end
+                    self._subscriptions.remove_worker(client)
                     del self._connected[addr]
+                    if client.send_queue is not None:
+                        self._sendstats['conflated'] += \
+                            client.send_queue.conflated
+                        self._sendstats['overflows'] += \
+                            client.send_queue.overflowed
 
             # now check for additional incoming connections
             # build list of things to check
@@ -439,15 +996,37 @@ class CacheServer(Device):
                     conn, addr = self._serversocket.accept()
                     addr = 'tcp://%s:%d' % addr
                     self.log.info('new connection from %s', addr)
-                    self._connected[addr] = CacheWorker(
-                        self._attached_db, conn, name=addr, loglevel=self.loglevel)
+                    if self._loops:
+                        # distribute connections among the event loops
+                        loop = self._loops[nconn % len(self._loops)]
+                        nconn += 1
+                        self._connected[addr] = CacheSelectorWorker(
+                            self._db, conn, name=addr,
+                            loglevel=self.loglevel, loop=loop,
+                            subscriptions=self._subscriptions,
+                            maxqueued=self.maxqueued, conflate=self.conflate,
+                            stats=self._stats)
+                    else:
+                        self._connected[addr] = CacheWorker(
+                            self._db, conn, name=addr,
+                            loglevel=self.loglevel,
+                            subscriptions=self._subscriptions,
+                            maxqueued=self.maxqueued, conflate=self.conflate,
+                            stats=self._stats)
                 elif self._serversocket_udp in res[0]:
                     # UDP data came in
                     data, addr = self._serversocket_udp.recvfrom(3072)
                     nice_addr = 'udp://%s:%d' % addr
                     self.log.info('new connection from %s', nice_addr)
+                    if self._loops:
+                        # handled synchronously, no need to keep the worker
+                        CacheSelectorUDPWorker(
+                            self._db, self._serversocket_udp,
+                            name=nice_addr, data=data, remoteaddr=addr,
+                            loglevel=self.loglevel)
+                        continue
                     self._connected[nice_addr] = CacheUDPWorker(
-                        self._attached_db, self._serversocket_udp, name=nice_addr,
+                        self._db, self._serversocket_udp, name=nice_addr,
                         data=data, remoteaddr=addr, loglevel=self.loglevel)
         if self._serversocket:
             closeSocket(self._serversocket)
@@ -472,6 +1051,10 @@ class CacheServer(Device):
                 self.log.info('waiting for %s', client)
                 client.closedown()  # make sure, the connection closes down
                 client.join()
+        for loop in self._loops:
+            loop.stop()
         self.log.info('waiting for server')
         self._worker.join()
+        if self._statsthread:
+            self._statsthread.join()
         self.log.info('server finished')
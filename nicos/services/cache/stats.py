@@ -0,0 +1,203 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""Statistics of the NICOS cache server.
+
+The server publishes its statistics periodically under keys starting with
+`STATS_PREFIX`; ``nicos-cache --stats`` shows them.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+from bisect import bisect_left
+from time import time as currenttime
+
+from nicos.protocols.cache import BUFSIZE, DEFAULT_CACHE_PORT, END_MARKER, \
+    OP_ASK, OP_TELLOLD, OP_WILDCARD, cache_load, msg_pattern
+from nicos.pycompat import from_utf8, to_utf8
+from nicos.utils import closeSocket, tcpSocket
+
+# prefix of the keys under which the server publishes its statistics
+STATS_PREFIX = 'cache/stats/'
+
+
+class Histogram(object):
+    """Histogram of durations (in seconds) with logarithmic buckets."""
+
+    # upper bounds of the buckets; the last bucket is unbounded
+    bounds = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1., 10.)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._sum = 0.
+        self._max = 0.
+
+    def add(self, duration):
+        index = bisect_left(self.bounds, duration)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += duration
+            if duration > self._max:
+                self._max = duration
+
+    def snapshot(self):
+        """Return count, total and maximum duration, and the counts per
+        bucket as a list of (upper bound, count) pairs, with None as the
+        bound of the last bucket.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            return {
+                'count': sum(counts),
+                'sum': self._sum,
+                'max': self._max,
+                'buckets': list(zip(self.bounds + (None,), counts)),
+            }
+
+
+class TimedLock(object):
+    """Lock that records how long threads had to wait for it.
+
+    Only waits for a lock held by another thread are recorded, so that
+    acquiring an uncontended lock stays cheap.
+    """
+
+    def __init__(self, histogram):
+        self._lock = threading.Lock()
+        self._histogram = histogram
+
+    def acquire(self, blocking=True):
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        started = currenttime()
+        self._lock.acquire()
+        self._histogram.add(currenttime() - started)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+class ServerStats(object):
+    """Statistics collected by the cache server and its connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # number of updates per category since the last call to updateRates
+        self._updates = {}
+        self._since = currenttime()
+        # latency of requests, by kind of request
+        self.requests = {
+            'ask': Histogram(),
+            'wildcard': Histogram(),
+            'history': Histogram(),
+        }
+
+    def countUpdate(self, key):
+        if key.startswith(STATS_PREFIX):
+            return
+        category = key.rpartition('/')[0] or 'nocat'
+        with self._lock:
+            self._updates[category] = self._updates.get(category, 0) + 1
+
+    def updateRates(self):
+        """Return the updates per second of each category since the last
+        call.
+        """
+        now = currenttime()
+        with self._lock:
+            updates, self._updates = self._updates, {}
+            interval, self._since = now - self._since, now
+        interval = max(interval, 1e-3)
+        return dict((category, count / interval)
+                    for (category, count) in updates.items())
+
+
+def queryStats(address):
+    """Query the statistics of the cache server at *address*."""
+    sock = tcpSocket(address, DEFAULT_CACHE_PORT)
+    try:
+        sock.sendall(to_utf8('%s%s\n%s%s\n' % (STATS_PREFIX, OP_WILDCARD,
+                                               END_MARKER, OP_ASK)))
+        sentinel = to_utf8(END_MARKER + OP_TELLOLD + '\n')
+        data = b''
+        while not data.endswith(sentinel):
+            newdata = sock.recv(BUFSIZE)
+            if not newdata:
+                raise IOError('cache closed connection')
+            data += newdata
+    finally:
+        closeSocket(sock)
+    stats = {}
+    for line in from_utf8(data).splitlines():
+        match = msg_pattern.match(line)
+        if match and match.group('key').startswith(STATS_PREFIX):
+            stats[match.group('key')[len(STATS_PREFIX):]] = \
+                cache_load(match.group('value'))
+    return stats
+
+
+def _formatDuration(seconds):
+    if seconds < 1e-3:
+        return '%.0f us' % (seconds * 1e6)
+    if seconds < 1:
+        return '%.1f ms' % (seconds * 1e3)
+    return '%.2f s' % seconds
+
+
+def formatStats(stats, indent=''):
+    """Format statistics returned by `queryStats` as a list of lines."""
+    lines = []
+    for name in sorted(stats):
+        value = stats[name]
+        if isinstance(value, dict) and 'buckets' in value:
+            if value['count']:
+                lines.append('%s%s: %d, mean %s, max %s' % (
+                    indent, name, value['count'],
+                    _formatDuration(value['sum'] / value['count']),
+                    _formatDuration(value['max'])))
+                for bound, count in value['buckets']:
+                    if count:
+                        lines.append('%s    %-10s %d' % (
+                            indent, bound is None and '> 10 s' or
+                            '<= ' + _formatDuration(bound), count))
+            else:
+                lines.append('%s%s: none' % (indent, name))
+        elif isinstance(value, dict):
+            lines.append('%s%s:' % (indent, name))
+            lines.extend(formatStats(value, indent + '    '))
+        elif isinstance(value, float):
+            lines.append('%s%s: %.2f' % (indent, name, value))
+        else:
+            lines.append('%s%s: %s' % (indent, name, value))
+    return lines
@@ -0,0 +1,167 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""Server-wide index of client subscriptions of the cache server."""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+from collections import deque
+
+from nicos.pycompat import iteritems, itervalues
+
+# kinds of subscription
+SUB_PLAIN = 1
+SUB_TS = 2
+
+
+class SubstringMatcher(object):
+    """Aho-Corasick automaton finding all of a set of patterns that occur as
+    substrings of a given text, in a single pass over the text.
+    """
+
+    def __init__(self, patterns):
+        # per node: transitions, failure link and matched patterns
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for pattern in patterns:
+            node = 0
+            for char in pattern:
+                nextnode = self._goto[node].get(char)
+                if nextnode is None:
+                    nextnode = len(self._goto)
+                    self._goto[node][char] = nextnode
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = nextnode
+            self._out[node] += (pattern,)
+        # compute failure links breadth-first
+        todo = deque(itervalues(self._goto[0]))
+        while todo:
+            node = todo.popleft()
+            for char, nextnode in iteritems(self._goto[node]):
+                todo.append(nextnode)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                if fail == nextnode:
+                    fail = 0
+                self._fail[nextnode] = fail
+                self._out[nextnode] += self._out[fail]
+
+    def search(self, text):
+        """Return the set of patterns occurring in *text*."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+class SubscriptionIndex(object):
+    """Maps cache keys to the workers subscribed to them.
+
+    Subscriptions are substring matches: a worker subscribed to "nicos/t"
+    receives updates for all keys containing that string.  If any matching
+    subscription of a worker requested timestamps, the worker gets the
+    update with timestamp, and each worker gets at most one update per key.
+
+    Lookups are answered from a memo of previous results, and otherwise with
+    a `SubstringMatcher` over all subscribed strings; both are discarded when
+    subscriptions change.
+    """
+
+    # maximum number of memoized lookups
+    max_memo = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # maps subscribed string -> {worker: SUB_PLAIN and/or SUB_TS bits}
+        self._subs = {}
+        self._matcher = None
+        self._memo = {}
+
+    def __len__(self):
+        return sum(len(workers) for workers in itervalues(self._subs))
+
+    def _changed(self):
+        self._matcher = None
+        self._memo = {}
+
+    def add(self, worker, key, ts):
+        with self._lock:
+            workers = self._subs.setdefault(key, {})
+            workers[worker] = workers.get(worker, 0) | \
+                (ts and SUB_TS or SUB_PLAIN)
+            self._changed()
+
+    def remove(self, worker, key, ts):
+        with self._lock:
+            workers = self._subs.get(key)
+            if not workers or worker not in workers:
+                return
+            workers[worker] &= ~(ts and SUB_TS or SUB_PLAIN)
+            if not workers[worker]:
+                del workers[worker]
+                if not workers:
+                    del self._subs[key]
+            self._changed()
+
+    def remove_worker(self, worker):
+        with self._lock:
+            for key in list(self._subs):
+                workers = self._subs[key]
+                if workers.pop(worker, None) is not None and not workers:
+                    del self._subs[key]
+            self._changed()
+
+    def lookup(self, key):
+        """Return a sequence of (worker, with timestamp) for the key."""
+        result = self._memo.get(key)
+        if result is not None:
+            return result
+        with self._lock:
+            if self._matcher is None:
+                self._matcher = SubstringMatcher(self._subs)
+            matches = self._matcher.search(key)
+            if '' in self._subs:
+                matches.add('')
+            workers = {}
+            for match in matches:
+                for worker, bits in iteritems(self._subs[match]):
+                    workers[worker] = workers.get(worker, 0) | bits
+            result = tuple((worker, bool(bits & SUB_TS))
+                           for (worker, bits) in iteritems(workers))
+            if len(self._memo) >= self.max_memo:
+                self._memo = {}
+            self._memo[key] = result
+        return result
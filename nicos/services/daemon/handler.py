@@ -588,18 +588,20 @@ class ConnectionHandler(object):
         self.send_ok_reply(current_script and current_script.text or '')
 
     @command()
-    def gethistory(self, key, fromtime, totime):
+    def gethistory(self, key, fromtime, totime, maxpoints=None):
         """Return history of a cache key, if available.
 
         :param key: cache key (without prefix) to query history
         :param fromtime: start time as Unix timestamp
         :param totime: end time as Unix timestamp
+        :param maxpoints: if given, maximum number of values to return
         :returns: list of (time, value) tuples
         """
         if not session.cache:
             self.send_ok_reply([])
         history = session.cache.history('', key, float(fromtime),
-                                        float(totime))
+                                        float(totime),
+                                        maxpoints and int(maxpoints) or None)
         self.send_ok_reply(history)
 
     @command()
@@ -615,7 +617,15 @@ class ConnectionHandler(object):
             self.send_ok_reply([])
             return
         if ',' in query:
-            result = session.cache.query_db(query.split(','))
+            keys = query.split(',')
+            try:
+                # fetch all keys from the server in one request
+                values = session.cache.get_explicit(None, keys)
+                result = [(key, value) for (key, (time, _, value))
+                          in zip(keys, values) if time is not None]
+            except Exception:
+                # cache server does not support multi-key queries
+                result = session.cache.query_db(keys)
         else:
             result = session.cache.query_db(query)
         self.send_ok_reply(result)
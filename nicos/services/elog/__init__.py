@@ -32,8 +32,8 @@ from time import time as currenttime
 from nicos.core import CacheLockError, Override, Param, oneof
 from nicos.core.sessions.utils import sessionInfo
 from nicos.devices.cacheclient import BaseCacheClient
-from nicos.protocols.cache import OP_ASK, OP_SUBSCRIBE, OP_TELL, cache_load
-from nicos.pycompat import to_utf8
+from nicos.protocols.cache import END_MARKER, OP_ASK, OP_SUBSCRIBE, OP_TELL, \
+    cache_load
 from nicos.services.elog.handler import Handler
 from nicos.utils import timedRetryOnExcept
 
@@ -73,23 +73,13 @@ class Logbook(BaseCacheClient):
         else:
             self._islocked = True
 
-        # request current directory for the handler to start up correctly
-        self._socket.sendall(
-            to_utf8('logbook/directory%s\n###%s\n' % (OP_ASK, OP_ASK)))
-
-        # read response
-        data, n = b'', 0
-        while not data.endswith(b'###!\n') and n < 1000:
-            data += self._socket.recv(8192)
-            n += 1
+        # request current directory for the handler to start up correctly,
+        # and all relevant updates
+        self._sync_request('logbook/directory%s\n%s%s\n@logbook/%s\n' %
+                           (OP_ASK, END_MARKER, OP_ASK, OP_SUBSCRIBE))
 
         self.storeSysInfo('elog')
 
-        # send request for all relevant updates
-        self._socket.sendall(to_utf8('@logbook/%s\n' % OP_SUBSCRIBE))
-
-        self._process_data(data)
-
     def _handle_msg(self, time, ttlop, ttl, tsop, key, op, value):
         if op != OP_TELL or not key.startswith(self._prefix):
             return
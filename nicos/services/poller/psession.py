@@ -49,7 +49,7 @@ class PollerCacheClient(CacheClient):
     # but use _propagate to call callbacks always
     def _propagate(self, args):
         time, key, op, value = args
-        if op == OP_TELL and key in self._callbacks and value:
+        if op == OP_TELL and value and self._has_callbacks(key):
             self._call_callbacks(key, cache_load(value), time)
 
 
@@ -32,7 +32,8 @@ from time import time as currenttime
 from nicos.core import Override
 from nicos.devices.cacheclient import BaseCacheClient
 from nicos.guisupport.qt import QObject, pyqtSignal
-from nicos.protocols.cache import END_MARKER, OP_ASK, OP_TELL, OP_TELLOLD
+from nicos.protocols.cache import END_MARKER, OP_ASK, OP_ASKMULTI, OP_TELL, \
+    OP_TELLOLD
 
 
 class CacheSignals(QObject):
@@ -141,6 +142,16 @@ class CICacheClient(BaseCacheClient):
         for msgmatch in self._single_request(tosend):
             self._handle_msg(**msgmatch.groupdict())
 
+    def update_many(self, keys):
+        """Refresh several values from cache in one request."""
+        if not keys:
+            return
+        tosend = '@%s%s\n%s%s\n' % (
+            OP_ASKMULTI, ','.join(self._prefix + key for key in keys),
+            END_MARKER, OP_ASK)
+        for msgmatch in self._single_request(tosend, b'###!\n'):
+            self._handle_msg(**msgmatch.groupdict())
+
     def put(self, key, entry):
         time = entry.time or currenttime()
         ttlstr = entry.ttl and '+%s' % entry.ttl or ''
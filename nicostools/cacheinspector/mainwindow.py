@@ -178,6 +178,8 @@ class MainWindow(QMainWindow):
             prefix = ''
         keys = [key for key in self.client.keys()
                 if key.rpartition('/')[0] == prefix]
+        # refresh timestamps and TTLs of all shown keys
+        self.client.update_many(keys)
         for key in sorted(keys):
             entry = self.client.get(key)
             widget = EntryWidget(self.client, self.watcherWindow, entry,
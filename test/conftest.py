@@ -40,6 +40,10 @@ from nicos.utils import updateFileCounter
 from test.utils import TestSession, cache_addr, cleanup, killSubprocess, \
     startCache, startSubprocess
 
+# the asyncio cache client requires Python 3
+if sys.version_info[0] == 2:
+    collect_ignore = ['test_stresstest/test_cache_aio.py']
+
 
 # This fixture will run during the entire test suite.  Therefore, the special
 # cache stresstests must use a different port.
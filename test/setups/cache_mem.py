@@ -30,6 +30,7 @@ devices = dict(
     Server = device('nicos.services.cache.server.CacheServer',
         server = alt_cache_addr,
         db = 'DB2',
+        statsinterval = 0.5,
         loglevel = 'debug',
     ),
     DB2 = device('nicos.services.cache.server.MemoryCacheDatabase',
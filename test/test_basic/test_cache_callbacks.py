@@ -0,0 +1,112 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+
+"""NICOS tests for the callback dispatch of cache clients."""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+from nicos.devices.cacheclient import CallbackDispatcher, CallbackTrie
+
+
+class Log(object):
+    def __init__(self):
+        self.warnings = 0
+
+    def warning(self, *args, **kwds):
+        self.warnings += 1
+
+
+def test_trie():
+    trie = CallbackTrie()
+    trie.add('motor/*', 'prefix')
+    trie.add('mot*/status', 'glob')
+    trie.add('motor/value', 'exact')
+    trie.add('m?tor/value', 'single')
+    trie.add('*', 'all')
+    assert len(trie) == 5
+    assert sorted(trie.match('motor/value')) == \
+        ['all', 'exact', 'prefix', 'single']
+    assert sorted(trie.match('motor/status')) == ['all', 'glob', 'prefix']
+    assert sorted(trie.match('motor2/status')) == ['all', 'glob']
+    assert trie.match('motor') == ['all']
+    assert trie.match('motor/value/x') == ['all', 'prefix']
+    trie.remove('*', 'all')
+    trie.remove('motor/*', 'other')
+    trie.remove('unknown/*', 'prefix')
+    assert len(trie) == 4
+    assert trie.match('other') == []
+
+
+def test_dispatch_order():
+    dispatcher = CallbackDispatcher(Log(), 4)
+    calls = {}
+
+    def callback(key, value, time):
+        calls.setdefault(key, []).append(value)
+
+    for i in range(100):
+        for key in ['a', 'b', 'c', 'd', 'e']:
+            dispatcher.dispatch(key, [callback], i, i)
+    dispatcher.stop()
+    assert calls == dict((key, list(range(100))) for key in 'abcde')
+    stats = dispatcher.getStats()
+    assert stats['queued'] == 0
+    assert stats['maxqueued'] >= 1
+    assert stats['latency']['count'] == stats['runtime']['count'] == 500
+
+
+def test_dispatch_async():
+    log = Log()
+    dispatcher = CallbackDispatcher(log, 2)
+    event = threading.Event()
+    called = []
+
+    def slow(key, value, time):
+        event.wait()
+
+    def failing(key, value, time):
+        raise RuntimeError
+
+    def fast(key, value, time):
+        called.append(key)
+
+    # a slow callback does not block the dispatching thread
+    dispatcher.dispatch('slow', [slow, failing], 1, 1)
+    dispatcher.dispatch('slow', [fast], 1, 1)
+    assert dispatcher.getStats()['queued'] >= 1
+    event.set()
+    dispatcher.stop()
+    assert called == ['slow']
+    assert log.warnings == 1
+
+
+def test_dispatch_sync():
+    dispatcher = CallbackDispatcher(Log(), 0)
+    called = []
+    dispatcher.dispatch('key', [lambda *args: called.append(args)], 1, 2)
+    assert called == [('key', 1, 2)]
+    dispatcher.stop()
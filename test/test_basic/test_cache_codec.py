@@ -0,0 +1,117 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+
+"""NICOS tests for the encoding of cache values."""
+
+from __future__ import absolute_import, division, print_function
+
+from ast import parse
+from datetime import date
+
+import pytest
+
+from nicos.protocols.cache import _cache_dump, ast_eval, cache_dump, \
+    cache_load
+from nicos.pycompat import iteritems
+from nicos.utils import readonlydict, readonlylist
+
+# serialized values: the simple ones are decoded by the fast paths, all of
+# them must give the same result as evaluating the AST
+LOAD_CORPUS = [
+    '0', '1', '-1', '-0', '00', '123456789012345678901234567890',
+    '0.0', '-0.0', '1.5', '-1.5', '1.', '.5', '-.5', '007.5', '1e5', '1E-5',
+    '1.5e+20', '-2.5e-300', '1e400', 'inf', '-inf', 'nan', '-nan',
+    'None', 'True', 'False',
+    "''", "'abc'", '"it\'s"', "'\\n'", "'\\\\'", "'\\x00'", "'ä€'",
+    "b'abc'", "u'abc'",
+    '[]', '[1,]', '[1,2,3,]', '[1.5,-2,inf,nan,-inf,]', '[1, 2]', '[1,2]',
+    '[[1,],]', "['a',1,]", "['a,b',]", '["x",\'y\',]', "['\\'',]",
+    '[None,]', '[True,]', "(200,'idle',)", "('',)", "('a', 'b')",
+    '()', '(1,)', '(1.5,2,)', '(1, 2)', '(1)', "('a',)", '((1,),(2.0,),)',
+    '{}', "{'a':1,}", '{1:[2,],}', '{1,2,}', '{(1,2,):{3:4,},}',
+    '1+2j', '-1-2j', '1_000', ' 1',
+]
+
+# values that must be rejected
+INVALID = ['', 'abc', '007', '1.5.5', '[1,2', "'abc", 'os.system("ls")',
+           '__import__("os")', '1 +', '-abc']
+
+# objects that must be restored by cache_load(cache_dump(obj))
+DUMP_CORPUS = [
+    0, 1, -1, 2**70, 0.0, -0.0, 1.5, 1e-300, 1e300, float('inf'),
+    -float('inf'), float('nan'), True, False, None, '', 'abc', "it's",
+    'a"b\'c', '\n\\', u'ä€', b'bytes',
+    (), (1,), (1, 2.5, 'a'), ((1,), (2,)),
+    readonlylist(), readonlylist([1, 2.5, -1]), readonlylist(['a', None]),
+    readonlydict(), readonlydict({'a': 1, 'b': readonlylist([1])}),
+    frozenset([1, 2]), readonlylist([readonlylist([1]), (2, 3)]),
+    date(2020, 1, 31), 1 + 2j,
+]
+
+
+def same(a, b):
+    """Return whether *a* and *b* are equal, including their types and the
+    types of all items.
+    """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for (x, y) in zip(a, b))
+    if isinstance(a, dict):
+        return len(a) == len(b) and all(
+            k in b and same(v, b[k]) for (k, v) in iteritems(a))
+    # repr() to compare nan and the sign of zero
+    return repr(a) == repr(b)
+
+
+@pytest.mark.parametrize('entry', LOAD_CORPUS)
+def test_load_conformance(entry):
+    try:
+        expected = ast_eval(parse(entry, mode='eval').body)
+    except Exception:
+        with pytest.raises(ValueError):
+            cache_load(entry)
+    else:
+        assert same(cache_load(entry), expected)
+
+
+@pytest.mark.parametrize('entry', INVALID)
+def test_load_invalid(entry):
+    with pytest.raises(ValueError):
+        cache_load(entry)
+
+
+@pytest.mark.parametrize('obj', DUMP_CORPUS, ids=repr)
+def test_roundtrip(obj):
+    dumped = cache_dump(obj)
+    # the fast paths give the same output as the general case
+    assert dumped == _cache_dump(obj)
+    assert same(cache_load(dumped), obj)
+
+
+def test_list_roundtrip():
+    # plain lists are restored as readonlylist
+    assert same(cache_load(cache_dump([1, 2.5])), readonlylist([1, 2.5]))
+    assert cache_dump([1, [2.5, 'a'], (None,)]) == "[1,[2.5,'a',],(None,),]"
@@ -0,0 +1,89 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""NICOS tests for the columnar cache history store."""
+
+from __future__ import absolute_import, division, print_function
+
+from os import path
+
+from nicos.services.cache.database.columnar import ColumnStore, \
+    convertFlatfile
+from nicos.utils import ensureDirectory
+
+
+def test_column_store(tmpdir):
+    store = ColumnStore(str(tmpdir))
+    store.append('dev/value', 10., '1.5', None)
+    store.append('dev/value', 20., "'abc'", None)
+    store.append('dev/value', 30., None, None)
+    store.append('dev/value', 40., "'abc'", 5)
+    store.append('dev/value', 50., '1', None)
+    store.append('other', 15., '[1, 2]', None)
+
+    assert sorted(store.keys()) == ['dev/value', 'other']
+    assert store.last('dev/value') == (50., '1', False)
+    assert store.last('other') == (15., '[1, 2]', False)
+    assert store.last('dev/status') is None
+
+    # the last non-deleted value before the range is included
+    assert store.query('dev/value', 35, 45) == [(20., "'abc'"),
+                                                (40., "'abc'")]
+    assert store.query('dev/value', 0, 25) == [(10., '1.5'), (20., "'abc'")]
+    assert store.query('dev/value', 25, 30) == [(20., "'abc'"), (30., '')]
+    assert store.query('dev/value', 60, 70) == [(50., '1')]
+    assert store.query('dev/value', 0, 5) == []
+    store.close()
+
+    # repeated strings are stored only once
+    with open(path.join(str(tmpdir), 'dev', 'value', 'strings')) as fp:
+        assert fp.read().splitlines() == ["'abc'", '1']
+
+    # reopening gives the same results
+    store = ColumnStore(str(tmpdir))
+    assert store.last('dev/value') == (50., '1', False)
+    assert store.query('dev/value', 35, 45) == [(20., "'abc'"),
+                                                (40., "'abc'")]
+    store.close()
+
+
+def test_convert_flatfile(tmpdir):
+    src = path.join(str(tmpdir), 'flat')
+    for day, lines in [('01-01', ['value\t100.0\t+\t1.0\n',
+                                  'status\t100.0\t-\t(200, \'ok\')\n',
+                                  'value\t200.0\t+\t2.0\n']),
+                       ('01-02', ['value\t200.0\t+\t2.0\n',
+                                  'value\t300.0\t+\t-\n'])]:
+        ensureDirectory(path.join(src, '2020', day))
+        with open(path.join(src, '2020', day, 'nicos-dev'), 'w') as fp:
+            fp.write('# NICOS cache store file v2\n')
+            fp.writelines(lines)
+
+    store = ColumnStore(path.join(str(tmpdir), 'columnar'))
+    # the value repeated at the start of the second day is skipped
+    assert convertFlatfile(src, store) == 4
+    assert store.query('nicos/dev/value', 0, 1000) == [
+        (100., '1.0'), (200., '2.0'), (300., '')]
+    assert store.last('nicos/dev/status') == (100., "(200, 'ok')", True)
+    store.close()
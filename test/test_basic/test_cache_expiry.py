@@ -0,0 +1,63 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""NICOS tests for the cache database expiry queue."""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+from time import time as currenttime
+
+from nicos.services.cache.database.base import ExpiryQueue
+from nicos.services.cache.entry import CacheEntry
+
+
+def test_expiry_queue():
+    queue = ExpiryQueue()
+    expired = []
+    done = threading.Event()
+
+    def expire(key, entry, time):
+        expired.append((key, time - (entry.time + entry.ttl)))
+        if len(expired) == 3:
+            done.set()
+
+    now = currenttime()
+    queue.schedule('c', CacheEntry(now, 0.3, '3'))
+    queue.schedule('a', CacheEntry(now - 10, 1, '1'))
+    queue.schedule('b', CacheEntry(now, 0.1, '2'))
+    # entries without TTL are never scheduled
+    queue.schedule('d', CacheEntry(now, None, '4'))
+    assert len(queue) == 3
+
+    thread = threading.Thread(target=queue.run, args=(expire,))
+    thread.start()
+    try:
+        assert done.wait(5)
+    finally:
+        queue.stop()
+        thread.join()
+    assert [key for (key, _) in expired] == ['a', 'b', 'c']
+    # entries are expired on time, not late
+    assert all(0 <= delay < 0.2 for (key, delay) in expired[1:])
@@ -0,0 +1,76 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""NICOS tests for the flatfile cache database store files."""
+
+from __future__ import absolute_import, division, print_function
+
+import gzip
+from os import path
+
+import pytest
+
+from nicos.services.cache.database.flatfile import COMPRESSIONS, \
+    HistoryIndex, openStoreFile
+
+STORE = b'''\
+# NICOS cache store file v2
+value\t100.0\t+\t1.0
+status\t100.0\t+\t(200, 'ok')
+value\t1300.0\t+\t2.0
+value\t2500.0\t+\t3.0
+'''
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESSIONS))
+def test_compressed_storefile(tmpdir, compression):
+    suffix, opener = COMPRESSIONS[compression]
+    if opener is None:
+        pytest.skip('compression %s not supported' % compression)
+    filename = path.join(str(tmpdir), 'nicos-dev')
+    fd = opener(filename + suffix, 'wb')
+    fd.write(STORE)
+    fd.close()
+
+    fd = openStoreFile(filename)
+    with fd:
+        assert fd.read() == STORE
+
+    # the index refers to offsets in the uncompressed data
+    index = HistoryIndex.build(filename, path.join(str(tmpdir), 'index'))
+    start, end = index.byterange('value', 1300, 1400)
+    fd = openStoreFile(filename)
+    with fd:
+        fd.seek(start)
+        assert fd.read(end - start).splitlines() == [
+            b'value\t100.0\t+\t1.0', b"status\t100.0\t+\t(200, 'ok')", b'value\t1300.0\t+\t2.0']
+
+
+def test_missing_storefile(tmpdir):
+    assert openStoreFile(path.join(str(tmpdir), 'nicos-dev')) is None
+    with open(path.join(str(tmpdir), 'nicos-dev'), 'wb') as fp:
+        fp.write(STORE)
+    fd = openStoreFile(path.join(str(tmpdir), 'nicos-dev'))
+    with fd:
+        assert not isinstance(fd, gzip.GzipFile)
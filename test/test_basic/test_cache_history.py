@@ -0,0 +1,114 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+
+"""NICOS tests for the history cache of cache clients."""
+
+from __future__ import absolute_import, division, print_function
+
+from time import time as currenttime
+
+from nicos.devices.cacheclient import HistoryCache
+from nicos.protocols.cache import cache_dump
+
+
+class Store(object):
+    """History of a single key, queried like the cache server."""
+
+    def __init__(self, points):
+        self.points = points
+        self.queries = []
+
+    def fetch(self, fromtime, totime):
+        self.queries.append((fromtime, totime))
+        before = [p for p in self.points if p[0] < fromtime]
+        return before[-1:] + [p for p in self.points
+                              if fromtime <= p[0] <= totime]
+
+    def query(self, fromtime, totime):
+        return self.fetch(fromtime, totime)
+
+
+def test_ranges():
+    store = Store([(float(t), t) for t in range(0, 100, 10)])
+    cache = HistoryCache(4)
+    # first query fetches the whole range
+    assert cache.query('key', 15, 45, store.fetch) == store.query(15, 45)
+    assert store.queries == [(15, 45)] * 2
+    del store.queries[:]
+    # contained ranges are answered from the cache
+    assert cache.query('key', 25, 35, store.fetch) == [(20, 20), (30, 30)]
+    assert cache.query('key', 15, 45, store.fetch) == store.fetch(15, 45)
+    assert store.queries == [(15, 45)]
+    del store.queries[:]
+    # overlapping ranges fetch only the missing intervals
+    assert cache.query('key', 5, 65, store.fetch) == store.fetch(5, 65)
+    assert store.queries == [(5, 15), (45, 65), (5, 65)]
+    del store.queries[:]
+    assert cache.query('key', 0, 65, store.fetch) == store.fetch(0, 65)
+    assert store.queries == [(0, 5), (0, 65)]
+    del store.queries[:]
+    # disjoint ranges replace the cached range
+    assert cache.query('key', 80, 85, store.fetch) == store.fetch(80, 85)
+    assert store.queries == [(80, 85), (80, 85)]
+    assert len(cache) == 1
+
+
+def test_lru():
+    store = Store([(1., 1)])
+    cache = HistoryCache(2)
+    for key in ['a', 'b', 'a', 'c']:
+        cache.query(key, 0, 10, store.fetch)
+    assert store.queries == [(0, 10), (0, 10), (0, 10)]
+    # 'b' was evicted
+    cache.query('b', 0, 10, store.fetch)
+    cache.query('a', 0, 10, store.fetch)
+    assert len(store.queries) == 5
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_live():
+    now = currenttime()
+    store = Store([(now - 100, 1), (now - 50, 2)])
+    cache = HistoryCache(2)
+    assert cache.query('key', now - 80, now, store.fetch) == \
+        [(now - 100, 1), (now - 50, 2)]
+    assert len(store.queries) == 1
+    # updates extend the live range
+    cache.update('key', now - 1, cache_dump([1, 2]))
+    cache.update('other', now - 1, '3')
+    result = cache.query('key', now - 60, currenttime(), store.fetch)
+    assert result == [(now - 100, 1), (now - 50, 2), (now - 1, [1, 2])]
+    assert len(store.queries) == 1
+    # values after the current time are fetched
+    cache.query('key', now - 60, now + 100, store.fetch)
+    assert len(store.queries) == 2
+    # after a disconnect, the missing interval is fetched again
+    cache.disconnected()
+    cache.update('key', now + 150, '4')
+    store.points.append((now + 150, 4))
+    result = cache.query('key', now - 60, now + 200, store.fetch)
+    assert result[-1] == (now + 150, 4)
+    assert len(store.queries) == 3
@@ -0,0 +1,145 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""NICOS tests for the shared memory cache mirror."""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+from time import sleep
+
+import pytest
+
+from nicos.devices.cachemirror import MirrorPublisher, MirrorReader, \
+    MirrorTable
+
+
+class Log(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg, *args, **kwds):
+        self.warnings.append(msg % args)
+
+
+def wait_for(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        sleep(0.01)
+    return condition()
+
+
+def test_table(tmpdir):
+    path = str(tmpdir.join('mirror'))
+    table = MirrorTable(path, 'cache|nicos/', nslots=4, slotsize=512,
+                        create=True)
+    table.write(0, 'motor/value', 1.5, '2.5')
+    table.write(1, 'motor/status', 2.0, 'x' * 1000)
+    table.write(0, 'motor/value', 3.0, '', expired=True)
+    assert table.used == 2
+
+    reader = MirrorTable(path)
+    assert reader.source == 'cache|nicos/'
+    assert (reader.nslots, reader.slotsize) == (4, 512)
+    assert reader.used == 2
+    assert reader.read(0) == ('motor/value', 3.0, '', True)
+    # too long for the slot
+    assert reader.read(1) == ('motor/status', 2.0, None, False)
+    reader.close()
+    table.close()
+
+    with pytest.raises(ValueError):
+        MirrorTable(path, slotsize=64, create=True)
+    tmpdir.join('other').write('no table')
+    with pytest.raises(ValueError):
+        MirrorTable(str(tmpdir.join('other')))
+
+
+def test_seqlock(tmpdir):
+    path = str(tmpdir.join('mirror'))
+    table = MirrorTable(path, nslots=1, slotsize=512, create=True)
+    table.write(0, 'key', 0, '0')
+    reader = MirrorTable(path)
+    stop = []
+
+    def writer():
+        i = 0
+        while not stop:
+            i += 1
+            table.write(0, 'key', i, str(i) * (i % 50 + 1))
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(20000):
+            _, time, value, _ = reader.read(0)
+            # never a mix of two writes
+            assert value == str(int(time)) * (int(time) % 50 + 1)
+    finally:
+        stop.append(1)
+        thread.join()
+    reader.close()
+    table.close()
+
+
+def test_publish(tmpdir):
+    path = str(tmpdir.join('mirror'))
+    log = Log()
+    publisher = MirrorPublisher.acquire(path, 'src', log, nslots=3,
+                                        slotsize=512)
+    # only one publisher at a time
+    assert MirrorPublisher.acquire(path, 'src', log) is None
+    publisher.publish('a/value', 1.0, '1')
+    publisher.publish('b/value', 1.0, '2')
+    publisher.start()
+
+    received = []
+    with pytest.raises(ValueError):
+        MirrorReader(path, 'other', log, None)
+    reader = MirrorReader(path, 'src', log,
+                          lambda *args: received.append(args))
+    reader.attach()
+    assert received == [('a/value', 1.0, '1', False),
+                        ('b/value', 1.0, '2', False)]
+    publisher.publish('a/value', 2.0, '3')
+    publisher.publish('b/value', 3.0, '4', expired=True)
+    assert wait_for(lambda: len(received) == 4)
+    assert received[2:] == [('a/value', 2.0, '3', False),
+                            ('b/value', 3.0, '4', True)]
+
+    # the table is full: readers are detached and cannot attach again
+    publisher.publish('c/value', 1.0, '5')
+    publisher.publish('d/value', 1.0, '6')
+    assert log.warnings
+    assert wait_for(lambda: reader.lost)
+    reader.stop()
+    with pytest.raises(ValueError):
+        MirrorReader(path, 'src', log, None)
+
+    # the lock is released on stop
+    publisher.stop()
+    publisher = MirrorPublisher.acquire(path, 'src', log)
+    assert publisher is not None
+    publisher.stop()
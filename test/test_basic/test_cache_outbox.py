@@ -0,0 +1,76 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+
+"""NICOS tests for the outbox of cache server connections."""
+
+from __future__ import absolute_import, division, print_function
+
+from nicos.services.cache.server import CacheOutbox
+
+
+class DummyWorker(object):
+    overflowed = None
+
+    def overflow(self, queued, conflated):
+        self.overflowed = (queued, conflated)
+
+
+def test_outbox_in_order():
+    outbox = CacheOutbox(DummyWorker(), maxsize=10, conflate=3)
+    assert not outbox.has_data()
+    assert outbox.put('a=1\n', 'a')
+    assert not outbox.put('a=2\n', 'a')
+    outbox.put('reply\n')
+    # below the conflation limit, every update is kept
+    assert outbox.get() == 'a=1\na=2\nreply\n'
+    assert outbox.conflated == 0
+    assert len(outbox) == 0
+
+
+def test_outbox_conflation():
+    outbox = CacheOutbox(DummyWorker(), maxsize=10, conflate=3)
+    for line in ['a=1\n', 'b=1\n', 'c=1\n']:
+        outbox.put(line, line[0])
+    outbox.put('reply\n')
+    # the client is lagging: latest value of each key replaces older ones,
+    # and goes after the reply
+    outbox.put('a=2\n', 'a')
+    outbox.put('b=2\n', 'b')
+    outbox.put('b=3\n', 'b')
+    assert len(outbox) == 3
+    assert outbox.conflated == 3
+    assert outbox.get() == 'c=1\nreply\na=2\nb=3\n'
+
+
+def test_outbox_overflow():
+    worker = DummyWorker()
+    outbox = CacheOutbox(worker, maxsize=3, conflate=2)
+    for i in range(4):
+        outbox.put('k%d=1\n' % i, 'k%d' % i)
+    assert worker.overflowed == (4, 0)
+    assert outbox.overflowed
+    # a closed outbox accepts no more data
+    assert not outbox.put('k0=2\n', 'k0')
+    assert outbox.get() is None
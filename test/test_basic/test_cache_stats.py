@@ -0,0 +1,75 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+
+"""NICOS tests for the cache server statistics."""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+from nicos.services.cache.stats import Histogram, ServerStats, TimedLock, \
+    formatStats
+
+
+def test_histogram():
+    histogram = Histogram()
+    for duration in [2e-6, 5e-5, 5e-5, 0.5, 20]:
+        histogram.add(duration)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 5
+    assert snapshot['max'] == 20
+    assert snapshot['buckets'] == [(1e-5, 1), (1e-4, 2), (1e-3, 0),
+                                   (1e-2, 0), (0.1, 0), (1., 1), (10., 0),
+                                   (None, 1)]
+    lines = formatStats({'latency': snapshot, 'other': {'x': 1.0}})
+    assert lines[0].startswith('latency: 5, mean ')
+    assert lines[-2:] == ['other:', '    x: 1.00']
+
+
+def test_timed_lock():
+    histogram = Histogram()
+    lock = TimedLock(histogram)
+    with lock:
+        pass
+    # uncontended acquisitions are not recorded
+    assert histogram.snapshot()['count'] == 0
+    lock.acquire()
+    waiter = threading.Thread(target=lambda: lock.acquire() and lock.release())
+    waiter.start()
+    waiter.join(0.05)
+    lock.release()
+    waiter.join()
+    assert histogram.snapshot()['count'] == 1
+    assert histogram.snapshot()['max'] > 0.01
+
+
+def test_update_rates():
+    stats = ServerStats()
+    for key in ['nicos/a/value', 'nicos/a/status', 'nicos/b/value', 'key']:
+        stats.countUpdate(key)
+    rates = stats.updateRates()
+    assert set(rates) == {'nicos/a', 'nicos/b', 'nocat'}
+    assert rates['nicos/a'] == 2 * rates['nicos/b']
+    assert stats.updateRates() == {}
@@ -0,0 +1,65 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""NICOS tests for the cache server subscription index."""
+
+from __future__ import absolute_import, division, print_function
+
+from nicos.services.cache.subscriptions import SubscriptionIndex, \
+    SubstringMatcher
+
+
+def test_substring_matcher():
+    patterns = ['nicos/', 'he', 'she', 'his', 'hers', 'value', 'x']
+    matcher = SubstringMatcher(patterns)
+    for text in ['nicos/t/value', 'ushers', 'this', 'abc', 'nicos/x/status',
+                 'hishe', '']:
+        assert matcher.search(text) == \
+            set(p for p in patterns if p in text)
+
+
+def test_subscription_lookup():
+    index = SubscriptionIndex()
+    index.add('w1', 'nicos/', False)
+    index.add('w1', 'nicos/t/', True)
+    index.add('w2', '/value', False)
+    index.add('w3', 'other/', False)
+    index.add('w4', '', False)
+
+    assert dict(index.lookup('nicos/t/value')) == \
+        {'w1': True, 'w2': False, 'w4': False}
+    assert dict(index.lookup('nicos/m/status')) == {'w1': False, 'w4': False}
+    assert dict(index.lookup('other/x')) == {'w3': False, 'w4': False}
+
+    # removing one kind of subscription keeps the other
+    index.remove('w1', 'nicos/t/', True)
+    index.add('w1', 'nicos/t/', False)
+    index.add('w1', 'nicos/t/', True)
+    index.remove('w1', 'nicos/t/', True)
+    assert dict(index.lookup('nicos/t/value'))['w1'] is False
+
+    index.remove_worker('w4')
+    index.remove('w2', '/value', False)
+    assert dict(index.lookup('nicos/t/value')) == {'w1': False}
+    assert len(index) == 3
@@ -0,0 +1,94 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+
+"""NICOS tests for the wildcard index of cache databases."""
+
+from __future__ import absolute_import, division, print_function
+
+from nicos.services.cache.database.base import WildcardIndex
+
+
+class Database(object):
+    def __init__(self, values):
+        self.values = values
+        self.validuntil = float('inf')
+        self.scans = self.builds = 0
+
+    def scan(self):
+        self.scans += 1
+        return list(self.values)
+
+    def build(self, keys, ts):
+        self.builds += 1
+        return [''.join('%s=%s\n' % (key, self.values[key])
+                        for key in sorted(keys))], self.validuntil
+
+    def tell(self, index, key, value):
+        self.values[key] = value
+        index.update(key)
+
+
+def test_wildcard_index():
+    db = Database({'nicos/a/value': '1', 'nicos/b/value': '2', 'other/x': '3'})
+    index = WildcardIndex()
+
+    def query(pattern):
+        return index.query(pattern, False, db.scan, db.build)
+
+    assert query('nicos/') == ['nicos/a/value=1\nnicos/b/value=2\n']
+    assert query('/value') == ['nicos/a/value=1\nnicos/b/value=2\n']
+    assert db.scans == 2
+    # repeated queries use the cached response
+    assert query('nicos/') == ['nicos/a/value=1\nnicos/b/value=2\n']
+    assert db.builds == 2
+    # updates and new keys invalidate the matching responses only
+    db.tell(index, 'nicos/a/value', '4')
+    db.tell(index, 'nicos/c/value', '5')
+    db.tell(index, 'other/y', '6')
+    assert query('nicos/') == \
+        ['nicos/a/value=4\nnicos/b/value=2\nnicos/c/value=5\n']
+    assert query('other') == ['other/x=3\nother/y=6\n']
+    assert db.scans == 3
+    assert db.builds == 4
+    # responses are rebuilt when a TTL has run out
+    db.validuntil = 0
+    db.tell(index, 'nicos/a/value', '7')
+    query('nicos/')
+    query('nicos/')
+    assert db.builds == 6
+
+
+def test_wildcard_index_eviction():
+    db = Database({'key%d' % i: str(i) for i in range(10)})
+    index = WildcardIndex(maxpatterns=3)
+    for i in range(5):
+        index.query('key%d' % i, True, db.scan, db.build)
+    assert len(index) == 3
+    index.query('key4', True, db.scan, db.build)
+    assert db.scans == 5
+    index.query('key0', True, db.scan, db.build)
+    assert db.scans == 6
+    index.clear()
+    assert len(index) == 0
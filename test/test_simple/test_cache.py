@@ -28,12 +28,14 @@
 
 from __future__ import absolute_import, division, print_function
 
-from time import sleep
+from time import sleep, time
 
+import mock
 import pytest
 
 from nicos.core.errors import CommunicationError, LimitError
 from nicos.devices.cacheclient import CacheClient
+from nicos.protocols.cache import cache_dump
 from nicos.utils import readonlydict, readonlylist
 
 from test.utils import cache_addr, raises
@@ -64,6 +66,18 @@ class TestCache(object):
         assert cachedval_local == testval
         assert cachedval[2] == testval
 
+    def test_write_multi(self, session):
+        cc = session.cache
+        cc.put('testcache', 'multi1', 1)
+        cc.put('testcache', 'multi2', 'two', ttl=100)
+        cc.flush()
+        values = cc.get_explicit('testcache', ['multi2', 'multi1', 'missing'],
+                                 Ellipsis)
+        assert [value for (_, _, value) in values] == ['two', 1, Ellipsis]
+        assert values[0][1] == 100
+        assert values[1][0] is not None and values[1][1] is None
+        assert values[2][:2] == (None, None)
+
     def test_rewrite(self, session):
         cc = session.cache
         cc.setRewrite('testrewrite', 'testcache')
@@ -203,6 +217,46 @@ class TestCache(object):
         finally:
             cc2.shutdown()
 
+    def test_lazy_decoding(self, session):
+        cc = session.cache
+        cc2 = CacheClient(name='cache2', prefix='nicos', cache=cache_addr)
+        try:
+            cc2.put('testcache', 'lazy', [1, 2])
+            cc2.flush()
+            sleep(0.2)
+            # not decoded before it is needed...
+            assert cc._db['testcache/lazy'][2] == cache_dump([1, 2])
+            assert cc.get('testcache', 'lazy') == [1, 2]
+            # ... and only once
+            assert cc._db['testcache/lazy'][2] is None
+            assert cc.query_db('testcache/lazy') == [('testcache/lazy',
+                                                      [1, 2])]
+        finally:
+            cc2.shutdown()
+
+    def test_pattern_callback(self, session):
+        cc = session.cache
+        cc2 = CacheClient(name='cache2', prefix='nicos', cache=cache_addr)
+        called = []
+
+        def callback(key, value, time):
+            called.append((key, value))
+        cc.addPatternCallback('testcb*/val?e', callback)
+        try:
+            cc2.put('testcb1', 'value', 1)
+            cc2.put('testcb1', 'other', 2)
+            cc2.put('testcb2', 'value', 3)
+            cc2.flush()
+            for _ in range(50):
+                if len(called) == 2:
+                    break
+                sleep(0.1)
+            assert called == [('testcb1/value', 1), ('testcb2/value', 3)]
+            assert cc.getCallbackStats()['latency']['count'] >= 2
+        finally:
+            cc.removePatternCallback('testcb*/val?e', callback)
+            cc2.shutdown()
+
     def test_cache_writer(self, session, log):
         cc = session.cache
         cc2 = CacheClient(name='cache2', prefix='nicos', cache=cache_addr)
@@ -232,3 +286,48 @@ class TestCache(object):
             assert raises(LimitError, wrt1.move, 500)
         finally:
             cc2.shutdown()
+
+    def test_history(self, session):
+        cc = session.cache
+        start = time()
+        for i in range(5):
+            cc.put('testcache', 'hist', i, time=start + i)
+        cc.flush()
+        hist = cc.history('testcache', 'hist', start - 1, start + 10)
+        assert hist == [(start + i, i) for i in range(5)]
+        # the last value before the range is also returned
+        hist = cc.history('testcache', 'hist', start + 2.5, start + 3.5)
+        assert hist == [(start + 2, 2), (start + 3, 3)]
+
+    def test_history_downsampled(self, session):
+        cc = session.cache
+        start = time()
+        values = [0, 5, 1, 2, -3, 4, 1, 0, 8, 2, 3]
+        for i, value in enumerate(values):
+            cc.put('testcache', 'histds', value, time=start + i)
+        cc.flush()
+        # three buckets of ~3.3 seconds: only minimum and maximum remain
+        hist = cc.history('testcache', 'histds', start, start + 10,
+                          maxpoints=7)
+        assert hist == [(start, 0), (start + 1, 5), (start + 4, -3),
+                        (start + 5, 4), (start + 7, 0), (start + 8, 8)]
+        # without downsampling, all values are returned
+        hist = cc.history('testcache', 'histds', start, start + 10)
+        assert [v for (_, v) in hist] == values
+
+    def test_history_cache(self, session):
+        cc = session.cache
+        start = time()
+        cc.put('testcache', 'histcache', 1, time=start - 10)
+        cc.flush()
+        hist = cc.history('testcache', 'histcache', start - 60, time())
+        assert hist == [(start - 10, 1)]
+        # repeated queries are answered locally, and the range up to now is
+        # kept up to date with the updates
+        cc.put('testcache', 'histcache', 2, time=start - 5)
+        with mock.patch.object(cc, '_query_history',
+                               side_effect=AssertionError('not cached')):
+            hist = cc.history('testcache', 'histcache', start - 60, time())
+            assert hist == [(start - 10, 1), (start - 5, 2)]
+            hist = cc.history('testcache', 'histcache', start - 8, time())
+            assert hist == [(start - 10, 1), (start - 5, 2)]
@@ -27,22 +27,32 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import sys
 from time import sleep
 
 import pytest
 
-from nicos.devices.cacheclient import CacheError
+from nicos.devices import cacheclient
+from nicos.devices.cacheclient import CacheError, SyncCacheClient
+from nicos.protocols.cache import cache_dump, cache_load
+from nicos.pycompat import from_utf8, to_utf8
+from nicos.services.cache.stats import formatStats, queryStats
+from nicos.utils import tcpSocket
 
 from test.utils import TestCacheClient as CacheClient, alt_cache_addr, \
-    killSubprocess, raises, startCache
+    cache_addr, killSubprocess, raises, startCache
 
 session_setup = 'cachestress'
 
 
 def all_setups():
-    for setup in ['cache_db', 'cache_mem', 'cache_mem_hist']:
+    for setup in ['cache_db', 'cache_db_writebehind', 'cache_mem',
+                  'cache_mem_hist', 'cache_columnar', 'cache_replica']:
         yield setup
 
+    if sys.version_info[0] >= 3:
+        yield 'cache_selector'
+
     if os.environ.get('KAFKA_URI', None):
         yield 'cache_kafka'
 
@@ -99,3 +109,149 @@ def test_restart(session, setup):
         assert cachedval2[2] == testval
     finally:
         killSubprocess(cache)
+
+
+def raw_request(addr, line, reply=True):
+    sock = tcpSocket(addr, 0)
+    try:
+        sock.sendall(to_utf8(line))
+        data = b''
+        while reply and not data.endswith(b'\n'):
+            data += sock.recv(8192)
+        return from_utf8(data)
+    finally:
+        sock.close()
+
+
+def test_replica(session):
+    cache = startCache(alt_cache_addr, 'cache_replica')
+    try:
+        sleep(1)
+        cc = session.cache
+        # writes to the replica are forwarded to the primary
+        cc.put('testreplica', 'value', 'fromreplica')
+        cc.flush()
+        sleep(0.5)
+        reply = raw_request(cache_addr, 'nicos/testreplica/value?\n')
+        assert cache_load(reply.partition('=')[2]) == 'fromreplica'
+        # writes to the primary are mirrored
+        raw_request(cache_addr, 'nicos/testreplica/other=%s\n' %
+                    cache_dump('fromprimary'), reply=False)
+        sleep(0.5)
+        assert cc.get_explicit('testreplica', 'other', None)[2] == \
+            'fromprimary'
+        # locks are managed by the primary
+        assert raw_request(alt_cache_addr, 'nicos/testreplica$+one\n') == \
+            'nicos/testreplica$\n'
+        assert raw_request(cache_addr, 'nicos/testreplica$+two\n') == \
+            'nicos/testreplica$one\n'
+        assert raw_request(alt_cache_addr, 'nicos/testreplica$-one\n') == \
+            'nicos/testreplica$\n'
+    finally:
+        killSubprocess(cache)
+
+
+def test_stats(session):
+    cache = startCache(alt_cache_addr, 'cache_mem')
+    try:
+        sleep(1)
+        cc = session.cache
+        # update rates are published for the last interval only
+        for i in range(50):
+            cc.put('teststats', 'value', i)
+            cc.flush()
+            sleep(0.1)
+            stats = queryStats(alt_cache_addr)
+            if stats.get('updaterate', {}).get('nicos/teststats'):
+                break
+        else:
+            assert False, 'no update rate published'
+        cc.get_explicit('teststats', 'value')
+        sleep(0.6)
+        stats = queryStats(alt_cache_addr)
+        assert stats['asklatency']['count'] >= 1
+        assert stats['subscriptions'] >= 1
+        assert 'lockwait' in stats['database']
+        assert any(client['sent'] > 0 for client in stats['clients'].values())
+        assert formatStats(stats)
+    finally:
+        killSubprocess(cache)
+
+
+def test_initial_sync(session):
+    cache = startCache(alt_cache_addr, 'cache_mem')
+    try:
+        sleep(1)
+        # more data than the old limit of 1000 reads of the initial reply
+        value = cache_dump('x' * 500)
+        nkeys = 20000
+        raw_request(alt_cache_addr, ''.join(
+            'testsync/key%d=%s\n' % (i, value) for i in range(nkeys)),
+            reply=False)
+        sleep(1)
+        client = SyncCacheClient('Syncer', cache=alt_cache_addr,
+                                 prefix='testsync/', lowlevel=True)
+        try:
+            values = client.get_values()
+        finally:
+            client.doShutdown()
+        assert len(values) == nkeys
+        assert values['key%d' % (nkeys - 1)] == 'x' * 500
+    finally:
+        killSubprocess(cache)
+
+
+def test_mirror(session, tmpdir):
+    cache = startCache(alt_cache_addr, 'cache_mem')
+    path = str(tmpdir.join('mirror'))
+    clients = []
+
+    def client(name):
+        clients.append(cacheclient.CacheClient(
+            name, cache=alt_cache_addr, prefix='testmirror/', mirror=path,
+            lowlevel=True))
+        clients[-1].waitForStartup(5)
+        return clients[-1]
+
+    def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return True
+            sleep(0.05)
+        return False
+
+    try:
+        sleep(1)
+        raw_request(alt_cache_addr, 'testmirror/dev/old=%s\n' %
+                    cache_dump(1), reply=False)
+        sleep(0.2)
+        publisher = client('MirrorPublisher')
+        reader = client('MirrorReader')
+        assert publisher._publisher and not publisher._reader
+        assert reader._reader and not reader._publisher
+        assert reader.get('dev', 'old') == 1
+
+        updates = []
+        reader.addCallback('dev', 'new', lambda *args: updates.append(args))
+        raw_request(alt_cache_addr, 'testmirror/dev/new=%s\n' %
+                    cache_dump('x' * 2000), reply=False)
+        assert wait_for(lambda: updates)
+        assert reader.get('dev', 'new') == 'x' * 2000
+
+        # writes go to the server, and are not processed again when the
+        # mirror sends them back
+        reader.put('dev', 'new', 'mine')
+        reader.flush()
+        assert wait_for(lambda: publisher.get('dev', 'new') == 'mine')
+        assert reader.get_explicit('dev', 'new')[2] == 'mine'
+        sleep(0.2)
+        assert len(updates) == 1
+
+        # when the publisher goes away, another client takes over
+        publisher.shutdown()
+        assert wait_for(lambda: reader._publisher)
+        assert reader.get('dev', 'old') == 1
+    finally:
+        for cc in clients:
+            cc.shutdown()
+        killSubprocess(cache)
@@ -0,0 +1,113 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# NICOS, the Networked Instrument Control System of the MLZ
+# Copyright (c) 2009-2020 by the NICOS contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <georg.brandl@frm2.tum.de>
+#
+# *****************************************************************************
+
+"""NICOS tests for the asyncio cache client (Python 3 only)."""
+
+import asyncio
+from time import sleep, time as currenttime
+
+import pytest
+
+from nicos.clients.aiocache import AsyncCacheClient
+from nicos.core.errors import CacheError
+
+from test.utils import alt_cache_addr, killSubprocess, startCache
+
+session_setup = 'cachestress'
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(asyncio.wait_for(coro, 30))
+    finally:
+        loop.close()
+
+
+def test_client(session):
+    cache = startCache(alt_cache_addr, 'cache_mem_hist')
+    try:
+        sleep(1)
+        run(check_client())
+    finally:
+        killSubprocess(cache)
+
+
+async def check_client():
+    start = currenttime()
+    async with AsyncCacheClient(alt_cache_addr, 'testaio/') as client:
+        for i in range(5):
+            await client.put('dev%d/value' % i, i, time=start + i)
+        await client.put('dev0/status', (200, 'ok'), time=start + 5)
+        assert await client.get('dev0/status') == (200, 'ok')
+        assert await client.get('missing/value', 'default') == 'default'
+        assert await client.get_many(['dev1/value', 'dev2/value', 'x/y']) \
+            == [1, 2, None]
+        assert await client.query('dev0/') == {'dev0/value': 0,
+                                               'dev0/status': (200, 'ok')}
+
+        for i in range(1, 10):
+            await client.put('dev0/value', i, time=start + i)
+        history = await client.history('dev0/value', start, start + 20)
+        assert history == [(start + i, i) for i in range(10)]
+        # many concurrent queries over few connections
+        histories = await client.history_many(
+            ['dev%d/value' % (i % 5) for i in range(200)], start, start + 20)
+        assert len(histories) == 5
+        assert histories['dev3/value'] == [(start + 3, 3)]
+
+        subscription = await client.subscribe('dev1/')
+        other = await client.subscribe('dev')
+        await client.put('dev1/value', 'new', time=start + 30)
+        await client.put('dev2/value', 'other', time=start + 31)
+        assert await subscription.__anext__() == \
+            (start + 30, 'dev1/value', 'new', False)
+        assert [await other.__anext__() for _ in range(2)] == [
+            (start + 30, 'dev1/value', 'new', False),
+            (start + 31, 'dev2/value', 'other', False)]
+        await subscription.close()
+        assert [item async for item in subscription] == []
+
+    # the iterators end when the client is closed
+    assert [item async for item in other] == []
+
+
+def test_connection_lost(session):
+    cache = startCache(alt_cache_addr, 'cache_mem')
+    try:
+        sleep(1)
+
+        async def check():
+            client = AsyncCacheClient(alt_cache_addr, 'testaio/')
+            subscription = await client.subscribe('dev')
+            killSubprocess(cache)
+            with pytest.raises(CacheError):
+                await subscription.__anext__()
+            with pytest.raises(CacheError):
+                await client.get('dev/value')
+            client.close()
+
+        run(check())
+    finally:
+        killSubprocess(cache)
@@ -317,6 +317,7 @@ class TestCacheDatabase(FlatfileCacheDatabase):
         if key == '__clear__':
             with self._cat_lock:
                 self._cat.clear()
+            self._wildcard.clear()
             return
 
         FlatfileCacheDatabase.tell(self, key, value, time, ttl, from_client)